@@ -1,8 +1,610 @@
 
+import asyncio
 import logging
+import math
+import queue
+import re
 import serial
+import threading
 import time
-import yaml
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
+from kinematics import (
+    DEFAULT_SETTINGS, LineTimer, estimate_gcode_duration, move_limits, parse_grbl_settings,
+    profile_distance, profile_duration, profile_speed, trapezoid,
+)
+from gcode_tools import (
+    StreamOptimizer, WireEncoder, fit_arcs, iter_optimize_gcode, open_gcode, optimize_gcode,
+    step_decimals,
+)
+from job_checkpoint import Checkpointer, ModalState, load_checkpoint
+from location_table import LocationWatcher, compile_locations, load_location_table
+from route_planner import optimize_route
+
+
+# GRBL 1.1 real-time commands: GRBL acts on these bytes as soon as it reads
+# them, so they are written straight to the port, never queued behind lines
+CMD_FEED_HOLD = b"!"
+CMD_CYCLE_START = b"~"
+CMD_SOFT_RESET = b"\x18"
+CMD_JOG_CANCEL = b"\x85"
+# reset to 100 %, +10, -10, +1, -1
+FEED_OVERRIDE_CMDS = (0x90, 0x91, 0x92, 0x93, 0x94)
+SPINDLE_OVERRIDE_CMDS = (0x99, 0x9A, 0x9B, 0x9C, 0x9D)
+RAPID_OVERRIDE_CMDS = {100: 0x95, 50: 0x96, 25: 0x97}
+
+# Put in the ack queue by soft_reset() so a send waiting on acks stops at once
+_RESET_ACK = "soft reset"
+
+# [MSG:], [GC:] and $ reply lines kept for read_grbl_settings() and the
+# like; nothing else reads them, so older ones are dropped beyond this
+MESSAGE_BACKLOG = 256
+
+
+def _failed(r):
+    return r.startswith("error:") or r.startswith("ALARM:") or r == _RESET_ACK
+
+
+def override_bytes(percent, cmds, low=10, high=200):
+    """
+    Real-time bytes that set a feed or spindle override to ``percent``:
+    back to 100 %, then steps of 10 and 1 (GRBL only offers increments).
+    """
+    percent = int(round(percent))
+    if not low <= percent <= high:
+        raise ValueError(f"Override {percent}% outside {low}-{high}%")
+    reset, up10, down10, up1, down1 = cmds
+    tens, ones = divmod(abs(percent - 100), 10)
+    if percent >= 100:
+        return bytes([reset] + [up10] * tens + [up1] * ones)
+    return bytes([reset] + [down10] * tens + [down1] * ones)
+
+
+def _put_dropping_oldest(q, item):
+    # put_nowait() on a bounded queue.Queue or asyncio.Queue, making room
+    # by dropping its oldest entry
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                q.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+
+
+def classify_response(line):
+    """Sort one line received from GRBL into ack/status/banner/message."""
+    if line.startswith("ok") or line.startswith("error:"):
+        return "ack"
+    if line.startswith("<"):
+        return "status"
+    if line.startswith("Grbl") or line.startswith("GrblHAL"):
+        return "banner"
+    return "message"
+
+
+class MachineStatus:
+    """
+    One parsed GRBL real-time status report, e.g.
+    <Run|MPos:1.000,2.000,-3.000|Bf:12,96|Ln:7|FS:500,0|WCO:0.000,0.000,0.000>
+    Positions are tuples of floats; fields absent from the report are None.
+    """
+
+    __slots__ = (
+        "state", "substate", "mpos", "wpos", "wco", "planner_free", "rx_free",
+        "line", "feed", "spindle", "overrides", "pins", "raw",
+    )
+
+    def __init__(self, state, substate=None, mpos=None, wpos=None, wco=None,
+                 planner_free=None, rx_free=None, line=None, feed=None,
+                 spindle=None, overrides=None, pins=None, raw=""):
+        self.state = state
+        self.substate = substate
+        self.mpos = mpos
+        self.wpos = wpos
+        self.wco = wco
+        self.planner_free = planner_free
+        self.rx_free = rx_free
+        self.line = line
+        self.feed = feed
+        self.spindle = spindle
+        self.overrides = overrides
+        self.pins = pins
+        self.raw = raw
+
+    @property
+    def idle(self):
+        return self.state == "Idle"
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{k}={getattr(self, k)!r}" for k in self.__slots__[:-1]
+            if getattr(self, k) is not None
+        )
+        return f"MachineStatus({fields})"
+
+
+def _floats(text):
+    return tuple(float(v) for v in text.split(","))
+
+
+def parse_status_report(report, wco=None):
+    """
+    Parse a '<...>' status report into a MachineStatus, or return None.
+    GRBL only sends WCO every few reports, so pass the last known offset as
+    ``wco`` to have both MPos and WPos filled in.
+    """
+    if not report or report[0] != "<" or report[-1] != ">":
+        return None
+    fields = report[1:-1].split("|")
+    state, _, sub = fields[0].partition(":")
+    st = MachineStatus(state, substate=int(sub) if sub.isdigit() else None, raw=report)
+    try:
+        for field in fields[1:]:
+            key, _, val = field.partition(":")
+            if key == "MPos":
+                st.mpos = _floats(val)
+            elif key == "WPos":
+                st.wpos = _floats(val)
+            elif key == "WCO":
+                st.wco = _floats(val)
+            elif key == "Bf":
+                st.planner_free, st.rx_free = (int(v) for v in val.split(","))
+            elif key == "Ln":
+                st.line = int(val)
+            elif key == "FS":
+                feed, _, spindle = val.partition(",")
+                st.feed = float(feed)
+                st.spindle = float(spindle) if spindle else None
+            elif key == "F":
+                st.feed = float(val)
+            elif key == "Ov":
+                st.overrides = tuple(int(v) for v in val.split(","))
+            elif key == "Pn":
+                st.pins = val
+    except ValueError:
+        return None
+    if st.wco is None:
+        st.wco = wco
+    if st.wco is not None:
+        if st.mpos is not None and st.wpos is None:
+            st.wpos = tuple(m - o for m, o in zip(st.mpos, st.wco))
+        elif st.wpos is not None and st.mpos is None:
+            st.mpos = tuple(w + o for w, o in zip(st.wpos, st.wco))
+    return st
+
+
+_GCODE_WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_GCODE_COMMENT = re.compile(r"\([^)]*\)|;.*")
+# $ commands that neither move the machine nor change its offsets
+_INERT_DOLLAR = re.compile(r"\$(?:\$|X|#|G|I|N|\d+=.*)?$")
+# Modal G-codes that leave the tool position alone (G54 being the only WCS used)
+_INERT_G = {4.0, 17.0, 18.0, 19.0, 21.0, 40.0, 54.0, 61.0, 64.0, 80.0, 93.0, 94.0}
+
+
+class AckTimeoutError(TimeoutError):
+    """
+    GRBL did not acknowledge a line by its deadline. ``outstanding`` lists
+    the lines sent but not acknowledged, oldest first.
+    """
+
+    def __init__(self, message, outstanding):
+        super().__init__(message)
+        self.outstanding = list(outstanding)
+
+
+def _override_s(est, kind, overrides):
+    # ``est`` seconds at the live feed or rapid override (``kind``, see
+    # LineTimer). Overrides above 100 % are not counted on: the axis max
+    # rates may still cap the speed.
+    if kind is None or overrides is None:
+        return est
+    return est * max(1.0, 100.0 / overrides[kind])
+
+
+def _planned_s(planned, overrides):
+    # Seconds the (est, kind) estimates in ``planned`` take
+    return sum(_override_s(est, kind, overrides) for est, kind in planned)
+
+
+class _AckDeadlines:
+    # Deadlines on time.monotonic() for the ack loops. The oldest line in
+    # flight is due by the last sign of progress (an ack, or its own send
+    # into an empty buffer) plus the time the blocks possibly still in the
+    # planner take, its own execution time and a margin; the whole job is
+    # due by job_end. Estimates are scaled by the overrides() in force.
+
+    def __init__(self, planned, margin_s, job_end=None, held=None, overrides=None):
+        self.planned = planned
+        self.margin_s = margin_s
+        self.job_end = job_end
+        # While held() the per-line clock stands still; the job one does not
+        self.held = held
+        self.overrides = overrides
+        self.progress = time.monotonic()
+
+    def sent(self, was_idle):
+        if was_idle:
+            self.progress = time.monotonic()
+
+    def acked(self, est, kind):
+        # Only motion and dwells take planner blocks; G90 and the like
+        # would push real moves out of the window
+        if est > 0.0:
+            self.planned.append((est, kind))
+        self.progress = time.monotonic()
+
+    def check(self, in_flight):
+        # in_flight entries are (line, nbytes, mark, est, kind)
+        if not in_flight:
+            return
+        now = time.monotonic()
+        outstanding = [entry[0] for entry in in_flight]
+        if self.job_end is not None and now > self.job_end:
+            raise AckTimeoutError(f"Job deadline passed with {len(outstanding)} lines "
+                                  f"unacknowledged (oldest: {outstanding[0]})", outstanding)
+        if self.held is not None and self.held():
+            self.progress = now
+            return
+        overrides = self.overrides() if self.overrides is not None else None
+        budget = (_planned_s(self.planned, overrides)
+                  + _override_s(in_flight[0][3], in_flight[0][4], overrides) + self.margin_s)
+        if now > self.progress + budget:
+            raise AckTimeoutError(f"No ack for {outstanding[0]} within {budget:.2f}s",
+                                  outstanding)
+
+
+class _HoldClock:
+    # Seconds on time.monotonic() since creation, standing still while
+    # held(): a feed hold is not a hung controller
+
+    def __init__(self, held):
+        self.held = held
+        self.last = time.monotonic()
+        self.elapsed = 0.0
+
+    def tick(self):
+        now = time.monotonic()
+        if not self.held():
+            self.elapsed += now - self.last
+        self.last = now
+        return self.elapsed
+
+
+def _get_nowait(q):
+    # The next item of a queue.Queue or asyncio.Queue, or None
+    try:
+        return q.get_nowait()
+    except (queue.Empty, asyncio.QueueEmpty):
+        return None
+
+
+class _Greeting:
+    # The decisions of wake_up(), shared by the sync and async loops, which
+    # only wait for a banner or a status report while waiting() says so.
+    # Boards that reset on open print the banner; boards that don't are
+    # probed with '?' once they had a chance to greet us.
+
+    def __init__(self, machine, max_s, probe_after_s, probe_every_s):
+        self.m = machine
+        self.max_s = max_s
+        self.probe_every_s = probe_every_s
+        self.greeting = None
+        machine.logger.debug("Waking GRBL and waiting for greeting.")
+        machine._drain_responses()
+        self.t0 = time.monotonic()
+        machine._write(b"\r\n\r\n")
+        self.next_probe = self.t0 + probe_after_s
+
+    def waiting(self):
+        # False once greeted or out of time; sends a probe when one is due
+        if self.greeting is not None:
+            return False
+        now = time.monotonic()
+        if now - self.t0 >= self.max_s:
+            return False
+        if now >= self.next_probe:
+            self.m._write(b"?")
+            self.next_probe = now + self.probe_every_s
+        return True
+
+    def result(self):
+        m = self.m
+        elapsed = time.monotonic() - self.t0
+        m._drain_responses()
+        m.stats["wake_s"] = elapsed
+        if self.greeting is None:
+            m.logger.warning("No greeting from GRBL after %.2fs; continuing.", elapsed)
+        else:
+            m.logger.info("GRBL awake after %.3fs (%s)", elapsed, self.greeting)
+        return elapsed
+
+
+class _IdleWait:
+    # The decisions of wait_until_idle(), shared by the sync and async
+    # loops, which only fetch status reports and acks and sleep as told.
+    # max_s (seconds, or a callable giving them, so a default follows the
+    # live overrides) counts time on ``clock``, which stops during a feed
+    # hold. With ``follow`` (the host knows of nothing queued, e.g. after a
+    # reconnect) status is polled throughout and every report showing the
+    # tool moved starts max_s over.
+
+    def __init__(self, machine, clock, poll_hz, max_s, adaptive, follow=False):
+        self.m = machine
+        self.clock = clock
+        self.max_s = max_s
+        self.adaptive = adaptive
+        self.follow = follow
+        self.moved_at = 0.0
+        self.mpos = None
+        self.period = 1.0 / float(poll_hz)
+        self.ack_timeout = min(0.1, self.period)
+        self.next_poll = time.monotonic() + self.period
+        self.last = ""
+        self.prev_feed, self.peak_feed = None, 0.0
+
+    def _delay(self, st):
+        # Shrink the poll period while the machine decelerates
+        if not self.adaptive:
+            return self.period
+        feed = st.feed if st else None
+        self.peak_feed = max(self.peak_feed, feed or 0.0)
+        delay = _adaptive_period(self.period, feed, self.prev_feed, self.peak_feed)
+        self.prev_feed = feed
+        return delay
+
+    def _expired(self):
+        self.limit = self.max_s() if callable(self.max_s) else self.max_s
+        return self.clock.tick() - self.moved_at > self.limit
+
+    def _moved(self, st):
+        if not self.follow or st is None or st.mpos is None:
+            return
+        if self.mpos is not None and st.mpos != self.mpos:
+            self.moved_at = self.clock.tick()
+        self.mpos = st.mpos
+
+    def status(self, st):
+        # Polling for Idle: None once ``st`` is Idle, else the delay before
+        # the next poll
+        self.last = st.raw if st else self.last
+        if st is not None and st.idle:
+            self.m._confirm_position(st)
+            return None
+        if st is not None and st.state == "Alarm":
+            raise RuntimeError(f"Controller in alarm while waiting for Idle: {self.last}")
+        self._moved(st)
+        if self._expired():
+            raise TimeoutError(f"Machine did not become Idle in {self.limit:.2f}s, "
+                               f"last status: {self.last}")
+        return self._delay(st)
+
+    def start_sync(self):
+        # GRBL only acks "G4 P0" once the planner has drained and motion stopped
+        m = self.m
+        m._drain_responses(m._acks)
+        m._alarm = None
+        m.logger.debug(">> G4 P0")
+        m._write(b"G4 P0\n")
+
+    def sync_ack(self, r):
+        # Waiting for the G4 P0 ack: True once ``r`` is it
+        if r.startswith("ok"):
+            return True
+        if _failed(r):
+            self.m.logger.error("%s (for: G4 P0)", r)
+            raise RuntimeError(f"{r} (for: G4 P0)")
+        if self._expired():
+            raise TimeoutError(f"G4 P0 sync not acknowledged in {self.limit:.2f}s, "
+                               f"last status: {self.last}")
+        return False
+
+    def poll_due(self):
+        # Adaptive sync waits also poll the status, for the feed, and
+        # following ones for motion
+        return (self.adaptive or self.follow) and time.monotonic() >= self.next_poll
+
+    def sync_status(self, st):
+        self.last = st.raw if st else self.last
+        self._moved(st)
+        self.next_poll = time.monotonic() + self._delay(st)
+
+
+class _LineStream:
+    # The send/ack state machine shared by every sender; callers only pull
+    # lines and wait for replies, in their own sync or async way. Lines go
+    # out while they fit in ``window`` bytes of GRBL's RX buffer (one at a
+    # time with a window of 0) and each ok/error is paired with the oldest
+    # line still in flight. The buffer holds window - 1 bytes, hence ">="
+    # in offer().
+
+    def __init__(self, machine, window, probe_s, keep_replies, job_end):
+        self.m = machine
+        self.window = window
+        self.probe_s = probe_s
+        self.next_probe = None if probe_s is None else time.monotonic() + probe_s
+        self.keep_replies = keep_replies
+        self.job = machine._job
+        self.deadlines = machine._ack_deadlines(job_end)
+        # (line, nbytes, mark, est) per line sent and not yet acknowledged
+        self.in_flight = deque()
+        self.buffered = 0
+        self.replies = []
+        self.acked = 0
+
+    def offer(self, item):
+        # Send one (data, line) from the machine's wire encoder if it fits;
+        # False leaves it for after the next ack
+        data, line = item
+        if self.in_flight and self.buffered + len(data) >= self.window:
+            return False
+        m = self.m
+        m.logger.debug(">> %s", line)
+        m._write(data)
+        self.deadlines.sent(not self.in_flight)
+        job = self.job
+        self.in_flight.append((line, len(data), job.current if job is not None else None,
+                               m._line_est, m._line_kind))
+        self.buffered += len(data)
+        m.stats["lines_sent"] += 1
+        m.stats["bytes_sent"] += len(data)
+        m.stats["peak_rx_bytes"] = max(m.stats["peak_rx_bytes"], self.buffered)
+        return True
+
+    def receive(self, r):
+        # Handle what one wait for an ack returned ("" when it timed out)
+        if self.next_probe is not None:
+            self.window = self.m._adapt_window(self.window)
+            if time.monotonic() >= self.next_probe:
+                self.m._write(b"?")
+                self.next_probe = time.monotonic() + self.probe_s
+        if not r:
+            self.deadlines.check(self.in_flight)
+        elif r.startswith("ok"):
+            _, n, mark, est, kind = self.in_flight.popleft()
+            self.deadlines.acked(est, kind)
+            self.buffered -= n
+            self.acked += 1
+            if self.keep_replies:
+                self.replies.append(r)
+            if mark is not None:
+                self.job.acked(mark)
+        elif _failed(r):
+            culprit = self.in_flight[0][0] if self.in_flight else None
+            self.m.logger.error("%s (for: %s)", r, culprit)
+            raise RuntimeError(f"{r} (for: {culprit})")
+
+    def result(self, verb):
+        self.m._log_sent(verb, self.acked)
+        return self.replies if self.keep_replies else self.acked
+
+
+class PositionTracker:
+    """
+    Follow where lines leave the tool, in work coordinates, one line at a
+    time, starting from ``position`` (x, y, z; None per unknown axis) and
+    distance mode ``absolute`` (True for G90, False for G91, None if
+    unknown). Anything not understood makes every axis unknown for good.
+    ``offsets_changed`` becomes True once G10 L20/G92/G92.1 moved the WCO,
+    which ``wco`` then follows (None once it cannot be worked out).
+    """
+
+    def __init__(self, position, absolute, wco=None):
+        self.position = list(position)
+        self.absolute = absolute
+        self.offsets_changed = False
+        self.wco = wco
+        self._lost = False
+
+    def _lose(self):
+        self.position = [None, None, None]
+        self.wco = None
+        self._lost = True
+
+    def update(self, raw):
+        if self._lost:
+            return
+        line = _GCODE_COMMENT.sub("", raw or "").strip().upper()
+        if not line:
+            return
+        pos = self.position
+        if line[0] == "$":
+            if not _INERT_DOLLAR.match(line.replace(" ", "")):
+                self.position = [None, None, None]
+            return
+        axes = [None, None, None]
+        machine = set_here = False
+        for letter, num in _GCODE_WORD.findall(line):
+            if letter in "XYZ":
+                axes["XYZ".index(letter)] = float(num)
+            elif letter == "G":
+                g = float(num)
+                if g in (0.0, 1.0, 2.0, 3.0) or g in _INERT_G:
+                    pass
+                elif g == 90.0:
+                    self.absolute = True
+                elif g == 91.0:
+                    self.absolute = False
+                elif g == 53.0:
+                    machine = True
+                elif g in (10.0, 92.0):
+                    set_here = True
+                elif g in (92.1, 92.2, 92.3):
+                    # The G92 offset is dropped or restored: the WCO moves
+                    # by an amount only the controller knows
+                    self.offsets_changed = True
+                    return self._lose()
+                else:
+                    return self._lose()
+            elif letter == "L":
+                if float(num) != 20.0:
+                    self.offsets_changed = True
+                    return self._lose()
+            elif letter == "P":
+                if set_here and float(num) > 1.0:
+                    # G10 L20 P2..: another coordinate system, this one unchanged
+                    set_here = None
+            elif letter not in "FSTMNIJKR":
+                return self._lose()
+        if set_here is None:
+            return
+        for i, val in enumerate(axes):
+            if val is None:
+                continue
+            wco = self.wco
+            if set_here:
+                # The machine position stays put; the offset takes the change
+                if wco is not None and pos[i] is not None:
+                    self.wco = list(wco)
+                    self.wco[i] += pos[i] - val
+                else:
+                    self.wco = None
+                pos[i] = val
+                self.offsets_changed = True
+            elif machine:
+                pos[i] = val - wco[i] if wco is not None else None
+            elif self.absolute:
+                pos[i] = val
+            elif self.absolute is False and pos[i] is not None:
+                pos[i] += val
+            else:
+                pos[i] = None
+
+
+def _wire_bytes(wire, line):
+    # Comments are stripped by now, so a character that is not ASCII makes
+    # the line itself malformed: it is refused here rather than sent
+    try:
+        return (wire + "\n").encode("ascii")
+    except UnicodeEncodeError:
+        raise ValueError(f"Non-ASCII character in G-code line: {line!r}") from None
+
+
+def _job_end(job_timeout_s):
+    return None if job_timeout_s is None else time.monotonic() + job_timeout_s
+
+
+def _time_left(job_end):
+    # What is left of a job deadline for the final wait (None: no deadline)
+    return None if job_end is None else max(0.0, job_end - time.monotonic())
+
+
+def _program_lines(gcode_blob):
+    # The lines of a G-code string that carry something
+    return [ln for ln in gcode_blob.splitlines() if ln.strip()]
+
+
+def _adaptive_period(period, feed, prev_feed, peak_feed, min_period=0.005):
+    # Shrink the poll period in proportion to the feed while decelerating
+    if feed is None or prev_feed is None or feed >= prev_feed or peak_feed <= 0:
+        return period
+    return max(min_period, period * feed / peak_feed)
+
 
 class CNC_Machine:
     """
@@ -14,7 +616,11 @@ class CNC_Machine:
 
     def __init__(self, com, baud_rate=115200, x_low_bound=0, x_high_bound=270, 
                  y_low_bound=0, y_high_bound=150, z_low_bound=-35, z_high_bound=0,
-                 virtual=False, locations_file=None, log_level=logging.INFO,):
+                 virtual=False, locations_file=None, log_level=logging.INFO,
+                 rx_buffer_size=None, sync_idle=False, adaptive_poll=False,
+                 grbl_settings=None, virtual_time_scale=None, location_cache=None,
+                 watch_locations=False, optimize_gcode=False, compact_wire=False,
+                 ack_margin_s=2.0,):
         self.logger = logging.getLogger(__name__ + ".CNC_Machine")
         if not self.logger.handlers:
             h = logging.StreamHandler()
@@ -34,30 +640,106 @@ class CNC_Machine:
         self.Y_HIGH_BOUND = y_high_bound
         self.Z_LOW_BOUND = z_low_bound
         self.Z_HIGH_BOUND = z_high_bound
+        # None means "ask the controller at connect time" (Bf: status field)
+        self.RX_BUFFER_SIZE = rx_buffer_size or 128
+        self.PLANNER_BLOCKS = 15
+        self._auto_rx = rx_buffer_size is None
+        self.SYNC_IDLE = sync_idle
+        self.ADAPTIVE_POLL = adaptive_poll
+        # Peephole-optimise generated programs before they are sent
+        self.OPTIMIZE_GCODE = optimize_gcode
+        # Send the shortest equivalent of each line (logs keep the original)
+        self.COMPACT_WIRE = compact_wire
+        # Slack on top of the estimated execution time before a missing ack
+        # (or a machine that never goes Idle) counts as a hung controller
+        self.ACK_MARGIN_S = ack_margin_s
+
+        # $11/$100-$122 values used to predict motion time
+        self.GRBL_SETTINGS = dict(DEFAULT_SETTINGS)
+        self.GRBL_SETTINGS.update(grbl_settings or {})
 
         self.VIRTUAL = virtual
+        # Simulated clock for virtual mode: None jumps straight to each target,
+        # 1.0 plays moves in real time, 10.0 ten times faster, math.inf
+        # completes them instantly while still accumulating virtual_time.
+        self.VIRTUAL_TIME_SCALE = virtual_time_scale
         self.SERIAL_PORT = com
         self.ser = None
+        # Compiled location table cache: None keeps it next to the YAML file,
+        # a path puts it there, False always parses the YAML
+        self.LOCATION_CACHE = location_cache
+        self.location_table = compile_locations({})
+        self.LOCATIONS_FILE = locations_file
         self.LOCATIONS = self.load_from_yaml(locations_file)
+        # Tables reloaded by the watcher wait here until the next lookup, so
+        # a batch of visits never mixes old and new offsets
+        self._location_lock = threading.Lock()
+        self._pending_locations = None
+        self._location_watcher = None
+        # Trusted tool position in work coordinates (None per unknown axis)
+        # and G90/G91 state, followed through every line sent and confirmed
+        # by Idle status reports; alarms, resets and G-code that
+        # PositionTracker does not understand make it unknown again
+        self.position = [None, None, None]
+        self._absolute = None
+        # Checkpointer of the job being sent, if it keeps one
+        self._job = None
 
         self._virtual_log = []
         self._virtual_state = "Idle"
         self._virtual_pos = {"X": 0.0, "Y": 0.0, "Z": 0.0}
+        self._virtual_moves = deque()
+        self._virtual_modal = {"motion": "G0", "distance": "G90", "feed": 0.0}
+        self._virtual_target = [0.0, 0.0, 0.0]
+        self._virtual_end = 0.0
+        self._virtual_real0 = time.monotonic()
+
+        self.stats = {"lines_sent": 0, "bytes_sent": 0, "peak_rx_bytes": 0,
+                      "rx_window": self.RX_BUFFER_SIZE, "planner_full_reports": 0}
+
+        # Upper-bound execution time of each line pulled for sending, and of
+        # the lines acknowledged last (those that may still be planned)
+        spans = (x_high_bound - x_low_bound, y_high_bound - y_low_bound,
+                 z_high_bound - z_low_bound)
+        self._line_timer = LineTimer(self.GRBL_SETTINGS, spans, homing_s=self._homing_s(spans))
+        self._line_est = 0.0
+        self._line_kind = None
+        self._planned = deque(maxlen=self.PLANNER_BLOCKS)
+
+        # Feed hold in effect (ours or the controller's) and the override
+        # percentages last set or reported (Ov:), which scale ack deadlines
+        self._held = False
+        self.overrides = {"feed": 100, "rapid": 100, "spindle": 100}
+
+        # Serial reader thread and the channels it sorts responses into
+        self._reader = None
+        self._reader_stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._acks = queue.Queue()
+        self._status_reports = queue.Queue()
+        self._messages = queue.Queue(maxsize=MESSAGE_BACKLOG)
+        self._banners = queue.Queue()
+        self._alarm = None
+        self._wco = None
+        self.status = None
 
         self.logger.info(
             "CNC_Machine initialized (virtual=%s, port=%s, baud=%s)",
             self.VIRTUAL, self.SERIAL_PORT, self.BAUD_RATE
         )
+        if watch_locations:
+            self.start_location_watch()
 
     def load_from_yaml(self, file_in):
         if not file_in:
             self.logger.warning("No locations_file provided; LOCATIONS will be empty.")
             return {}
         try:
-            with open(file_in, "r") as f:
-                data = yaml.safe_load(f) or {}
-            self.logger.info("Loaded locations from %s", file_in)
-            return data
+            table = load_location_table(file_in, self.LOCATION_CACHE)
+            self.location_table = table
+            self.logger.info("Loaded %d locations (%d positions) from %s",
+                             len(table), len(table.positions), file_in)
+            return table.raw
         except FileNotFoundError:
             self.logger.error("locations_file %s not found; LOCATIONS empty.", file_in)
             return {}
@@ -65,6 +747,46 @@ class CNC_Machine:
             self.logger.exception("Failed to load YAML '%s': %s", file_in, e)
             return {}
 
+    def reload_locations(self):
+        # Parse and validate the locations file again; the running table is
+        # only replaced (at the next lookup) when that succeeds
+        if not self.LOCATIONS_FILE:
+            return False
+        try:
+            table = load_location_table(self.LOCATIONS_FILE, self.LOCATION_CACHE)
+        except Exception as e:
+            self.logger.error("Rejected locations_file %s; keeping the current table: %s",
+                              self.LOCATIONS_FILE, e)
+            return False
+        with self._location_lock:
+            self._pending_locations = table
+        self.logger.info("Reloaded %d locations (%d positions) from %s",
+                         len(table), len(table.positions), self.LOCATIONS_FILE)
+        return True
+
+    def start_location_watch(self, poll_s=1.0):
+        if self._location_watcher is not None or not self.LOCATIONS_FILE:
+            return
+        self._location_watcher = LocationWatcher(self.LOCATIONS_FILE, self.reload_locations,
+                                                 poll_s=poll_s).start()
+        self.logger.info("Watching %s for changes (%s).", self.LOCATIONS_FILE,
+                         "inotify" if self._location_watcher.using_inotify else "polling")
+
+    def stop_location_watch(self):
+        if self._location_watcher is not None:
+            self._location_watcher.stop()
+            self._location_watcher = None
+
+    def _locations(self):
+        # The current table, swapping in a reloaded one between moves
+        if self._pending_locations is not None:
+            with self._location_lock:
+                table, self._pending_locations = self._pending_locations, None
+            if table is not None:
+                self.location_table = table
+                self.LOCATIONS = table.raw
+        return self.location_table
+
     def connect(self):
         if self.VIRTUAL:
             self.logger.info("[VIRTUAL] connect() noop.")
@@ -73,13 +795,18 @@ class CNC_Machine:
             self.logger.debug("Serial already open on %s", self.SERIAL_PORT)
             return
         self.logger.info("Opening serial port %s @ %s baud", self.SERIAL_PORT, self.BAUD_RATE)
-        self.ser = serial.Serial(self.SERIAL_PORT, self.BAUD_RATE)
+        self.ser = serial.Serial(self.SERIAL_PORT, self.BAUD_RATE, timeout=0.1)
+        self._start_reader()
         self.wake_up()
+        if self._auto_rx:
+            self.detect_buffers()
 
     def close(self):
+        self.stop_location_watch()
         if self.VIRTUAL:
             self.logger.info("[VIRTUAL] close() noop.")
             return
+        self._stop_reader()
         if self.ser:
             try:
                 self.logger.info("Closing serial port.")
@@ -93,61 +820,348 @@ class CNC_Machine:
         if not self.ser or not self.ser.is_open:
             self.connect()
 
-    def wake_up(self):
+    def wake_up(self, max_s=2.0, probe_after_s=0.5, probe_every_s=0.25):
         if self.VIRTUAL:
             self.logger.debug("[VIRTUAL] wake_up() noop.")
-            return
+            return 0.0
         self._ensure_connected()
-        self.logger.debug("Waking GRBL and clearing greeting.")
-        self.ser.reset_input_buffer()
-        self.ser.write(b"\r\n\r\n")
-        time.sleep(2.0)
-        self.ser.reset_input_buffer()
+        g = _Greeting(self, max_s, probe_after_s, probe_every_s)
+        while g.waiting():
+            try:
+                g.greeting = self._banners.get(timeout=0.02)
+            except queue.Empty:
+                g.greeting = _get_nowait(self._status_reports)
+        return g.result()
+
+    def _start_reader(self):
+        self._reader_stop.clear()
+        self._reader = threading.Thread(
+            target=self._reader_loop, name="cnc-serial-reader", daemon=True
+        )
+        self._reader.start()
 
-    def _readline(self, timeout=2.0):
+    def _stop_reader(self):
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        self._reader.join(timeout=1.0)
+        self._reader = None
+
+    def _reader_loop(self):
+        # Sole owner of the port's input side. The port timeout is set once in
+        # connect(); partial lines are held until their newline arrives.
+        buf = b""
+        while not self._reader_stop.is_set():
+            try:
+                buf += self.ser.readline()
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                if not self._reader_stop.is_set():
+                    self.logger.error("Serial reader stopped: %s", e)
+                return
+            if not buf.endswith(b"\n"):
+                continue
+            s = buf.decode("utf-8", errors="ignore").strip()
+            buf = b""
+            if s:
+                self._dispatch_response(s)
+
+    def _dispatch_response(self, s):
+        self.logger.debug("<< %s", s)
+        channel = classify_response(s)
+        if channel == "ack":
+            self._acks.put_nowait(s)
+        elif channel == "status":
+            self._status_reports.put_nowait(s)
+        elif channel == "banner":
+            self.forget_position()
+            self._banners.put_nowait(s)
+        else:
+            if s.startswith("ALARM:"):
+                self.logger.error("Controller reported %s", s)
+                self._alarm = s
+                self.forget_position()
+            _put_dropping_oldest(self._messages, s)
+
+    def _drain_responses(self, *channels):
+        for q in channels or (self._acks, self._status_reports, self._messages, self._banners):
+            while True:
+                try:
+                    q.get_nowait()
+                except (queue.Empty, asyncio.QueueEmpty):
+                    break
+
+    def _write(self, data):
+        with self._write_lock:
+            self.ser.write(data)
+
+    def _realtime(self, data, what):
+        # Real-time bytes go out ahead of anything queued; reconnecting here
+        # would reset the controller, so a closed port is an error
         if self.VIRTUAL:
+            self.logger.info("[VIRTUAL] %s.", what)
+            return
+        if not self.ser or not self.ser.is_open:
+            raise RuntimeError(f"Cannot send {what}: not connected")
+        self.logger.info("%s.", what)
+        self._write(data)
+
+    def feed_hold(self):
+        self._realtime(CMD_FEED_HOLD, "Feed hold")
+        self._held = True
+
+    def cycle_start(self):
+        self._realtime(CMD_CYCLE_START, "Cycle start")
+        self._held = False
+
+    def jog_cancel(self):
+        self._realtime(CMD_JOG_CANCEL, "Jog cancel")
+
+    def feed_override(self, percent):
+        self._realtime(override_bytes(percent, FEED_OVERRIDE_CMDS), f"Feed override {percent}%")
+        self.overrides["feed"] = int(round(percent))
+
+    def spindle_override(self, percent):
+        self._realtime(override_bytes(percent, SPINDLE_OVERRIDE_CMDS),
+                       f"Spindle override {percent}%")
+        self.overrides["spindle"] = int(round(percent))
+
+    def rapid_override(self, percent):
+        if percent not in RAPID_OVERRIDE_CMDS:
+            raise ValueError(f"Rapid override must be one of {sorted(RAPID_OVERRIDE_CMDS)}%")
+        self._realtime(bytes([RAPID_OVERRIDE_CMDS[percent]]), f"Rapid override {percent}%")
+        self.overrides["rapid"] = percent
+
+    def soft_reset(self):
+        """
+        Send GRBL's soft reset (0x18). Under the lock that serialises writes,
+        so no line can slip in between, the host drops what it held for the
+        old session: queued responses, the trusted position and WCO, planner
+        estimates, hold and override state. A send waiting on acks fails
+        straight away instead of running into its deadline.
+        """
+        self.logger.warning("Soft reset.")
+        if self.VIRTUAL:
+            self._flush_host_state()
+            return
+        if not self.ser or not self.ser.is_open:
+            raise RuntimeError("Cannot soft reset: not connected")
+        with self._write_lock:
+            self.ser.write(CMD_SOFT_RESET)
+            self._flush_host_state()
+
+    def _flush_host_state(self):
+        self._drain_responses()
+        self._acks.put_nowait(_RESET_ACK)
+        self.forget_position()
+        self._wco = None
+        self._planned.clear()
+        self._held = False
+        self.overrides = {"feed": 100, "rapid": 100, "spindle": 100}
+
+    def _next_ack(self, timeout=0.1):
+        try:
+            return self._acks.get(timeout=timeout)
+        except queue.Empty:
+            if self._alarm:
+                return self._alarm
             return ""
-        self._ensure_connected()
-        self.ser.timeout = timeout
-        line = self.ser.readline()
-        s = line.decode("utf-8", errors="ignore").strip()
-        if s:
-            self.logger.debug("<< %s", s)
-        return s
 
     def _query_status(self):
         if self.VIRTUAL:
-            s = f"<{self._virtual_state}|MPos:{self._virtual_pos['X']:.3f},{self._virtual_pos['Y']:.3f},{self._virtual_pos['Z']:.3f}|FS:0,0>"
+            feed = self._virtual_advance() if self.VIRTUAL_TIME_SCALE is not None else 0.0
+            s = f"<{self._virtual_state}|MPos:{self._virtual_pos['X']:.3f},{self._virtual_pos['Y']:.3f},{self._virtual_pos['Z']:.3f}|FS:{feed:.0f},0>"
             self.logger.debug("[VIRTUAL] ? => %s", s)
             return s
         self._ensure_connected()
-        self.ser.write(b"?")
+        self._drain_responses(self._status_reports)
+        self._write(b"?")
         self.logger.debug(">> ?")
-        return self._readline(timeout=0.5)
+        try:
+            return self._status_reports.get(timeout=0.5)
+        except queue.Empty:
+            return ""
 
-    def wait_until_idle(self, poll_hz=10.0, max_s=60.0):
-        if self.VIRTUAL:
-            self.logger.debug("[VIRTUAL] wait_until_idle() immediate Idle.")
-            return
-        period = 1.0 / float(poll_hz)
-        t0 = time.time()
-        last = ""
+    def get_status(self):
+        return self._parse_status(self._query_status())
+
+    def _parse_status(self, report):
+        st = parse_status_report(report, self._wco)
+        if st is not None:
+            self._wco = st.wco
+            self.status = st
+            self._held = st.state in ("Hold", "Door")
+            if st.overrides is not None and len(st.overrides) == 3:
+                # Also catches overrides set from a pendant or another sender
+                self.overrides = dict(zip(("feed", "rapid", "spindle"), st.overrides))
+            if st.state == "Alarm":
+                self.forget_position()
+        return st
+
+    def forget_position(self):
+        self.position = [None, None, None]
+        self._absolute = None
+
+    def known_position(self):
+        # The cached work position as a tuple, or None unless every axis is known
+        if None in self.position:
+            return None
+        return tuple(self.position)
+
+    def _confirm_position(self, st):
+        # An Idle report after waiting is ground truth for the position
+        if st is not None and st.idle and st.wpos is not None:
+            self.position = list(st.wpos)
+
+    def detect_buffers(self):
+        return self._apply_detected_buffers(self.get_status())
+
+    def _apply_detected_buffers(self, st):
+        # A controller at rest (Idle, or locked in Alarm after boot) reports
+        # its whole RX buffer and planner as free
+        if st is None or st.rx_free is None:
+            self.logger.info("No Bf: field in status reports; assuming %d-byte RX buffer.",
+                             self.RX_BUFFER_SIZE)
+        elif st.state in ("Idle", "Alarm"):
+            self.RX_BUFFER_SIZE = st.rx_free
+            self.PLANNER_BLOCKS = st.planner_free
+            self.logger.info("Controller buffers: %d RX bytes, %d planner blocks.",
+                             self.RX_BUFFER_SIZE, self.PLANNER_BLOCKS)
+        self.stats["rx_window"] = self.RX_BUFFER_SIZE
+        self.stats["planner_blocks"] = self.PLANNER_BLOCKS
+        return self.RX_BUFFER_SIZE
+
+    def _adapt_window(self, window):
+        # Consume status replies to the streamer's own '?' probes. Free RX bytes
+        # are a lower bound on the real buffer size, so the window only grows.
         while True:
-            status = self._query_status()
-            last = status or last
-            if status.startswith("<Idle"):
-                return
-            if (time.time() - t0) > max_s:
-                raise TimeoutError(f"Machine did not become Idle in {max_s}s, last status: {last}")
-            time.sleep(period)
+            try:
+                report = self._status_reports.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                return window
+            st = self._parse_status(report)
+            if st is None or st.rx_free is None:
+                continue
+            if st.planner_free == 0:
+                self.stats["planner_full_reports"] += 1
+            if st.rx_free > window:
+                self.logger.info("Controller reports %d free RX bytes; widening window from %d.",
+                                 st.rx_free, window)
+                window = self.RX_BUFFER_SIZE = st.rx_free
+                self.stats["rx_window"] = window
+
+    def wait_until_idle(self, poll_hz=10.0, max_s=None, sync=None, adaptive=None):
+        # max_s defaults to the estimated time of the lines possibly still
+        # in the planner, at the current overrides, plus ACK_MARGIN_S; with
+        # none planned, to ACK_MARGIN_S after the tool last moved
+        sync = self.SYNC_IDLE if sync is None else sync
+        adaptive = self.ADAPTIVE_POLL if adaptive is None else adaptive
+        if self.VIRTUAL:
+            wait_s = self._virtual_wait_s()
+            time.sleep(wait_s)
+            return self._virtual_idle(wait_s, sync, adaptive)
+        t0 = time.monotonic()
+        wait = self._idle_wait(poll_hz, max_s, adaptive)
+        if sync:
+            self._ensure_connected()
+            self._wait_dwell_sync(wait)
+        else:
+            self._wait_status_idle(wait)
+        return self._idle_reached(t0, sync, adaptive)
+
+    def _wait_status_idle(self, wait):
+        delay = wait.status(self.get_status())
+        while delay is not None:
+            time.sleep(delay)
+            delay = wait.status(self.get_status())
+
+    def _wait_dwell_sync(self, wait):
+        wait.start_sync()
+        while not wait.sync_ack(self._next_ack(timeout=wait.ack_timeout)):
+            if wait.poll_due():
+                wait.sync_status(self.get_status())
+
+    def _idle_wait(self, poll_hz, max_s, adaptive):
+        # With nothing planned that the host knows of, the controller may
+        # still be running moves it was sent before (a reconnect, another
+        # sender), so the default wait lasts while status shows motion
+        follow = False
+        if max_s is None:
+            max_s = lambda: _planned_s(self._planned, self.overrides) + self.ACK_MARGIN_S
+            follow = not self._planned
+        return _IdleWait(self, _HoldClock(lambda: self._held), poll_hz, max_s, adaptive, follow)
+
+    def _idle_reached(self, t0, sync, adaptive):
+        # Idle means the planner has drained
+        self._planned.clear()
+        return self._record_sync(time.monotonic() - t0, sync, adaptive)
 
-    def send_lines(self, lines):
+    def _virtual_idle(self, wait_s, sync, adaptive):
+        self.logger.debug("[VIRTUAL] wait_until_idle() Idle in %.3fs.", wait_s)
+        self._virtual_advance()
+        return self._record_sync(wait_s, sync, adaptive)
+
+    def _record_sync(self, elapsed, sync, adaptive):
+        mode = ("dwell" if sync else "poll") + ("+adaptive" if adaptive else "")
+        self.stats["sync_mode"] = mode
+        self.stats["last_sync_s"] = elapsed
+        self.logger.debug("Idle after %.4fs (%s).", elapsed, mode)
+        return elapsed
+
+    def send_lines(self, lines, stream=False, keep_replies=True, checkpoint=None,
+                   job_timeout_s=None):
+        # The position is unknown while lines are in flight; it becomes
+        # where they end once every one of them has been acknowledged.
+        # Without keep_replies only the number of acks is returned; with a
+        # Checkpointer every acknowledged line is recorded in it. Each ack
+        # is due within the line's estimated execution time plus
+        # ACK_MARGIN_S, and all of them within job_timeout_s if given;
+        # AckTimeoutError is raised otherwise.
+        job_end = _job_end(job_timeout_s)
+        tracker = PositionTracker(self.position, self._absolute, self._wco)
+        self.position = [None, None, None]
+        self._job = checkpoint
+        try:
+            replies = self._send_lines(self._tracked(lines, tracker), stream, keep_replies,
+                                       job_end)
+        finally:
+            self._absolute = tracker.absolute
+            self._job = None
+        if not self._alarm:
+            self.position = tracker.position
+        return replies
+
+    def _tracked(self, lines, tracker):
+        # Lines are tracked as they are pulled, so any iterable works
+        for raw in lines:
+            self._track(raw, tracker)
+            yield raw
+
+    def _track(self, raw, tracker):
+        before = list(tracker.position)
+        tracker.update(raw)
+        self._line_est = self._line_timer.estimate(raw, before, tracker.position)
+        self._line_kind = self._line_timer.kind
+        if tracker.offsets_changed:
+            self._wco = None if tracker.wco is None else tuple(tracker.wco)
+        if self._job is not None:
+            self._job.pulled(raw, tracker.position, self._line_est > 0.0)
+
+    def _send_lines(self, lines, stream, keep_replies=True, job_end=None):
         replies = []
+        acked = 0
+        job = self._job
+        if self.VIRTUAL and self.VIRTUAL_TIME_SCALE is not None:
+            return self._virtual_send_timed(lines, keep_replies)
         if self.VIRTUAL:
             for raw in lines:
                 line = (raw or "").strip()
                 if not line:
                     continue
+                acked += 1
+                if job is not None:
+                    job.acked(job.current)
+                if keep_replies:
+                    replies.append("ok")
                 self._virtual_log.append(line)
                 self.logger.debug("[VIRTUAL] >> %s", line)
                 if line.startswith(("G0", "G1", "G2", "G3")):
@@ -161,40 +1175,383 @@ class CNC_Machine:
                                     except Exception:
                                         pass
             self._virtual_state = "Idle"
-            replies = ["ok" for _ in lines if (raw or "").strip()]
-            self.logger.info("[VIRTUAL] Sent %d lines.", len(replies))
-            return replies
+            self.logger.info("[VIRTUAL] Sent %d lines.", acked)
+            return replies if keep_replies else acked
 
         self._ensure_connected()
+        # Acks left over from an aborted job must not be paired with new lines
+        self._drain_responses(self._acks)
+        self._alarm = None
+        ls = self._line_stream(stream, keep_replies, job_end)
+        pending = self._wire_lines(lines)
+        item = next(pending, None)
+        while item is not None or ls.in_flight:
+            while item is not None and ls.offer(item):
+                item = next(pending, None)
+            ls.receive(self._next_ack())
+        return ls.result("Streamed" if stream else "Sent")
+
+    def _line_stream(self, stream, keep_replies, job_end, probe_s=0.25):
+        # Ping-pong is simply streaming with a window of one line
+        window = self.RX_BUFFER_SIZE if stream else 0
+        if stream:
+            self.stats["rx_window"] = window
+        return _LineStream(self, window, probe_s if stream and self._auto_rx else None,
+                           keep_replies, job_end)
+
+    def _wire_encoder(self):
+        # Returns raw line -> (bytes to send, original) or None; the original
+        # is what logs and errors show
+        self.stats["job_wire_bytes_saved"] = 0
+        if not self.COMPACT_WIRE:
+            def plain(raw):
+                # GRBL ignores comments, but would act on a real-time
+                # character such as '!' or '?' inside one
+                line = (raw or "").strip()
+                wire = _GCODE_COMMENT.sub("", line).strip()
+                return (_wire_bytes(wire, line), line) if wire else None
+            return plain
+        enc = WireEncoder(step_decimals(self.GRBL_SETTINGS))
+
+        def compact(raw):
+            item = enc.encode(raw)
+            if item is None:
+                return None
+            wire, line = item
+            saved = len(line) - len(wire)
+            self.stats["job_wire_bytes_saved"] += saved
+            self.stats["wire_bytes_saved"] = self.stats.get("wire_bytes_saved", 0) + saved
+            return _wire_bytes(wire, line), line
+        return compact
+
+    def _wire_lines(self, lines, encode=None):
+        encode = encode or self._wire_encoder()
+        for raw in lines:
+            item = encode(raw)
+            if item is not None:
+                yield item
+
+    def _log_sent(self, verb, acked):
+        saved = self.stats.get("job_wire_bytes_saved", 0)
+        if self.COMPACT_WIRE:
+            self.logger.info("%s %d lines (%d bytes saved on the wire).", verb, acked, saved)
+        else:
+            self.logger.info("%s %d lines.", verb, acked)
+
+    def _ack_deadlines(self, job_end):
+        if self._planned.maxlen != self.PLANNER_BLOCKS:
+            self._planned = deque(self._planned, maxlen=self.PLANNER_BLOCKS)
+        return _AckDeadlines(self._planned, self.ACK_MARGIN_S, job_end, lambda: self._held,
+                             lambda: self.overrides)
+
+    def _homing_s(self, spans):
+        # $H is acknowledged once homing is done: a seek across the longest
+        # travel at $25, the locate pass at $24, plus slack
+        seek = float(self.GRBL_SETTINGS.get(25, 500.0))
+        locate = float(self.GRBL_SETTINGS.get(24, 25.0))
+        travel = max(spans)
+        return 60.0 * (travel / seek + 2.0 * float(self.GRBL_SETTINGS.get(27, 1.0)) / locate) * 2.0 + 10.0
+
+    def read_grbl_settings(self):
+        if self.VIRTUAL:
+            return dict(self.GRBL_SETTINGS)
+        self._ensure_connected()
+        self._drain_responses(self._messages)
+        self.send_lines(["$$"])
+        return self._apply_grbl_settings()
+
+    def _apply_grbl_settings(self):
+        # The reader queues the $N=value lines before their ok
+        lines = []
+        line = _get_nowait(self._messages)
+        while line is not None:
+            lines.append(line)
+            line = _get_nowait(self._messages)
+        self.GRBL_SETTINGS.update(parse_grbl_settings(lines))
+        self.logger.info("Read %d GRBL settings.", len(lines))
+        return dict(self.GRBL_SETTINGS)
+
+    def estimate_duration(self, gcode, start=None):
+        if start is None:
+            start = self.status.wpos if self.status and self.status.wpos else (0.0, 0.0, 0.0)
+        timestamps, total = estimate_gcode_duration(
+            gcode, self.GRBL_SETTINGS, start=start, wco=self._wco or (0.0, 0.0, 0.0))
+        self.logger.debug("Estimated %.3fs for %d lines.", total, len(timestamps))
+        return timestamps, total
+
+    # ---- simulated clock for virtual mode ----
+    @property
+    def virtual_time(self):
+        """Simulated seconds elapsed on the virtual machine's clock."""
+        return self._virtual_clock()
+
+    def _virtual_clock(self):
+        if math.isinf(self.VIRTUAL_TIME_SCALE or 0.0):
+            return self._virtual_end
+        scale = self.VIRTUAL_TIME_SCALE or 1.0
+        return (time.monotonic() - self._virtual_real0) * scale
+
+    def _virtual_wait_s(self):
+        if self.VIRTUAL_TIME_SCALE is None or math.isinf(self.VIRTUAL_TIME_SCALE):
+            return 0.0
+        return max(0.0, self._virtual_end - self._virtual_clock()) / self.VIRTUAL_TIME_SCALE
+
+    def _virtual_advance(self):
+        # Retire finished moves and interpolate the one in progress; returns
+        # the current feed in mm/min
+        now = self._virtual_clock()
+        self.stats["virtual_time_s"] = now
+        while self._virtual_moves:
+            t0, prof, start, end = self._virtual_moves[0]
+            t = now - t0
+            if t < 0.0:
+                break
+            # The end time as _virtual_send_timed summed it: now - t0 can
+            # round to just below the duration when the clock sits there
+            if now >= t0 + profile_duration(prof):
+                self._virtual_pos = dict(zip("XYZ", end))
+                self._virtual_moves.popleft()
+                continue
+            f = profile_distance(prof, t) / prof.length
+            self._virtual_pos = {a: s + (e - s) * f for a, s, e in zip("XYZ", start, end)}
+            self._virtual_state = "Run"
+            return profile_speed(prof, t) * 60.0
+        self._virtual_state = "Idle"
+        return 0.0
+
+    def _virtual_send_timed(self, lines, keep_replies=True):
+        replies = []
+        acked = 0
+        job = self._job
+        t = max(self._virtual_clock(), self._virtual_end)
         for raw in lines:
             line = (raw or "").strip()
             if not line:
                 continue
-            self.logger.debug(">> %s", line)
-            self.ser.write((line + "\n").encode("ascii"))
-            while True:
-                r = self._readline(timeout=2.0)
-                if not r:
-                    continue
-                if r.startswith("ok"):
-                    replies.append(r)
-                    break
-                if r.startswith("error:") or r.startswith("ALARM:"):
-                    self.logger.error("%s (for: %s)", r, line)
-                    raise RuntimeError(f"{r} (for: {line})")
-        self.logger.info("Sent %d lines.", len(replies))
-        return replies
+            self._virtual_log.append(line)
+            self.logger.debug("[VIRTUAL] >> %s", line)
+            move = self._virtual_parse(line.upper())
+            if isinstance(move, float):
+                t += move
+            elif move is not None:
+                target, feed = move
+                start = self._virtual_target
+                length, v_nominal, accel = move_limits(
+                    [e - s for e, s in zip(target, start)], feed, self.GRBL_SETTINGS)
+                if length > 0.0:
+                    prof = trapezoid(length, v_nominal, accel)
+                    self._virtual_moves.append((t, prof, list(start), list(target)))
+                    t += profile_duration(prof)
+                self._virtual_target = target
+            acked += 1
+            if keep_replies:
+                replies.append("ok")
+            if job is not None:
+                job.acked(job.current)
+        self._virtual_end = t
+        self._virtual_advance()
+        self.logger.info("[VIRTUAL] Sent %d lines; motion ends at t=%.3fs.", acked, t)
+        return replies if keep_replies else acked
 
-    def follow_gcode_path(self, gcode_blob, wait=True):
-        lines = [ln for ln in gcode_blob.splitlines() if ln.strip()]
-        if not lines:
-            self.logger.warning("Empty G-code blob received.")
+    def _virtual_parse(self, line):
+        # Returns (target, feed or None for rapids), a dwell in seconds, or None
+        if line == "$H":
+            return [0.0, 0.0, 0.0], None
+        words = re.findall(r"([A-Z])([-+]?[0-9.]+)", line)
+        modal = self._virtual_modal
+        motion = None
+        machine = False
+        values = {}
+        for letter, num in words:
+            val = float(num)
+            if letter == "G":
+                if val in (0, 1, 2, 3):
+                    motion = f"G{val:g}"
+                elif val in (90, 91):
+                    modal["distance"] = f"G{val:g}"
+                elif val == 53:
+                    machine = True
+                elif val == 4:
+                    motion = "G4"
+                elif val == 10:
+                    return None
+            else:
+                values[letter] = val
+        if "F" in values:
+            modal["feed"] = values["F"]
+        if motion == "G4":
+            return values.get("P", 0.0)
+        if motion is not None:
+            modal["motion"] = motion
+        if not any(a in values for a in "XYZ"):
+            return None
+        target = list(self._virtual_target)
+        for i, axis in enumerate("XYZ"):
+            if axis in values:
+                relative = modal["distance"] == "G91" and not machine
+                target[i] = target[i] + values[axis] if relative else values[axis]
+        return target, (None if modal["motion"] == "G0" else modal["feed"] or None)
+
+    def follow_gcode_path(self, gcode_blob, wait=True, stream=False, checkpoint=None,
+                          job_timeout_s=None):
+        # A string is split into lines; any other iterable of lines (a
+        # generator computing the path, say) is pulled lazily as it is sent.
+        # With a checkpoint file every acknowledged line is recorded there
+        # for resume_job(); the peephole pass is skipped so line numbers
+        # stay those of the program as given. The job is only marked done
+        # once the machine went Idle, so with wait=False a resume goes back
+        # over its last planned moves.
+        lines = self._job_lines(gcode_blob, checkpoint)
+        if lines is None:
             return []
-        self.logger.debug("Dispatching %d lines.", len(lines))
-        acks = self.send_lines(lines)
-        if wait:
-            self.wait_until_idle()
-        return acks
+        return self._send_job(lines, stream, True, checkpoint, wait, job_timeout_s=job_timeout_s)
+
+    def _job_lines(self, gcode_blob, checkpoint):
+        # The lines follow_gcode_path() sends, or None for an empty string
+        optimize = checkpoint is None
+        if isinstance(gcode_blob, str):
+            lines = _program_lines(gcode_blob)
+            if not lines:
+                self.logger.warning("Empty G-code blob received.")
+                return None
+            if optimize:
+                lines = self._prepare_program(lines)
+            self.logger.debug("Dispatching %d lines.", len(lines))
+            return lines
+        self.logger.debug("Dispatching lines from %s.", type(gcode_blob).__name__)
+        if not optimize:
+            return gcode_blob
+        if hasattr(gcode_blob, "__aiter__"):
+            if not self.OPTIMIZE_GCODE:
+                return gcode_blob
+            return self._optimize_async(gcode_blob, list(self.position), self._wco)
+        return self._prepare_program(gcode_blob)
+
+    def stream_gcode_file(self, path, wait=True, checkpoint=None, job_timeout_s=None):
+        """
+        Stream a G-code file (plain, .gz, .xz or .bz2) straight from disk.
+        Lines are read as the RX buffer frees up and only acks are counted,
+        so memory stays flat however long the program is. The peephole
+        pass is not applied. With a ``checkpoint`` file the job can be
+        continued by resume_job(checkpoint) after an interruption. Returns
+        the number of lines acknowledged.
+        """
+        self.logger.info("Streaming G-code from %s.", path)
+        with open_gcode(path) as f:
+            return self._send_job(f, True, False, checkpoint, wait, source=path,
+                                  job_timeout_s=job_timeout_s)
+
+    def _send_job(self, lines, stream, keep_replies, checkpoint, wait, source=None, start=0,
+                  modal=None, job_timeout_s=None):
+        # Send a job and, with ``wait``, wait for the machine to run it, all
+        # within job_timeout_s. GRBL acks a line once it is planned, not
+        # once it ran, so a checkpointed job is only marked done after that
+        # wait.
+        job_end = _job_end(job_timeout_s)
+        job = self._checkpointer(checkpoint, source, start, modal)
+        try:
+            replies = self.send_lines(lines, stream=stream, keep_replies=keep_replies, checkpoint=job,
+                                      job_timeout_s=_time_left(job_end))
+            if wait:
+                self.wait_until_idle(max_s=_time_left(job_end))
+                if job is not None and not self._alarm:
+                    job.finish()
+            return replies
+        finally:
+            if job is not None:
+                job.close()
+
+    def _checkpointer(self, checkpoint, source, start, modal):
+        if checkpoint is None:
+            return None
+        return Checkpointer(checkpoint, source=source, start_index=start, modal=modal,
+                            position=self.position, blocks=self.PLANNER_BLOCKS)
+
+    def resume_job(self, checkpoint, lines=None, speed=3000, stream=True, wait=True):
+        """
+        Continue a checkpointed job after the last line that certainly ran:
+        the one before the newest acknowledged moves, which may still have
+        been queued in GRBL (see job_checkpoint). ``lines`` is the program
+        the job was started with (string or iterable); jobs started by
+        stream_gcode_file reopen their file when it is omitted.
+        The machine must be able to move, so unlock or home it first. The
+        modal state is re-established, the tool makes a safe move to where
+        that line left it and streaming continues from the next line, still
+        checkpointed.
+        """
+        cp, before, after = self._resume_plan(checkpoint)
+        if cp is None:
+            return 0
+        remaining, source = self._resume_program(cp, lines)
+        try:
+            if before:
+                self.follow_gcode_path("\n".join(before))
+            self.move_to_point_safe(*cp.position, speed=speed)
+            self.follow_gcode_path("\n".join(after))
+            return self._send_job(remaining, stream, source is None, checkpoint, wait,
+                                  source=cp.source, start=cp.index + 1, modal=cp.modal)
+        finally:
+            if source is not None:
+                source.close()
+
+    def _resume_program(self, cp, lines):
+        # The lines after the resume point, and the file opened for them
+        # when the job streamed from one and ``lines`` is None
+        source = open_gcode(cp.source) if lines is None else None
+        program = source if source is not None else (
+            _program_lines(lines) if isinstance(lines, str) else lines)
+        return islice(program, cp.index + 1, None), source
+
+    def _resume_plan(self, checkpoint):
+        cp = load_checkpoint(checkpoint)
+        if cp.done:
+            self.logger.info("Job in %s already ran to the end; nothing to resume.", checkpoint)
+            return None, None, None
+        if any(v is None for v in cp.position):
+            raise RuntimeError(f"Checkpoint {checkpoint} has no known position to resume from")
+        if not self.coordinates_within_bounds(*cp.position):
+            raise ValueError(f"Recovery position {cp.position} is out of bounds")
+        before, after = ModalState(cp.modal).restore_lines()
+        self.logger.info("Resuming %s after line %d (acknowledged up to %d) from X%.3f Y%.3f Z%.3f.",
+                         cp.source or checkpoint, cp.index, cp.acked, *cp.position)
+        return cp, before, after
+
+    def _prepare_program(self, lines):
+        if not self.OPTIMIZE_GCODE:
+            return lines
+        if not isinstance(lines, list):
+            # Optimised as it is pulled; the totals are logged at the end
+            return self._optimize_lazily(lines, list(self.position), self._wco)
+        st = {}
+        out = optimize_gcode(lines, tolerance=self.GRBL_SETTINGS[12], start=self.position,
+                             wco=self._wco, stats=st)
+        saved = st["bytes_in"] - st["bytes_out"]
+        self.stats["gcode_bytes_saved"] = self.stats.get("gcode_bytes_saved", 0) + saved
+        self.logger.debug("Peephole: %d -> %d lines, %d bytes saved (%d merged, %d collapsed, %d dropped).",
+                          len(lines), len(out), saved, st["merged"], st["collapsed"], st["dropped"])
+        return out
+
+    def _optimize_lazily(self, lines, start, wco):
+        st = {}
+        yield from iter_optimize_gcode(lines, tolerance=self.GRBL_SETTINGS[12], start=start,
+                                       wco=wco, stats=st)
+        self._record_peephole(st)
+
+    async def _optimize_async(self, lines, start, wco):
+        st = {}
+        opt = StreamOptimizer(self.GRBL_SETTINGS[12], start, wco, st)
+        async for raw in lines:
+            for ln in opt.push(raw):
+                yield ln
+        for ln in opt.finish():
+            yield ln
+        self._record_peephole(st)
+
+    def _record_peephole(self, st):
+        saved = st["bytes_in"] - st["bytes_out"]
+        self.stats["gcode_bytes_saved"] = self.stats.get("gcode_bytes_saved", 0) + saved
+        self.logger.debug("Peephole: %d bytes saved (%d merged, %d collapsed, %d dropped).",
+                          saved, st["merged"], st["collapsed"], st["dropped"])
 
     def set_safe_modes(self):
         self.logger.info("Setting safe modes (G21, G90, G94, G54).")
@@ -205,35 +1562,36 @@ class CNC_Machine:
         self.move_to_point_safe(x=0, y=0, z=0, gtype="G0")
 
     def home(self, unlock=True, set_wcs_zero=True, park=(0,0,0), rapid=True):
-        g = []
-        if unlock:
-            g.append("$X")
-        g.append("$H")
-        g += ["G21", "G90", "G94", "G54"]
-        if set_wcs_zero:
-            g.append("G10 L20 P1 X0 Y0 Z0")
-        if park is not None:
-            x, y, z = park
-            move = "G0" if rapid else "G1"
-            g += [
-                f"G53 G0 Z{self.Z_HIGH_BOUND}",
-                f"{move} X{float(x):.3f} Y{float(y):.3f}",
-                f"{move} Z{float(z):.3f}",
-            ]
-        gcode = "\n".join(g) + "\n"
+        gcode = self.get_gcode_home(unlock, set_wcs_zero, park, rapid)
         self.logger.info("Starting homing sequence.")
         self.logger.debug("Homing program:\n%s", gcode)
         self.follow_gcode_path(gcode)
 
-    def move_through_points(self, point_list, speed=3000):
+    def move_through_points(self, point_list, speed=3000, optimize=False, arc_tolerance=None):
         self.logger.info("Moving through %d points at F%d.", len(point_list), speed)
-        lines = ["G90"]
-        for (x, y, z) in point_list:
-            if self.coordinates_within_bounds(x, y, z):
-                lines.append(self.get_gcode_path_to_point(x, y, z, speed, "G1").strip())
-            else:
-                self.logger.warning("Skipped out-of-bounds point: X%s Y%s Z%s", x, y, z)
-        self.follow_gcode_path("\n".join(lines) + "\n")
+        if optimize:
+            point_list = self.order_points(point_list, speed)
+        if arc_tolerance is not None:
+            gcode = self.get_gcode_arcs_through_points(point_list, speed, arc_tolerance)
+        else:
+            gcode = self.get_gcode_through_points(point_list, speed)
+        self.follow_gcode_path(gcode)
+
+    def order_points(self, point_list, speed=None, time_limit=0.5):
+        # Travel-time ordering from where the tool will be once queued moves
+        # finish, else the last reported position (or, if neither is known,
+        # keeping the first point first); speed=None plans for rapids
+        start = self.known_position()
+        if start is None and self.status and self.status.wpos:
+            start = self.status.wpos
+        rates = tuple(float(self.GRBL_SETTINGS[110 + i]) for i in range(3))
+        route = optimize_route(point_list, start=start, rates=rates, feed=speed,
+                               time_limit=time_limit)
+        self.stats["route_original_s"] = route.original_s
+        self.stats["route_optimized_s"] = route.optimized_s
+        self.logger.info("Route of %d points: %.2fs as given, %.2fs optimized.",
+                         len(route.order), route.original_s, route.optimized_s)
+        return [point_list[i] for i in route.order]
 
     def move_to_point(self, x=None, y=None, z=None, speed=3000, gtype="G1"):
         if self.coordinates_within_bounds(x, y, z):
@@ -246,15 +1604,12 @@ class CNC_Machine:
 
     def move_to_point_safe(self, x, y, z, speed=3000, gtype="G1"):
         if self.coordinates_within_bounds(x, y, z):
-            move = "G0" if gtype == "G0" else "G1"
-            g = [
-                f"G53 G0 Z{self.Z_HIGH_BOUND}",
-                "G90",
-                f"{move} X{float(x):.3f} Y{float(y):.3f} F{int(speed)}",
-                f"{move} Z{float(z):.3f}",
-            ]
             self.logger.info("Safe move to: X%s Y%s Z%s @ F%d.", x, y, z, speed)
-            self.follow_gcode_path("\n".join(g) + "\n")
+            gcode = self.get_gcode_safe_move(x, y, z, speed, gtype, start=self.position)
+            if gcode:
+                self.follow_gcode_path(gcode)
+            else:
+                self.logger.debug("Already at X%s Y%s Z%s; nothing to move.", x, y, z)
         else:
             self.logger.warning("Out of bounds (safe move): X%s Y%s Z%s", x, y, z)
 
@@ -266,21 +1621,106 @@ class CNC_Machine:
         else:
             return self.move_to_point(x, y, z, speed=speed)
 
+    def move_to_locations(self, visits, safe=True, speed=3000, optimize=False):
+        """
+        Visit many locations with one streamed program. Each visit is
+        (location_name, location_index[, dwell_s[, callback]]); dwells become
+        G4 P words and callback(location_name, location_index) runs once the
+        machine has arrived, synchronised with G4 P0 only at those visits.
+        """
+        acks = []
+        for lines, stop in self._visit_groups(visits, safe, speed, optimize):
+            acks += self.send_lines(lines, stream=True)
+            if stop is not None:
+                callback, name, index = stop
+                callback(name, index)
+        self.wait_until_idle(sync=True)
+        return acks
+
+    def _visit_groups(self, visits, safe, speed, optimize):
+        # (lines, (callback, name, index) or None) per streamed group; each
+        # program is built once the previous group's callback has run, as
+        # it may itself move the machine. Lifts use the table the visits
+        # were resolved from, even if a reload lands in between.
+        table, groups = self._plan_visits(visits, optimize)
+        self.logger.info("Visiting %d locations in %d streamed chunk(s).", len(visits), len(groups))
+        for group in groups:
+            lines = self._prepare_program(self._visit_program(group, safe, speed, self.position, table))
+            stop = None
+            if group and group[-1][4] is not None:
+                _, name, index, _, callback = group[-1]
+                stop = (callback, name, index)
+            yield lines, stop
+
+    def _plan_visits(self, visits, optimize):
+        # (table, groups): resolve and order the visits, split after every
+        # visit that has a callback: that group's program ends with G4 P0,
+        # whose ok only arrives once motion has stopped.
+        table = self._locations()
+        resolved = []
+        for visit in visits:
+            name, index = visit[0], visit[1]
+            dwell = visit[2] if len(visit) > 2 else 0
+            callback = visit[3] if len(visit) > 3 else None
+            x, y, z = table.position(name, index)
+            if not self.coordinates_within_bounds(x, y, z):
+                self.logger.warning("Skipped out-of-bounds visit %s[%s]: X%s Y%s Z%s", name, index, x, y, z)
+                continue
+            resolved.append(((x, y, z), name, index, dwell, callback))
+        if optimize and len(resolved) > 2:
+            order = self.order_points([r[0] for r in resolved])
+            by_point = {}
+            for r in resolved:
+                by_point.setdefault(r[0], []).append(r)
+            resolved = [by_point[p].pop(0) for p in order]
+        groups = [[]]
+        for visit in resolved:
+            groups[-1].append(visit)
+            if visit[4] is not None:
+                groups.append([])
+        return table, [g for g in groups if g] or [[]]
+
+    def _visit_program(self, group, safe, speed, start, table=None):
+        # G-code for one group of visits travelling on from ``start``
+        lines = []
+        for (x, y, z), name, index, dwell, callback in group:
+            if safe:
+                gcode = self.get_gcode_safe_move(x, y, z, speed, start=start, table=table)
+            else:
+                gcode = self.get_gcode_path_to_point(x, y, z, speed)
+            lines += gcode.splitlines()
+            if dwell:
+                lines.append(f"G4 P{float(dwell):.3f}")
+            if callback is not None:
+                lines.append("G4 P0")
+            start = (x, y, z)
+        return lines
+
     def get_location_position(self, location_name, location_index):
-        loc = self.LOCATIONS.get(location_name)
-        if not loc:
-            raise KeyError(f"Unknown location '{location_name}'")
-        x = loc["x_origin"]; y = loc["y_origin"]; z = loc["z_origin"]
-        if location_index is not None and location_index >= 0:
-            nx = int(loc["num_x"]); dx = float(loc["x_offset"])
-            ny = int(loc["num_y"]); dy = float(loc["y_offset"])
-            col = location_index % nx
-            row = location_index // nx
-            x = x + col * dx
-            y = y + row * dy
+        x, y, z = self._locations().position(location_name, location_index)
         self.logger.debug("Resolved location '%s'[%s] -> X%.3f Y%.3f Z%.3f", location_name, location_index, x, y, z)
         return x, y, z
 
+    def get_location_positions(self, location_name, location_indices=None):
+        """
+        Resolve many indices of one location at once as an (N, 3) array;
+        location_indices=None resolves the whole grid in index order.
+        Raises KeyError naming every out-of-range index.
+        """
+        return self._locations().positions_of(location_name, location_indices)
+
+    def positions_within_bounds(self, positions):
+        # Vectorised coordinates_within_bounds: True per row of an (N, 3)
+        # array; NaN means the axis is not moved, like None
+        pos = np.asarray(positions, dtype=float).reshape(-1, 3)
+        lo = np.array([self.X_LOW_BOUND, self.Y_LOW_BOUND, self.Z_LOW_BOUND], dtype=float)
+        hi = np.array([self.X_HIGH_BOUND, self.Y_HIGH_BOUND, self.Z_HIGH_BOUND], dtype=float)
+        inside = np.isnan(pos) | ((pos >= lo) & (pos <= hi))
+        mask = inside.all(axis=1)
+        if not mask.all():
+            self.logger.debug("Bounds check failed for %d of %d positions.", int((~mask).sum()), len(mask))
+        return mask
+
     def get_gcode_path_to_point(self, x=None, y=None, z=None, speed=3000, gtype="G1"):
         parts = [gtype]
         if x is not None: parts.append(f"X{float(x):.3f}")
@@ -291,6 +1731,91 @@ class CNC_Machine:
         self.logger.debug("Built move: %s", cmd.strip())
         return cmd
 
+    def get_gcode_home(self, unlock=True, set_wcs_zero=True, park=(0,0,0), rapid=True):
+        g = []
+        if unlock:
+            g.append("$X")
+        g.append("$H")
+        g += ["G21", "G90", "G94", "G54"]
+        if set_wcs_zero:
+            g.append("G10 L20 P1 X0 Y0 Z0")
+        if park is not None:
+            x, y, z = park
+            move = "G0" if rapid else "G1"
+            g += [
+                f"G53 G0 Z{self.Z_HIGH_BOUND}",
+                f"{move} X{float(x):.3f} Y{float(y):.3f}",
+                f"{move} Z{float(z):.3f}",
+            ]
+        return "\n".join(g) + "\n"
+
+    def get_gcode_through_points(self, point_list, speed=3000):
+        lines = ["G90"]
+        for (x, y, z) in point_list:
+            if self.coordinates_within_bounds(x, y, z):
+                lines.append(self.get_gcode_path_to_point(x, y, z, speed, "G1").strip())
+            else:
+                self.logger.warning("Skipped out-of-bounds point: X%s Y%s Z%s", x, y, z)
+        return "\n".join(lines) + "\n"
+
+    def get_gcode_arcs_through_points(self, point_list, speed=3000, tolerance=0.01):
+        # As get_gcode_through_points, with runs of points on a circle (within
+        # tolerance mm) sent as single G2/G3 moves
+        pts = np.asarray(point_list, dtype=float).reshape(-1, 3)
+        inside = self.positions_within_bounds(pts)
+        if not inside.all():
+            self.logger.warning("Skipped %d out-of-bounds points.", int((~inside).sum()))
+            pts = pts[inside]
+        fit = fit_arcs(pts, tolerance=tolerance, feed=speed)
+        self.stats["arc_compression"] = fit.compression
+        self.stats["arc_max_deviation"] = fit.max_deviation
+        self.logger.info("Arc fit: %d points -> %d moves (%d arcs, %.1fx), max deviation %.4f mm.",
+                         fit.points_in, fit.lines_out, fit.arcs, fit.compression, fit.max_deviation)
+        return "\n".join(fit.lines) + "\n"
+
+    def get_gcode_safe_move(self, x, y, z, speed=3000, gtype="G1", start=None, table=None):
+        # Lift only as high as the obstacles between start and target need
+        # when both are known; otherwise retract to the top of Z travel.
+        # Segments that would not move the tool from ``start`` (x, y, z,
+        # None per unknown axis) are left out. ``table`` defaults to the
+        # current location table.
+        move = "G0" if gtype == "G0" else "G1"
+        sx, sy, sz = start if start is not None else (None, None, None)
+        def same(a, b):
+            return a is not None and abs(float(a) - float(b)) < 5e-4
+        if same(sx, x) and same(sy, y):
+            if same(sz, z):
+                return ""
+            return f"G90\n{move} Z{float(z):.3f} F{int(speed)}\n"
+        lift = self.travel_height(start, (x, y, z), table)
+        g = []
+        if lift is None:
+            # Full retract, unless the tool is already up there
+            top = self.Z_HIGH_BOUND - self._wco[2] if self._wco is not None else None
+            if top is None or not same(sz, top):
+                g.append(f"G53 G0 Z{self.Z_HIGH_BOUND}")
+            lift = top
+        elif not same(sz, lift):
+            g.append(f"G90 G0 Z{lift:.3f}")
+        g += ["G90", f"{move} X{float(x):.3f} Y{float(y):.3f} F{int(speed)}"]
+        if not same(lift, z):
+            g.append(f"{move} Z{float(z):.3f}")
+        return "\n".join(g) + "\n"
+
+    def travel_height(self, start, end, table=None):
+        # Work Z for an XY hop from start to end, None for a full retract
+        if start is None or None in start:
+            return None
+        if table is None:
+            table = self._locations()
+        need = table.travel_height(start, end)
+        if need is None:
+            return None
+        lift = max(need, float(start[2]), float(end[2]))
+        if lift >= self.Z_HIGH_BOUND:
+            return None
+        return lift
+
     def coordinates_within_bounds(self, x, y, z):
         def ok(val, lo, hi):
             return val is None or (lo <= val <= hi)
@@ -307,3 +1832,322 @@ class CNC_Machine:
                 z, self.Z_LOW_BOUND, self.Z_HIGH_BOUND,
             )
         return inside
+
+
+class AsyncCNCMachine(CNC_Machine):
+    """
+    asyncio flavour of CNC_Machine:
+      - The serial file descriptor is read by the event loop (add_reader)
+      - Motion and I/O methods are coroutines
+      - G-code is built by the same helpers as CNC_Machine
+    """
+
+    async def connect(self):
+        if self.VIRTUAL:
+            self.logger.info("[VIRTUAL] connect() noop.")
+            return
+        if self.ser and self.ser.is_open:
+            self.logger.debug("Serial already open on %s", self.SERIAL_PORT)
+            return
+        self.logger.info("Opening serial port %s @ %s baud", self.SERIAL_PORT, self.BAUD_RATE)
+        self.ser = serial.Serial(self.SERIAL_PORT, self.BAUD_RATE, timeout=0)
+        self._acks = asyncio.Queue()
+        self._status_reports = asyncio.Queue()
+        self._messages = asyncio.Queue(maxsize=MESSAGE_BACKLOG)
+        self._banners = asyncio.Queue()
+        self._rx = b""
+        self._send_lock = asyncio.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.ser.fileno(), self._on_readable)
+        await self.wake_up()
+        if self._auto_rx:
+            await self.detect_buffers()
+
+    async def close(self):
+        self.stop_location_watch()
+        if self.VIRTUAL:
+            self.logger.info("[VIRTUAL] close() noop.")
+            return
+        if self.ser:
+            try:
+                self._loop.remove_reader(self.ser.fileno())
+                self.logger.info("Closing serial port.")
+                self.ser.close()
+            finally:
+                self.ser = None
+
+    async def _ensure_connected(self):
+        if self.VIRTUAL:
+            return
+        if not self.ser or not self.ser.is_open:
+            await self.connect()
+
+    def _on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            self.logger.error("Serial reader stopped: %s", e)
+            self._loop.remove_reader(self.ser.fileno())
+            return
+        self._rx += data
+        while b"\n" in self._rx:
+            raw, self._rx = self._rx.split(b"\n", 1)
+            s = raw.decode("utf-8", errors="ignore").strip()
+            if s:
+                self._dispatch_response(s)
+
+    async def wake_up(self, max_s=2.0, probe_after_s=0.5, probe_every_s=0.25):
+        if self.VIRTUAL:
+            self.logger.debug("[VIRTUAL] wake_up() noop.")
+            return 0.0
+        await self._ensure_connected()
+        g = _Greeting(self, max_s, probe_after_s, probe_every_s)
+        while g.waiting():
+            try:
+                g.greeting = await asyncio.wait_for(self._banners.get(), 0.02)
+            except asyncio.TimeoutError:
+                g.greeting = _get_nowait(self._status_reports)
+        return g.result()
+
+    async def _next_ack(self, timeout=0.1):
+        try:
+            return await asyncio.wait_for(self._acks.get(), timeout)
+        except asyncio.TimeoutError:
+            if self._alarm:
+                return self._alarm
+            return ""
+
+    async def _query_status(self):
+        if self.VIRTUAL:
+            return CNC_Machine._query_status(self)
+        await self._ensure_connected()
+        self._drain_responses(self._status_reports)
+        self._write(b"?")
+        self.logger.debug(">> ?")
+        try:
+            return await asyncio.wait_for(self._status_reports.get(), 0.5)
+        except asyncio.TimeoutError:
+            return ""
+
+    async def get_status(self):
+        return self._parse_status(await self._query_status())
+
+    async def read_grbl_settings(self):
+        if self.VIRTUAL:
+            return dict(self.GRBL_SETTINGS)
+        await self._ensure_connected()
+        self._drain_responses(self._messages)
+        await self.send_lines(["$$"])
+        return self._apply_grbl_settings()
+
+    async def detect_buffers(self):
+        return self._apply_detected_buffers(await self.get_status())
+
+    async def wait_until_idle(self, poll_hz=10.0, max_s=None, sync=None, adaptive=None):
+        sync = self.SYNC_IDLE if sync is None else sync
+        adaptive = self.ADAPTIVE_POLL if adaptive is None else adaptive
+        if self.VIRTUAL:
+            wait_s = self._virtual_wait_s()
+            await asyncio.sleep(wait_s)
+            return self._virtual_idle(wait_s, sync, adaptive)
+        t0 = time.monotonic()
+        wait = self._idle_wait(poll_hz, max_s, adaptive)
+        if sync:
+            await self._ensure_connected()
+            async with self._send_lock:
+                await self._wait_dwell_sync(wait)
+        else:
+            await self._wait_status_idle(wait)
+        return self._idle_reached(t0, sync, adaptive)
+
+    async def _wait_status_idle(self, wait):
+        delay = wait.status(await self.get_status())
+        while delay is not None:
+            await asyncio.sleep(delay)
+            delay = wait.status(await self.get_status())
+
+    async def _wait_dwell_sync(self, wait):
+        wait.start_sync()
+        while not wait.sync_ack(await self._next_ack(timeout=wait.ack_timeout)):
+            if wait.poll_due():
+                wait.sync_status(await self.get_status())
+
+    async def send_lines(self, lines, stream=False, keep_replies=True, checkpoint=None,
+                         job_timeout_s=None):
+        # ``lines`` may be an iterable or an async iterable; either is
+        # pulled only as the RX buffer frees up
+        is_async = hasattr(lines, "__aiter__")
+        if self.VIRTUAL:
+            if is_async:
+                lines = [ln async for ln in lines]
+            return CNC_Machine.send_lines(self, lines, keep_replies=keep_replies,
+                                          checkpoint=checkpoint)
+        job_end = _job_end(job_timeout_s)
+        await self._ensure_connected()
+        # Concurrent callers take turns so acks are never paired across jobs
+        async with self._send_lock:
+            tracker = PositionTracker(self.position, self._absolute, self._wco)
+            self.position = [None, None, None]
+            self._job = checkpoint
+            tracked = self._tracked_async(lines, tracker) if is_async else self._tracked(lines, tracker)
+            try:
+                replies = await self._send_locked(tracked, stream, keep_replies=keep_replies,
+                                                  job_end=job_end)
+            finally:
+                self._absolute = tracker.absolute
+                self._job = None
+            if not self._alarm:
+                self.position = tracker.position
+            return replies
+
+    async def _tracked_async(self, lines, tracker):
+        async for raw in lines:
+            self._track(raw, tracker)
+            yield raw
+
+    def _puller(self, lines):
+        # Awaitable returning the next (data, original), or None at the end,
+        # for plain and async iterables alike
+        encode = self._wire_encoder()
+        if not hasattr(lines, "__aiter__"):
+            pending = self._wire_lines(lines, encode)
+
+            async def pull():
+                return next(pending, None)
+            return pull
+        source = lines.__aiter__()
+
+        async def pull():
+            while True:
+                try:
+                    raw = await source.__anext__()
+                except StopAsyncIteration:
+                    return None
+                item = encode(raw)
+                if item is not None:
+                    return item
+        return pull
+
+    async def _send_locked(self, lines, stream, keep_replies=True, job_end=None):
+        self._drain_responses(self._acks)
+        self._alarm = None
+        ls = self._line_stream(stream, keep_replies, job_end)
+        pull = self._puller(lines)
+        item = await pull()
+        while item is not None or ls.in_flight:
+            while item is not None and ls.offer(item):
+                item = await pull()
+            ls.receive(await self._next_ack())
+        return ls.result("Streamed" if stream else "Sent")
+
+    async def follow_gcode_path(self, gcode_blob, wait=True, stream=False, checkpoint=None,
+                                job_timeout_s=None):
+        # Also takes an async iterable, so the next segments can be computed
+        # while the controller is busy with the ones already sent
+        lines = self._job_lines(gcode_blob, checkpoint)
+        if lines is None:
+            return []
+        return await self._send_job(lines, stream, True, checkpoint, wait,
+                                    job_timeout_s=job_timeout_s)
+
+    async def stream_gcode_file(self, path, wait=True, checkpoint=None, job_timeout_s=None):
+        self.logger.info("Streaming G-code from %s.", path)
+        with open_gcode(path) as f:
+            return await self._send_job(f, True, False, checkpoint, wait, source=path,
+                                        job_timeout_s=job_timeout_s)
+
+    async def _send_job(self, lines, stream, keep_replies, checkpoint, wait, source=None, start=0,
+                        modal=None, job_timeout_s=None):
+        job_end = _job_end(job_timeout_s)
+        job = self._checkpointer(checkpoint, source, start, modal)
+        try:
+            replies = await self.send_lines(lines, stream=stream, keep_replies=keep_replies,
+                                            checkpoint=job, job_timeout_s=_time_left(job_end))
+            if wait:
+                await self.wait_until_idle(max_s=_time_left(job_end))
+                if job is not None and not self._alarm:
+                    job.finish()
+            return replies
+        finally:
+            if job is not None:
+                job.close()
+
+    async def resume_job(self, checkpoint, lines=None, speed=3000, stream=True, wait=True):
+        cp, before, after = self._resume_plan(checkpoint)
+        if cp is None:
+            return 0
+        remaining, source = self._resume_program(cp, lines)
+        try:
+            if before:
+                await self.follow_gcode_path("\n".join(before))
+            await self.move_to_point_safe(*cp.position, speed=speed)
+            await self.follow_gcode_path("\n".join(after))
+            return await self._send_job(remaining, stream, source is None, checkpoint, wait,
+                                        source=cp.source, start=cp.index + 1, modal=cp.modal)
+        finally:
+            if source is not None:
+                source.close()
+
+    async def set_safe_modes(self):
+        self.logger.info("Setting safe modes (G21, G90, G94, G54).")
+        await self.follow_gcode_path("G21\nG90\nG94\nG54\n")
+
+    async def origin(self):
+        self.logger.info("Returning to work origin (0,0,0).")
+        await self.move_to_point_safe(x=0, y=0, z=0, gtype="G0")
+
+    async def home(self, unlock=True, set_wcs_zero=True, park=(0,0,0), rapid=True):
+        gcode = self.get_gcode_home(unlock, set_wcs_zero, park, rapid)
+        self.logger.info("Starting homing sequence.")
+        self.logger.debug("Homing program:\n%s", gcode)
+        await self.follow_gcode_path(gcode)
+
+    async def move_through_points(self, point_list, speed=3000, optimize=False, arc_tolerance=None):
+        self.logger.info("Moving through %d points at F%d.", len(point_list), speed)
+        if optimize:
+            point_list = self.order_points(point_list, speed)
+        if arc_tolerance is not None:
+            gcode = self.get_gcode_arcs_through_points(point_list, speed, arc_tolerance)
+        else:
+            gcode = self.get_gcode_through_points(point_list, speed)
+        await self.follow_gcode_path(gcode)
+
+    async def move_to_point(self, x=None, y=None, z=None, speed=3000, gtype="G1"):
+        if self.coordinates_within_bounds(x, y, z):
+            gcode = self.get_gcode_path_to_point(x, y, z, speed, gtype)
+            self.logger.info("Move to point: X%s Y%s Z%s @ F%d (%s).", x, y, z, speed, gtype)
+            return await self.follow_gcode_path(gcode)
+        else:
+            self.logger.warning("Out of bounds: X%s Y%s Z%s", x, y, z)
+            return None
+
+    async def move_to_point_safe(self, x, y, z, speed=3000, gtype="G1"):
+        if self.coordinates_within_bounds(x, y, z):
+            self.logger.info("Safe move to: X%s Y%s Z%s @ F%d.", x, y, z, speed)
+            gcode = self.get_gcode_safe_move(x, y, z, speed, gtype, start=self.position)
+            if gcode:
+                await self.follow_gcode_path(gcode)
+            else:
+                self.logger.debug("Already at X%s Y%s Z%s; nothing to move.", x, y, z)
+        else:
+            self.logger.warning("Out of bounds (safe move): X%s Y%s Z%s", x, y, z)
+
+    async def move_to_locations(self, visits, safe=True, speed=3000, optimize=False):
+        acks = []
+        for lines, stop in self._visit_groups(visits, safe, speed, optimize):
+            acks += await self.send_lines(lines, stream=True)
+            if stop is not None:
+                callback, name, index = stop
+                result = callback(name, index)
+                if asyncio.iscoroutine(result):
+                    await result
+        await self.wait_until_idle(sync=True)
+        return acks
+
+    async def move_to_location(self, location_name, location_index, safe=True, speed=3000):
+        self.logger.info("Moving to location '%s' index %s (safe=%s).", location_name, location_index, safe)
+        x, y, z = self.get_location_position(location_name, location_index)
+        if safe:
+            return await self.move_to_point_safe(x, y, z, speed=speed)
+        else:
+            return await self.move_to_point(x, y, z, speed=speed)
@@ -0,0 +1,358 @@
+"""
+Drive CNC_Machine against the GRBL emulator: streaming, ack deadlines,
+alarms, resets and checkpoint resume. Run with ``python -m pytest -q``.
+"""
+import asyncio
+import gzip
+import logging
+import math
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pty")
+
+from cnc_machine import (FEED_OVERRIDE_CMDS, MESSAGE_BACKLOG, AckTimeoutError, AsyncCNCMachine,
+                         CNC_Machine, override_bytes)
+from grbl_emulator import GrblEmulator
+from job_checkpoint import load_checkpoint
+
+LOG_LEVEL = logging.CRITICAL
+
+
+@pytest.fixture
+def emulators():
+    started = []
+
+    def start(time_scale=None, start_locked=False):
+        emu = GrblEmulator(time_scale=time_scale, start_locked=start_locked)
+        emu.start()
+        started.append(emu)
+        return emu
+    yield start
+    for emu in started:
+        emu.stop()
+
+
+@pytest.fixture
+def connect():
+    machines = []
+
+    def make(emu, **kwargs):
+        kwargs.setdefault("log_level", LOG_LEVEL)
+        m = CNC_Machine(com=emu.port, **kwargs)
+        m.connect()
+        machines.append(m)
+        return m
+    yield make
+    for m in machines:
+        m.close()
+
+
+def spiral(n, cx=100.0, cy=75.0):
+    return [(cx + (5 + a / 50) * math.cos(a / 20), cy + (5 + a / 50) * math.sin(a / 20))
+            for a in range(n)]
+
+
+def shuttle(moves, distance=5.0, feed=1200):
+    # Moves back and forth along X, about distance / feed * 60 s each
+    return [f"G1 X{distance * ((i + 1) % 2):.3f} F{feed}" for i in range(moves)]
+
+
+def status_until(m, state, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    st = m.get_status()
+    while (st is None or st.state != state) and time.monotonic() < deadline:
+        time.sleep(0.02)
+        st = m.get_status()
+    return st
+
+
+def test_gcode_is_locked_until_unlocked(emulators, connect):
+    m = connect(emulators(start_locked=True))
+    with pytest.raises(RuntimeError, match="error:9"):
+        m.send_lines(["G1 X1 F100"])
+    m.send_lines(["$X", "G1 X1 F100"])
+    assert status_until(m, "Idle").state == "Idle"
+
+
+def test_soft_reset_keeps_idle_and_aborts_motion_with_alarm(emulators, connect):
+    m = connect(emulators(time_scale=1.0, start_locked=True))
+    m.home()
+    m.soft_reset()
+    # $22=1 only locks the controller at power-up
+    assert status_until(m, "Idle").state == "Idle"
+    threading.Timer(0.3, m.soft_reset).start()
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match="soft reset"):
+        m.send_lines(shuttle(40), stream=True)
+    assert time.monotonic() - started < 2.0
+    assert status_until(m, "Alarm").state == "Alarm"
+    assert m.known_position() is None
+
+
+def test_stream_and_ping_pong_reach_the_same_point(emulators, connect):
+    emu = emulators()
+    m = connect(emu)
+    pts = spiral(200)
+    gcode = "G90\n" + "\n".join(f"G1 X{x:.3f} Y{y:.3f} F3000" for x, y in pts)
+    for stream in (False, True):
+        acks = m.follow_gcode_path("G0 X0 Y0\n")
+        acks = m.follow_gcode_path(gcode, stream=stream)
+        assert len(acks) == len(pts) + 1
+        assert m.position == pytest.approx([pts[-1][0], pts[-1][1], 0.0], abs=1e-3)
+    assert emu.overflows == 0
+    assert 0 < m.stats["peak_rx_bytes"] < m.RX_BUFFER_SIZE
+
+
+def test_error_reply_names_the_line(emulators, connect):
+    m = connect(emulators())
+    for stream in (False, True):
+        with pytest.raises(RuntimeError, match=r"error:20 \(for: G1 X1 Q5\)"):
+            m.send_lines(["G90", "G1 X1 Q5"], stream=stream)
+
+
+def test_unread_messages_are_bounded(emulators, connect):
+    m = connect(emulators(start_locked=False))
+    m.send_lines(["$G"] * (MESSAGE_BACKLOG + 50), stream=True)
+    assert m._messages.qsize() == MESSAGE_BACKLOG
+    # The newest replies are the ones kept, so $$ still reads back in full
+    assert m.read_grbl_settings()[110] == pytest.approx(3000.0)
+
+
+def test_async_stream(emulators):
+    emu = emulators()
+    gcode = "\n".join(f"G1 X{x:.3f} Y{y:.3f} F3000" for x, y in spiral(100))
+
+    async def run():
+        a = AsyncCNCMachine(com=emu.port, log_level=LOG_LEVEL)
+        await a.connect()
+        try:
+            for stream in (False, True):
+                await a.follow_gcode_path("G0 X0 Y0\n")
+                assert len(await a.follow_gcode_path(gcode, stream=stream)) == 100
+        finally:
+            await a.close()
+        return a.position
+    x, y = spiral(100)[-1]
+    assert asyncio.run(run()) == pytest.approx([x, y, 0.0], abs=1e-3)
+
+
+def test_async_waits_visits_and_settings(emulators):
+    emu = emulators(time_scale=10.0, start_locked=True)
+    arrived = []
+
+    async def note(name, index):
+        arrived.append((name, index, emu.state))
+
+    async def run():
+        a = AsyncCNCMachine(com=emu.port, locations_file="location_status.yaml",
+                            log_level=LOG_LEVEL)
+        await a.connect()
+        try:
+            assert (await a.read_grbl_settings())[22] == 1
+            await a.home()
+            await a.move_to_locations([("vial_rack", 0, 0, note), ("vial_rack", 3, 0, note)])
+            for sync, adaptive in ((False, False), (True, True)):
+                await a.send_lines(["G1 X20 Y10 F3000", "G1 X0 Y0"])
+                await a.wait_until_idle(sync=sync, adaptive=adaptive)
+                assert emu.state == "Idle"
+            return a.position
+        finally:
+            await a.close()
+    assert asyncio.run(run()) == pytest.approx([0.0, 0.0, 0.0])
+    assert [(n, i) for n, i, _ in arrived] == [("vial_rack", 0), ("vial_rack", 3)]
+    # Callbacks run once the machine has stopped at the visit
+    assert all(state == "Idle" for _, _, state in arrived)
+
+
+def test_g92_and_inverse_time_feed(emulators, connect):
+    emu = emulators(time_scale=1.0)
+    m = connect(emu)
+    m.send_lines(["G90 G0 X10 Y5", "G92 X0 Y0", "G1 X5 F600"])
+    m.wait_until_idle()
+    assert m.status.mpos == pytest.approx((15.0, 5.0, 0.0))
+    assert m.status.wpos == pytest.approx((5.0, 0.0, 0.0))
+    assert m.position == pytest.approx([5.0, 0.0, 0.0])
+    # In G93 every feed move needs its own F, in 1/min
+    with pytest.raises(RuntimeError, match="error:22"):
+        m.send_lines(["G93 G1 X10"])
+    started = time.monotonic()
+    m.send_lines(["G93 G1 X10 F60"])
+    m.wait_until_idle()
+    assert 0.9 < time.monotonic() - started < 1.5
+    # Back in G94 the feed is undefined until the next F word
+    with pytest.raises(RuntimeError, match="error:22"):
+        m.send_lines(["G94 G1 X0"])
+    m.send_lines(["G92.1", "G1 X0 F3000"])
+    m.wait_until_idle()
+    assert m.status.mpos == pytest.approx((0.0, 5.0, 0.0))
+
+
+def test_tracker_follows_work_offset_changes(emulators, connect):
+    emu = emulators(start_locked=True)
+    m = connect(emu)
+    m.home()
+    while m._wco is None:
+        m.get_status()
+    m.send_lines(["G10 L20 P1 Z5", "G53 G0 Z-10"])
+    assert m.position == pytest.approx([0.0, 0.0, -5.0])
+    m.wait_until_idle()
+    assert m.status.wpos == pytest.approx((0.0, 0.0, -5.0))
+    assert m.position == pytest.approx([0.0, 0.0, -5.0])
+    m.send_lines(["G92 Z0", "G53 G0 Z-12"])
+    assert m.position == pytest.approx([0.0, 0.0, -2.0])
+    m.wait_until_idle()
+    assert m.status.wpos == pytest.approx((0.0, 0.0, -2.0))
+    # Dropping the G92 offset moves the WCO by an amount the host cannot
+    # know: the position and WCO are unknown until the next reports
+    m.send_lines(["G92.1"])
+    assert m._wco is None
+    assert m.known_position() is None
+    m.wait_until_idle()
+    while m._wco is None:
+        m.get_status()
+    assert m.status.wpos == pytest.approx((0.0, 0.0, -7.0))
+    assert m.known_position() == pytest.approx((0.0, 0.0, -7.0))
+
+
+def test_comments_never_reach_the_controller(emulators, connect, tmp_path):
+    emu = emulators()
+    m = connect(emu)
+    path = tmp_path / "job.nc"
+    path.write_bytes(b"G90\n(probe \xb5m)\nG1 X5 F600 (stop! now?)\nG1 X6\n")
+    received = emu.lines_received
+    assert m.stream_gcode_file(path) == 3
+    assert m.position == pytest.approx([6.0, 0.0, 0.0])
+    # The '!' in the comment would have held the machine
+    assert emu.lines_received - received == 3
+    assert m.get_status().idle
+    path.write_bytes(b"G90\nG1 X5\xb5 F600\n")
+    with pytest.raises(ValueError, match="Non-ASCII"):
+        m.stream_gcode_file(path)
+
+
+@pytest.mark.parametrize("feed_mode", ["G94", "G93"])
+def test_resume_after_reset_picks_up_behind_the_tool(emulators, connect, tmp_path, feed_mode):
+    emu = emulators(time_scale=4.0, start_locked=True)
+    m = connect(emu, locations_file="location_status.yaml")
+    m.home()
+    pts = spiral(600)
+    program = tmp_path / "job.gcode.gz"
+    with gzip.open(program, "wt") as f:
+        f.write("G21 G90 G17\nG1 Z-3 F1500\nF3000\n")
+        if feed_mode == "G93":
+            # Inverse time: every move carries its own F, 3000 mm/min here.
+            # The recovery move must still run in G94.
+            f.write("G93\n")
+        prev = pts[0]
+        for x, y in pts:
+            f.write(f"G1 X{x:.3f} Y{y:.3f}")
+            if feed_mode == "G93":
+                f.write(f" F{3000 / max(math.dist(prev, (x, y)), 1e-3):.1f}")
+            f.write("\n")
+            prev = (x, y)
+    ckpt = tmp_path / "job.ckpt"
+    tool = {}
+
+    def reset():
+        tool["pos"] = emu.position()
+        m.soft_reset()
+    threading.Timer(0.5, reset).start()
+    with pytest.raises(RuntimeError):
+        m.stream_gcode_file(program, checkpoint=ckpt)
+    cp = load_checkpoint(ckpt)
+    assert not cp.done and cp.index < cp.acked
+    # The resume point must not be ahead of the move that was running
+    running = min(range(len(pts)), key=lambda i: math.dist(pts[i], tool["pos"][:2]))
+    assert cp.index - 3 <= running
+    m.home()
+    m.resume_job(ckpt)
+    assert m.get_status().mpos == pytest.approx((pts[-1][0], pts[-1][1], -3.0), abs=1e-3)
+    assert load_checkpoint(ckpt).done
+    assert m.resume_job(ckpt) == 0
+
+
+def test_hung_controller_raises_ack_timeout(emulators, connect):
+    # A fixed RX size means no '?' probes while streaming, so the host never
+    # learns of the hold and the stalled G4 P0 has to run into its deadline
+    m = connect(emulators(time_scale=1.0, start_locked=True), rx_buffer_size=128,
+                ack_margin_s=0.3)
+    # Homed, so the budget is not that of moves from an unknown position
+    m.home()
+    threading.Timer(0.2, m._write, (b"!",)).start()
+    with pytest.raises(AckTimeoutError) as exc:
+        m.send_lines(shuttle(4) + ["G4 P0"], stream=True)
+    assert exc.value.outstanding == ["G4 P0"]
+
+
+def test_job_timeout(emulators, connect):
+    m = connect(emulators(time_scale=1.0))
+    started = time.monotonic()
+    with pytest.raises(AckTimeoutError, match="Job deadline"):
+        m.send_lines(shuttle(10) + ["G4 P0"], stream=True, job_timeout_s=0.5)
+    assert time.monotonic() - started < 1.5
+
+
+def test_ack_budget_only_counts_planned_lines(emulators, connect):
+    m = connect(emulators())
+    m.send_lines(["G90", "G1 X1 F600", "G90", "G1 X2"] * 10, stream=True)
+    assert len(m._planned) == m.PLANNER_BLOCKS
+    assert all(est > 0.0 and kind == "feed" for est, kind in m._planned)
+
+
+def test_wait_follows_moves_the_host_did_not_plan(emulators, connect):
+    # The host knows of nothing queued (as after a reconnect to a controller
+    # that does not reset on open), yet the wait lasts as long as the
+    # status shows the tool moving. The emulator resets on open like an
+    # Arduino, so the lost bookkeeping is simulated.
+    m = connect(emulators(time_scale=1.0), ack_margin_s=0.3)
+    for sync in (False, True):
+        m.send_lines(shuttle(6, distance=10.0, feed=1200), stream=True)
+        m._planned.clear()
+        started = time.monotonic()
+        m.wait_until_idle(sync=sync)
+        assert m.get_status().idle
+        assert time.monotonic() - started > 2.0
+
+
+def test_feed_hold_pauses_deadlines(emulators, connect):
+    m = connect(emulators(time_scale=1.0, start_locked=True), ack_margin_s=0.3)
+    m.home()
+    threading.Timer(0.2, m.feed_hold).start()
+    threading.Timer(2.5, m.cycle_start).start()
+    started = time.monotonic()
+    m.follow_gcode_path("\n".join(shuttle(4)), stream=True)
+    assert time.monotonic() - started > 2.5
+    assert m.position == pytest.approx([0.0, 0.0, 0.0])
+
+
+def test_lowered_feed_override_stretches_deadlines(emulators, connect):
+    # At 10 % the moves take up to ten times their estimate, far past
+    # ack_margin_s; there are more of them than the planner holds
+    m = connect(emulators(time_scale=1.0), ack_margin_s=0.3)
+    # From a known position, so the estimates are not those of moves from
+    # anywhere
+    m.send_lines(["G90 G0 X0 Y0 Z0"])
+    m.wait_until_idle()
+    threading.Timer(0.1, m.feed_override, (10,)).start()
+    started = time.monotonic()
+    m.follow_gcode_path("\n".join(shuttle(17, distance=0.02)), stream=True)
+    assert time.monotonic() - started > 1.5
+    assert m.position == pytest.approx([0.02, 0.0, 0.0])
+    assert m.overrides["feed"] == 10
+
+
+def test_overrides_set_elsewhere_are_read_from_status(emulators, connect):
+    # An override from a pendant or another sender only shows in Ov:
+    m = connect(emulators(time_scale=1.0), ack_margin_s=0.5)
+    m.send_lines(["G90 G0 X0 Y0 Z0"])
+    m.wait_until_idle()
+    threading.Timer(0.1, m._write, (override_bytes(10, FEED_OVERRIDE_CMDS),)).start()
+    started = time.monotonic()
+    m.follow_gcode_path("\n".join(shuttle(17, distance=0.02)), stream=True)
+    assert time.monotonic() - started > 1.5
+    assert m.overrides["feed"] == 10
+    m.soft_reset()
+    assert m.overrides["feed"] == 100
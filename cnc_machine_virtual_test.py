@@ -0,0 +1,129 @@
+"""
+CNC_Machine in virtual mode: the simulated clock, generated G-code and
+location handling, without a serial port. Run with ``python -m pytest -q``.
+"""
+import logging
+import math
+import time
+
+from cnc_machine import CNC_Machine
+
+LOG_LEVEL = logging.CRITICAL
+
+
+def test_instant_virtual_moves_end_idle():
+    m = CNC_Machine("virtual", virtual=True, virtual_time_scale=math.inf, log_level=LOG_LEVEL)
+    for i in range(200):
+        m.send_lines([f"G1 X{(i * 37) % 200:.3f} Y{(i * 53) % 100:.3f} F{300 + 97 * i}"])
+        assert m.get_status().idle
+
+
+def test_scaled_virtual_clock_matches_the_estimate():
+    m = CNC_Machine("virtual", virtual=True, virtual_time_scale=50.0, log_level=LOG_LEVEL)
+    gcode = "G90\nG1 X100 Y50 F3000\nG4 P1\nG0 X0 Y0\n"
+    _, total = m.estimate_duration(gcode, start=(0.0, 0.0, 0.0))
+    m.send_lines(gcode.splitlines())
+    assert m.get_status().state == "Run"
+    m.wait_until_idle()
+    assert m.get_status().idle
+    assert m.virtual_time >= total
+    assert m.virtual_time < total + 50.0 * 0.25
+
+
+def test_points_are_ordered_from_the_queued_position():
+    # The last status still has the tool near the origin; the route starts
+    # where the queued move ends
+    m = CNC_Machine("virtual", virtual=True, virtual_time_scale=1.0, log_level=LOG_LEVEL)
+    m.send_lines(["G90", "G0 X200 Y150 Z0"])
+    assert m.get_status().state == "Run"
+    points = [(0.0, 0.0, 0.0), (100.0, 75.0, 0.0), (200.0, 150.0, 0.0)]
+    assert m.order_points(points) == points[::-1]
+
+
+RACK = """rack:
+  x_origin: 10
+  y_origin: 10
+  z_origin: -10
+  num_x: 3
+  x_offset: 10
+  y_offset: 10
+  clearance_z: {clearance}
+"""
+
+
+def test_a_batch_of_visits_lifts_from_one_table(tmp_path):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK.format(clearance=-5))
+    m = CNC_Machine("virtual", virtual=True, virtual_time_scale=math.inf,
+                    locations_file=str(path), location_cache=False, log_level=LOG_LEVEL)
+    sent = []
+    send_lines = m.send_lines
+    m.send_lines = lambda lines, **kw: sent.append(list(lines)) or send_lines(lines, **kw)
+
+    def edit(name, index):
+        # Reloaded mid-batch: only the next batch may use it
+        path.write_text(RACK.format(clearance=-2))
+        assert m.reload_locations()
+
+    m.move_to_locations([("rack", 0, 0, edit), ("rack", 2)])
+    assert "G90 G0 Z-5.000" in sent[-1]
+    m.move_to_locations([("rack", 0)])
+    assert "G90 G0 Z-2.000" in sent[-1]
+
+
+def test_watcher_rejects_malformed_yaml_and_stops_on_close(tmp_path):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK.format(clearance=-5))
+    m = CNC_Machine("virtual", virtual=True, locations_file=str(path),
+                    location_cache=False, log_level=LOG_LEVEL)
+    reloads = []
+    reload_locations = m.reload_locations
+    m.reload_locations = lambda: reloads.append(reload_locations()) or reloads[-1]
+    m.start_location_watch(poll_s=0.05)
+
+    def position_after(text):
+        # Rewrite the file and wait for the watcher to reload it
+        count = len(reloads)
+        path.write_text(text)
+        deadline = time.monotonic() + 5.0
+        while len(reloads) == count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert len(reloads) > count
+        return m.get_location_position("rack", 0)
+
+    assert position_after(RACK.format(clearance=-5).replace("y_origin: 10", "y_origin: 20")) \
+        == (10.0, 20.0, -10.0)
+    # Unparsable and invalid files both keep the running table
+    assert position_after("rack: [x_origin: 10\n") == (10.0, 20.0, -10.0)
+    assert position_after(RACK.format(clearance=-5).replace("x_origin: 10", "x_origin: ten")) \
+        == (10.0, 20.0, -10.0)
+    assert reloads[-2:] == [False, False]
+    watcher = m._location_watcher
+    m.close()
+    assert m._location_watcher is None
+    assert watcher._thread is None
+
+
+def test_safe_move_retracts_unless_both_ends_have_clearance(tmp_path):
+    path = tmp_path / "locations.yaml"
+    path.write_text(
+        "vial_rack: {num_x: 2, num_y: 4, x_origin: 166.5, y_origin: 125, z_origin: -30,\n"
+        "            x_offset: 37.5, y_offset: -36, clearance_z: -5}\n"
+        "well_plate: {num_x: 4, num_y: 6, x_origin: 50, y_origin: 50, z_origin: -30,\n"
+        "             x_offset: 5, y_offset: 5}\n"
+        "rack_a: {x_origin: 10, y_origin: 10, z_origin: -30, x_offset: 1, y_offset: 1,\n"
+        "         clearance_z: -5}\n"
+        "rack_b: {x_origin: 200, y_origin: 150, z_origin: -30, x_offset: 1, y_offset: 1,\n"
+        "         clearance_z: -5}\n")
+    m = CNC_Machine("virtual", virtual=True, locations_file=str(path), location_cache=False,
+                    log_level=LOG_LEVEL)
+    start = m.get_location_position("well_plate", 0)
+    gcode = m.get_gcode_safe_move(*m.get_location_position("well_plate", 5), start=start)
+    assert gcode.startswith("G53 G0 Z")
+    start = m.get_location_position("vial_rack", 0)
+    gcode = m.get_gcode_safe_move(*m.get_location_position("vial_rack", 3), start=start)
+    assert gcode.startswith("G90 G0 Z-5.000")
+    # Both ends have a clearance, but the deck between them is unknown
+    start = m.get_location_position("rack_a", 0)
+    gcode = m.get_gcode_safe_move(*m.get_location_position("rack_b", 0), start=start)
+    assert gcode.startswith("G53 G0 Z")
@@ -0,0 +1,2 @@
+# cnc_machine_test.py is a usage example that opens a real serial port
+collect_ignore = ["cnc_machine_test.py"]
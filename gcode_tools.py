@@ -0,0 +1,649 @@
+"""
+Rewriting passes over G-code programs before they are sent to GRBL.
+
+optimize_gcode() is a peephole pass for the simple programs this package
+generates (G0/G1 moves, G53 retracts, dwells and modal setup). It tracks
+the modal state actually sent, so repeated G90/G21/G94/G54, motion words
+and unchanged F words are only emitted when they change; drops moves and
+axis words that would not move the tool; merges collinear G1 segments;
+and removes a Z move that is immediately superseded by another Z move
+unless it is a dip (the tool going down to something and coming back).
+Lines it does not understand are passed through untouched and make it
+forget everything it knew.
+
+fit_arcs() turns dense point lists into G1 moves where the path is
+straight and single G2/G3 moves where runs of points lie on a circle.
+
+StreamOptimizer and iter_optimize_gcode() run the same pass lazily.
+
+WireEncoder is the wire encoding, one line at a time: the fewest bytes
+GRBL parses as the same program, paired with the original lines for
+logging. Comments and whitespace are stripped, numbers lose trailing
+zeros, coordinates are rounded to ``decimals`` places (None keeps them as
+written) and F words are dropped while the feed is unchanged (except in
+G93 inverse-time mode, where every move needs one). $ lines go out as
+written.
+
+open_gcode() opens a program on disk, compressed or not, for reading line
+by line.
+"""
+import bz2
+import gzip
+import lzma
+import math
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+_WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_COMMENT = re.compile(r"\([^)]*\)|;.*")
+_SIMPLE = re.compile(r"^(?:\s*[GFXYZ]\s*[-+]?(?:\d+\.?\d*|\.\d+))+\s*$")
+AXES = "XYZ"
+
+# G-codes a simple line may carry, by modal group
+_MODAL_GROUPS = {
+    0.0: "motion", 1.0: "motion",
+    90.0: "distance",
+    17.0: "plane",
+    21.0: "units",
+    94.0: "feed_mode",
+    54.0: "wcs",
+}
+_GROUP_ORDER = ("units", "distance", "feed_mode", "wcs", "plane")
+# G-codes in unrecognised lines that move the tool or its offsets but leave
+# the tracked modal groups alone; any other G word (or M2/M30) resets them
+_POSITION_ONLY_G = {4.0, 10.0, 28.0, 28.1, 30.0, 30.1, 53.0, 92.0, 92.1}
+_OFFSET_G = {10.0, 92.0, 92.1}
+
+
+def _same(a, b):
+    return a is not None and b is not None and abs(a - b) <= 1e-9
+
+
+def _same_point(p, q):
+    return all(_same(a, b) for a, b in zip(p, q))
+
+
+# Most vertices one merged G1 may absorb, which bounds the work per merge
+_MAX_CORNERS = 64
+
+
+class _Move:
+    __slots__ = ("motion", "machine", "target", "feed", "start", "end", "corners")
+
+    def __init__(self, motion, machine, target, feed, start, corners=()):
+        self.motion = motion
+        self.machine = machine
+        # axis -> (value, text as written)
+        self.target = target
+        self.feed = feed
+        self.start = list(start)
+        # Vertices dropped by merging into this move, in path order
+        self.corners = list(corners)
+        self.end = list(start)
+        for i, a in enumerate(AXES):
+            if a in target:
+                self.end[i] = None if machine else target[a][0]
+
+    def z_only(self):
+        return list(self.target) == ["Z"]
+
+
+class _Peephole:
+    def __init__(self, tolerance, start, wco, stats):
+        self.tol = tolerance
+        self.wco = wco
+        self.stats = stats
+        self.out = []
+        # Modal state wanted by the program so far vs. actually emitted
+        self.want = {}
+        self.sent = {}
+        self.feed = None
+        self.sent_feed = None
+        self.pos = list(start) if start is not None else [None, None, None]
+        self.pending = None
+
+    # -- emission -------------------------------------------------------
+    def _modal_words(self, motion=None):
+        words = []
+        for group in _GROUP_ORDER:
+            want = self.want.get(group)
+            if want is not None and self.sent.get(group) != want:
+                words.append(want)
+                self.sent[group] = want
+        if motion is not None and self.sent.get("motion") != motion:
+            words.append(motion)
+            self.sent["motion"] = motion
+        return words
+
+    def _emit_move(self, mv):
+        words = []
+        if mv.machine:
+            # G53 only works in G0/G1, so spell the motion out every time
+            words += self._modal_words()
+            words += ["G53", mv.motion]
+            self.sent["motion"] = mv.motion
+        else:
+            words += self._modal_words(mv.motion)
+        for a in AXES:
+            if a in mv.target:
+                words.append(a + mv.target[a][1])
+        if mv.motion == "G1" and mv.feed is not None and mv.feed[0] != self.sent_feed:
+            words.append("F" + mv.feed[1])
+            self.sent_feed = mv.feed[0]
+        self.out.append(" ".join(words))
+
+    def _flush(self):
+        if self.pending is not None:
+            self._emit_move(self.pending)
+            self.pending = None
+
+    def finish(self, modal=True):
+        self._flush()
+        if modal:
+            words = self._modal_words(self.want.get("motion"))
+            if self.feed is not None and self.feed[0] != self.sent_feed:
+                words.append("F" + self.feed[1])
+                self.sent_feed = self.feed[0]
+            if words:
+                self.out.append(" ".join(words))
+
+    def passthrough(self, line, keep_modal=False):
+        self.finish()
+        self.out.append(line)
+        self.pos = [None, None, None]
+        if keep_modal:
+            return
+        for letter, num in _WORD.findall(line.upper()):
+            value = float(num)
+            if letter == "G" and value in _OFFSET_G:
+                self.wco = None
+            if (letter == "G" and value not in _POSITION_ONLY_G) or \
+                    (letter == "M" and value in (2.0, 30.0)):
+                self.want, self.sent = {}, {}
+                self.feed = self.sent_feed = None
+                return
+
+    def barrier(self, line):
+        # A dwell: nothing may move across it, but modal state survives
+        self._flush()
+        self.out.append(line)
+
+    # -- rewriting ------------------------------------------------------
+    def line(self, raw):
+        line = raw.strip().upper()
+        if not line:
+            return
+        if line.startswith("$"):
+            self.passthrough(raw.strip(), keep_modal=True)
+            return
+        words = _WORD.findall(line)
+        if len(words) == 2 and words[0] == ("G", "4") and words[1][0] == "P":
+            self.barrier(raw.strip())
+            return
+        if not _SIMPLE.match(line):
+            self.passthrough(raw.strip())
+            return
+        machine = False
+        motion = None
+        modal = {}
+        target = {}
+        feed = None
+        for letter, num in words:
+            if letter == "G":
+                g = float(num)
+                if g == 53.0:
+                    machine = True
+                    continue
+                group = _MODAL_GROUPS.get(g)
+                if group is None:
+                    self.passthrough(raw.strip())
+                    return
+                word = f"G{int(g)}"
+                if group == "motion":
+                    motion = word
+                else:
+                    modal[group] = word
+            elif letter == "F":
+                feed = (float(num), num)
+            elif letter in target:
+                self.passthrough(raw.strip())
+                return
+            else:
+                target[letter] = (float(num), num)
+        distance = modal.get("distance", self.want.get("distance"))
+        motion = motion or self.want.get("motion")
+        if target and (motion is None or (not machine and distance != "G90")):
+            # Unknown motion or distance mode: cannot reason about it
+            self.passthrough(raw.strip())
+            return
+        self.want.update(modal)
+        if motion is not None:
+            self.want["motion"] = motion
+        if feed is not None:
+            self.feed = feed
+        if not target:
+            return
+        mv = _Move(motion, machine, target, self.feed, self.pos)
+        if machine and self.wco is not None:
+            # Place the G53 target in work coordinates
+            for i, a in enumerate(AXES):
+                if a in target:
+                    mv.end[i] = target[a][0] - self.wco[i]
+        if not machine:
+            for i, a in enumerate(AXES):
+                if a in target and _same(self.pos[i], target[a][0]):
+                    del target[a]
+        if not target or _same_point(mv.start, mv.end):
+            self.stats["dropped"] += 1
+            return
+        self.pos = list(mv.end)
+        self._push(mv)
+
+    def _push(self, mv):
+        prev = self.pending
+        if prev is not None:
+            if self._superseded(prev, mv):
+                mv.start = prev.start
+                self.pending = None if _same_point(mv.start, mv.end) else mv
+                self.stats["collapsed"] += 1
+                return
+            merged = self._merge(prev, mv)
+            if merged is not None:
+                self.pending = merged
+                self.stats["merged"] += 1
+                return
+            self._emit_move(prev)
+        self.pending = mv
+
+    def _superseded(self, prev, mv):
+        # Z move followed straight away by another Z move: only the second
+        # matters unless the first is a dip below both its neighbours
+        if not (prev.z_only() and mv.z_only()):
+            return False
+        z0, z1, z2 = prev.start[2], prev.end[2], mv.end[2]
+        if z1 is None or z2 is None:
+            return False
+        return not (z1 < z2 and (z0 is None or z1 < z0))
+
+    def _merge(self, prev, mv):
+        if prev.motion != "G1" or mv.motion != "G1" or prev.machine or mv.machine:
+            return None
+        if (prev.feed and prev.feed[0]) != (mv.feed and mv.feed[0]):
+            return None
+        p0, p1, p2 = prev.start, prev.end, mv.end
+        if None in p0 or None in p1 or None in p2 or len(prev.corners) >= _MAX_CORNERS:
+            return None
+        d = [b - a for a, b in zip(p0, p2)]
+        length = math.sqrt(sum(c * c for c in d))
+        if length == 0.0:
+            return None
+        # Every vertex dropped so far must stay within tolerance of the new
+        # chord, or a slow curve would drift off one segment at a time
+        corners = prev.corners + [p1]
+        for c in corners:
+            v = [b - a for a, b in zip(p0, c)]
+            t = sum(a * b for a, b in zip(v, d)) / length
+            if t < 0.0 or t > length:
+                return None
+            if sum(x * x for x in v) - t * t > self.tol * self.tol:
+                return None
+        target = dict(prev.target)
+        target.update(mv.target)
+        return _Move("G1", False, target, mv.feed, p0, corners)
+
+
+class StreamOptimizer:
+    """
+    The peephole pass one line at a time, for programs that are produced
+    while they are sent. push() returns the lines that are final so far
+    (possibly none, while a merge is pending); finish() returns the rest
+    and adds the counts to ``stats``.
+    """
+
+    def __init__(self, tolerance=0.002, start=None, wco=None, stats=None):
+        self.counts = {"merged": 0, "collapsed": 0, "dropped": 0}
+        self._pp = _Peephole(float(tolerance), start, wco, self.counts)
+        self.stats = stats
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _drain(self):
+        out = self._pp.out
+        self._pp.out = []
+        self.bytes_out += sum(len(ln) + 1 for ln in out)
+        return out
+
+    def push(self, raw):
+        if raw and raw.strip():
+            self.bytes_in += len(raw.strip()) + 1
+        self._pp.line(raw or "")
+        return self._drain()
+
+    def finish(self):
+        self._pp.finish()
+        out = self._drain()
+        if self.stats is not None:
+            for key, val in self.counts.items():
+                self.stats[key] = self.stats.get(key, 0) + val
+            self.stats["bytes_in"] = self.stats.get("bytes_in", 0) + self.bytes_in
+            self.stats["bytes_out"] = self.stats.get("bytes_out", 0) + self.bytes_out
+        return out
+
+
+def iter_optimize_gcode(lines, tolerance=0.002, start=None, wco=None, stats=None):
+    """Lazy optimize_gcode(): yields lines as soon as they are final."""
+    opt = StreamOptimizer(tolerance, start, wco, stats)
+    for raw in lines:
+        yield from opt.push(raw)
+    yield from opt.finish()
+
+
+def optimize_gcode(lines, tolerance=0.002, start=None, wco=None, stats=None):
+    """
+    Peephole-optimise ``lines`` (an iterable of G-code lines) and return the
+    new list of lines. ``tolerance`` (mm) bounds how far a merged collinear
+    G1 may stray from any of the corners it drops. ``start`` is the tool position in
+    work coordinates (None per unknown axis) and ``wco`` the work offset
+    used to place G53 moves; both are optional. Counts of merged, collapsed
+    and dropped moves and the byte totals are added to ``stats`` if given.
+    """
+    return list(iter_optimize_gcode(lines, tolerance, start, wco, stats))
+
+
+ArcFit = namedtuple("ArcFit", "lines arcs points_in lines_out compression max_deviation")
+
+
+def _circumcircles(A, B, C):
+    # Centre, radius and turning sign of the XY circles through A[k], B[k]
+    # and C[k], computed around B for conditioning
+    a = A[:, :2] - B[:, :2]
+    c = C[:, :2] - B[:, :2]
+    d = 2.0 * (a[:, 0] * c[:, 1] - a[:, 1] * c[:, 0])
+    a2 = (a * a).sum(axis=1)
+    c2 = (c * c).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ux = (c[:, 1] * a2 - a[:, 1] * c2) / d
+        uy = (a[:, 0] * c2 - c[:, 0] * a2) / d
+    centre = np.column_stack([ux, uy]) + B[:, :2]
+    radius = np.hypot(ux, uy)
+    # d is twice the cross product a x c, negative where the path turns
+    # left; the sign returned is +1 for left (G3) and -1 for right (G2)
+    return centre, radius, -np.sign(d)
+
+
+def _fit_runs(P, starts, ends):
+    # Circle through every run's end points with the least-squares centre
+    # projected onto their perpendicular bisector, so GRBL sees one radius.
+    # Returns centres, radii, max deviation and sweep (rad) per run.
+    counts = ends - starts + 1
+    idx = np.repeat(starts, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+    offsets = np.cumsum(counts) - counts
+    origin = np.repeat(P[starts, :2], counts, axis=0)
+    q = P[idx, :2] - origin
+    x, y = q[:, 0], q[:, 1]
+    w = x * x + y * y
+    S = lambda v: np.add.reduceat(v, offsets)
+    n = counts.astype(float)
+    sx, sy, sxx, syy, sxy = S(x), S(y), S(x * x), S(y * y), S(x * y)
+    A = np.stack([np.stack([sxx, sxy, sx], -1), np.stack([sxy, syy, sy], -1),
+                  np.stack([sx, sy, n], -1)], -2)
+    b = -np.stack([S(x * w), S(y * w), S(w)], -1)
+    sol = np.linalg.solve(A + np.eye(3) * 1e-12, b[..., None])[..., 0]
+    centre = -0.5 * sol[:, :2] + P[starts, :2]
+    s, e = P[starts, :2], P[ends, :2]
+    mid = 0.5 * (s + e)
+    chord = e - s
+    perp = np.column_stack([-chord[:, 1], chord[:, 0]])
+    perp /= np.linalg.norm(perp, axis=1)[:, None]
+    centre = mid + ((centre - mid) * perp).sum(axis=1)[:, None] * perp
+    radius = np.linalg.norm(s - centre, axis=1)
+    rc = np.repeat(centre, counts, axis=0)
+    rr = np.repeat(radius, counts)
+    dev = np.abs(np.linalg.norm(P[idx, :2] - rc, axis=1) - rr)
+    # Chords of the original polyline bulge away from the arc by the sagitta
+    seg = np.linalg.norm(np.diff(P[idx, :2], axis=0), axis=1)
+    sag = rr[1:] - np.sqrt(np.maximum(rr[1:] ** 2 - (seg / 2.0) ** 2, 0.0))
+    half = np.arcsin(np.minimum(seg / (2.0 * rr[1:]), 1.0))
+    last = np.cumsum(counts) - 1
+    sag[last[:-1]] = 0.0
+    half[last[:-1]] = 0.0
+    dev[1:] = np.maximum(dev[1:], sag)
+    zdev = np.abs(P[idx, 2] - np.repeat(P[starts, 2], counts))
+    dev = np.maximum(dev, zdev)
+    max_dev = np.maximum.reduceat(dev, offsets)
+    sweep = np.add.reduceat(np.concatenate([[0.0], 2.0 * half]), offsets)
+    return centre, radius, max_dev, sweep
+
+
+def _arc_ok(P, starts, ends, tol, max_sweep):
+    if not len(starts):
+        return np.zeros(0, dtype=bool)
+    _, _, dev, sweep = _fit_runs(P, starts, ends)
+    return (dev <= tol) & (sweep <= max_sweep)
+
+
+def _chop(starts, ends, chunk):
+    pieces = np.maximum(-(-(ends - starts) // (chunk - 1)), 1)
+    first = np.repeat(starts, pieces) + (chunk - 1) * (
+        np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces))
+    return first, np.minimum(first + chunk - 1, np.repeat(ends, pieces))
+
+
+def _merge_arcs(P, starts, ends, tol, max_sweep):
+    # Join arcs that meet end to start while the union still fits; pairs
+    # are tried on alternating parities so no arc takes part in two merges
+    stalled = 0
+    parity = 0
+    while len(starts) > 1 and stalled < 2:
+        i = np.flatnonzero(ends[:-1] == starts[1:])
+        i = i[i % 2 == parity]
+        ok = _arc_ok(P, starts[i], ends[i + 1], tol, max_sweep)
+        i = i[ok]
+        stalled = 0 if len(i) else stalled + 1
+        ends[i] = ends[i + 1]
+        keep = np.ones(len(starts), dtype=bool)
+        keep[i + 1] = False
+        starts, ends = starts[keep], ends[keep]
+        parity ^= 1
+    return starts, ends
+
+
+def fit_arcs(points, tolerance=0.01, feed=3000, min_points=4, max_sweep=1.5 * math.pi,
+             chunk=128):
+    """
+    G-code visiting ``points`` (N x 3, work coordinates) in order, with runs
+    of at least ``min_points`` points lying within ``tolerance`` mm of a
+    circular arc in the XY plane (at constant Z) replaced by single G2/G3
+    moves. Deviation counts both the points' distance from the arc and
+    how far the original chords sit inside it.
+
+    Returns ArcFit(lines, arcs, points_in, lines_out, compression,
+    max_deviation) where compression is input moves per output move.
+    """
+    P = np.asarray(points, dtype=float).reshape(-1, 3)
+    n = len(P)
+    tol = float(tolerance)
+    runs_s = np.empty(0, dtype=np.int64)
+    runs_e = np.empty(0, dtype=np.int64)
+    if n >= min_points:
+        # Judge the curve at each point from neighbours about ``reach`` mm
+        # away along the path: dense, rounded points say little about the
+        # circle they lie on over just one segment
+        reach = 10.0 * math.sqrt(tol)
+        dist = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(P, axis=0), axis=1))])
+        mid = np.arange(1, n - 1)
+        left = np.clip(np.searchsorted(dist, dist[mid] - reach, "right") - 1, 0, mid - 1)
+        right = np.clip(np.searchsorted(dist, dist[mid] + reach, "left"), mid + 1, n - 1)
+        centre, radius, turn = _circumcircles(P[left], P[mid], P[right])
+        with np.errstate(invalid="ignore"):
+            ok = np.isfinite(radius) & (turn != 0)
+            # Candidate runs: neighbouring triples turning the same way with
+            # similar radii. Rounded input makes the radius of three close
+            # points noisy, so this is loose; the fit below is the real test.
+            link = (ok[:-1] & ok[1:] & (turn[:-1] == turn[1:])
+                    & (np.abs(radius[:-1] - radius[1:]) <= 0.5 * np.minimum(radius[:-1], radius[1:]) + tol))
+            # Straight stretches are left to the peephole pass
+            half = np.linalg.norm(P[right, :2] - P[left, :2], axis=1) / 2.0
+            sag = radius - np.sqrt(np.maximum(radius ** 2 - half ** 2, 0.0))
+            link &= (sag[:-1] > tol / 4.0) | (sag[1:] > tol / 4.0)
+        edge = np.diff(np.concatenate([[0], link.astype(np.int8), [0]]))
+        first = np.flatnonzero(edge == 1)
+        last = np.flatnonzero(edge == -1)
+        # Linked triples first..last-1 (triple k is centred on point k+1)
+        # cover points first..last+1; runs may not share more than an end
+        starts, ends = [], []
+        prev_end = 0
+        for a, b in zip(first.tolist(), (last + 1).tolist()):
+            a = max(a, prev_end)
+            if b - a + 1 >= min_points:
+                starts.append(a)
+                ends.append(b)
+                prev_end = b
+        # Chop long candidates so the greedy search below takes the same few
+        # rounds however long a run is; _merge_arcs rejoins the pieces
+        todo_s, todo_e = _chop(np.asarray(starts, dtype=np.int64),
+                               np.asarray(ends, dtype=np.int64), chunk)
+        keep_s, keep_e = [], []
+        while len(todo_s):
+            # Longest arc from each start, by bisection over all runs at once
+            good = _arc_ok(P, todo_s, todo_e, tol, max_sweep)
+            keep_s.append(todo_s[good])
+            keep_e.append(todo_e[good])
+            s0, e0 = todo_s[~good], todo_e[~good]
+            lo = s0 + (min_points - 1)
+            hi = e0 - 1
+            fits = _arc_ok(P, s0, lo, tol, max_sweep)
+            while True:
+                busy = fits & (lo < hi)
+                if not busy.any():
+                    break
+                mid = np.where(busy, (lo + hi + 1) // 2, lo)
+                ok = _arc_ok(P, s0, mid, tol, max_sweep)
+                lo = np.where(busy & ok, mid, lo)
+                hi = np.where(busy & ~ok, mid - 1, hi)
+            keep_s.append(s0[fits])
+            keep_e.append(lo[fits])
+            # The rest of each run starts over; where not even the shortest
+            # arc fits, skip ahead and leave those points as lines
+            todo_s = np.where(fits, lo, s0 + max(min_points - 2, 1))
+            todo_e = e0
+            long = todo_e - todo_s + 1 >= min_points
+            todo_s, todo_e = todo_s[long], todo_e[long]
+        if keep_s:
+            runs_s = np.concatenate(keep_s)
+            runs_e = np.concatenate(keep_e)
+            order = np.argsort(runs_s)
+            runs_s, runs_e = _merge_arcs(P, runs_s[order], runs_e[order], tol, max_sweep)
+
+    max_dev = 0.0
+    arc_at = {}
+    if len(runs_s):
+        centre, radius, dev, _ = _fit_runs(P, runs_s, runs_e)
+        max_dev = float(dev.max())
+        turn = _circumcircles(P[runs_s], P[runs_s + 1], P[runs_e])[2]
+        for s, e, c, t in zip(runs_s.tolist(), runs_e.tolist(), centre.tolist(), turn.tolist()):
+            arc_at[s] = (e, c, "G3" if t > 0 else "G2")
+
+    lines = ["G90 G17"]
+    text = [f"X{x:.3f} Y{y:.3f} Z{z:.3f}" for x, y, z in P.tolist()]
+    if n:
+        lines.append(f"G1 {text[0]} F{int(feed)}")
+    i = 0
+    while i < n - 1:
+        arc = arc_at.get(i)
+        if arc is None:
+            lines.append(f"G1 {text[i + 1]}")
+            i += 1
+            continue
+        e, (cx, cy), word = arc
+        lines.append(f"{word} {text[e]} I{cx - P[i, 0]:.3f} J{cy - P[i, 1]:.3f}")
+        i = e
+    moves_in = max(n, 0)
+    moves_out = len(lines) - 1
+    return ArcFit(lines, len(arc_at), n, moves_out,
+                  moves_in / moves_out if moves_out else 1.0, max_dev)
+
+
+def _trim(text):
+    # Shortest spelling GRBL reads as the same number: 1.500 -> 1.5,
+    # 0.25 -> .25, -0.000 -> 0, 010 -> 10
+    sign = ""
+    if text[0] in "+-":
+        sign, text = text[0].replace("+", ""), text[1:]
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    text = text.lstrip("0")
+    return (sign + text) if text.strip("0.") else "0"
+
+
+_WIRE_ROUNDED = "XYZIJKR"
+
+
+def step_decimals(settings):
+    """Decimals needed to address one step: 800 steps/mm -> 3 (0.001 mm)."""
+    finest = max(float(settings[100 + i]) for i in range(3))
+    return max(0, math.ceil(math.log10(finest) - 1e-9))
+
+
+class WireEncoder:
+    """
+    The wire encoding one line at a time: encode() returns (wire, original)
+    for a line worth sending or None for one that carries nothing (blank,
+    comment only, or an F word that would not change the feed).
+    """
+
+    def __init__(self, decimals=None):
+        self.decimals = decimals
+        self.feed = None
+        self.inverse_time = False
+
+    def encode(self, raw):
+        original = (raw or "").strip()
+        if not original:
+            return None
+        if original.startswith("$"):
+            return original, original
+        text = _COMMENT.sub("", original).upper().replace(" ", "").replace("\t", "")
+        if not text:
+            return None
+        words = _WORD.findall(text)
+        if "".join(l + n for l, n in words) != text:
+            # Something this encoder does not model; only strip it
+            return text, original
+        decimals = self.decimals
+        out = []
+        for letter, num in words:
+            if letter == "F":
+                value = float(num)
+                if value == self.feed and not self.inverse_time:
+                    continue
+                self.feed = value
+                out.append("F" + _trim(num))
+            elif letter in _WIRE_ROUNDED and decimals is not None:
+                out.append(letter + _trim(f"{round(float(num), decimals):.{decimals}f}"))
+            else:
+                out.append(letter + _trim(num))
+                if letter == "G" and num in ("93", "93.0"):
+                    self.inverse_time = True
+                elif letter == "G" and num in ("94", "94.0"):
+                    self.inverse_time = False
+        return ("".join(out), original) if out else None
+
+
+_OPENERS = {".gz": gzip.open, ".xz": lzma.open, ".lzma": lzma.open, ".bz2": bz2.open}
+
+
+def open_gcode(path, buffer_size=1 << 20):
+    """
+    Open a G-code file for lazy line iteration, decompressing .gz, .xz and
+    .bz2 on the fly. Bytes that are not ASCII are decoded as U+FFFD rather
+    than raising; comments are stripped before lines are sent, so a stray
+    byte in one does not abort a long job.
+    """
+    opener = _OPENERS.get(os.path.splitext(str(path))[1].lower())
+    if opener is not None:
+        return opener(path, "rt", encoding="ascii", errors="replace")
+    return open(path, "r", encoding="ascii", errors="replace", buffering=buffer_size)
@@ -0,0 +1,182 @@
+"""
+Unit tests for the G-code rewriting passes. Run with ``python -m pytest -q``.
+"""
+import math
+import re
+
+import numpy as np
+import pytest
+
+from gcode_tools import WireEncoder, fit_arcs, optimize_gcode
+
+
+def polyline_deviation(points, vertices):
+    # Largest distance from any of ``points`` to the nearest segment of the
+    # polyline through ``vertices``
+    P = np.asarray(points, dtype=float)
+    V = np.asarray(vertices, dtype=float)
+    a, b = V[:-1], V[1:]
+    d = b - a
+    t = np.clip(((P[:, None, :] - a) * d).sum(axis=2) / (d * d).sum(axis=1), 0.0, 1.0)
+    nearest = a + t[..., None] * d
+    return float(np.sqrt(((P[:, None, :] - nearest) ** 2).sum(axis=2)).min(axis=1).max())
+
+
+def replay(lines, start):
+    # Work positions visited by absolute G0/G1 lines
+    pos = list(start)
+    out = [tuple(pos)]
+    for line in lines:
+        for word in line.split():
+            if word[0] in "XYZ":
+                pos["XYZ".index(word[0])] = float(word[1:])
+        out.append(tuple(pos))
+    return out
+
+
+@pytest.mark.parametrize("tol", [0.002, 0.05])
+def test_merging_a_slow_arc_stays_within_tolerance(tol):
+    # 400 one-millimetre segments on a radius of 1000 mm: every corner is
+    # nearly straight, but the curve as a whole is not
+    angles = np.arange(401) * 0.001
+    points = np.column_stack([1000 * np.cos(angles), 1000 * np.sin(angles), np.zeros(401)])
+    lines = ["G90 G1 F1200"] + [f"G1 X{x:.4f} Y{y:.4f}" for x, y, _ in points[1:]]
+    out = optimize_gcode(lines, tolerance=tol, start=points[0])
+    vertices = replay(out, points[0])
+    assert vertices[-1] == pytest.approx(tuple(points[-1]), abs=1e-4)
+    assert len(out) < len(lines) / 2
+    assert polyline_deviation(points, vertices) <= tol + 1e-4
+
+
+def test_straight_runs_still_merge():
+    lines = ["G90 G1 F600"] + [f"G1 X{i}" for i in range(1, 11)]
+    assert optimize_gcode(lines, start=(0, 0, 0)) == ["G90 G1 X10 F600"]
+    # Long runs are cut into a few pieces that each absorb a bounded
+    # number of vertices
+    out = optimize_gcode(lines[:1] + [f"G1 X{i}" for i in range(1, 201)], start=(0, 0, 0))
+    assert out[-1] == "X200"
+    assert len(out) <= 4
+
+
+def arc_deviation(points, lines):
+    # Largest distance from the input polyline (its points and the middle
+    # of every chord) to the moves of ``lines``, replayed independently of
+    # the fitter. I and J are rounded to 0.001 mm, which moves the centre
+    # by up to 0.0007 mm.
+    P = np.round(np.asarray(points, dtype=float), 3)
+    i, worst = 0, 0.0
+    for line in lines[2:]:
+        words = {w[0]: float(w[1:]) for w in line.split()[1:]}
+        end = (words["X"], words["Y"], words["Z"])
+        e = next(k for k in range(i + 1, len(P)) if np.allclose(P[k], end, atol=5e-4))
+        if line.startswith("G1"):
+            assert e == i + 1
+        else:
+            c = P[i, :2] + (words["I"], words["J"])
+            r = np.hypot(*(P[i, :2] - c))
+            run = P[i:e + 1, :2]
+            probes = np.vstack([run, (run[1:] + run[:-1]) / 2.0])
+            worst = max(worst, float(np.abs(np.hypot(*(probes - c).T) - r).max()))
+            # The path turns the way the arc goes
+            ang = np.unwrap(np.arctan2(run[:, 1] - c[1], run[:, 0] - c[0]))
+            step = np.diff(ang)
+            assert (step > 0).all() if line.startswith("G3") else (step < 0).all()
+            assert np.ptp(P[i:e + 1, 2]) == 0.0
+        i = e
+    assert i == len(P) - 1
+    return worst
+
+
+def circle(cx, cy, r, a0, a1, n, z=0.0):
+    a = np.linspace(a0, a1, n)
+    return np.column_stack([cx + r * np.cos(a), cy + r * np.sin(a), np.full(n, z)])
+
+
+@pytest.mark.parametrize("tol", [0.002, 0.01, 0.05])
+def test_arcs_stay_within_tolerance(tol):
+    # A line, a left turn, a right turn, a climb and a line, rounded to
+    # 0.001 mm as generated programs are
+    path = np.vstack([
+        np.column_stack([np.linspace(0, 20, 11), np.zeros(11), np.zeros(11)])[:-1],
+        circle(20, 15, 15, -math.pi / 2, 0, 80)[:-1],
+        circle(60, 15, 25, math.pi, math.pi / 2, 120)[:-1],
+        np.column_stack([np.linspace(60, 80, 21), np.full(21, 40), np.linspace(0, -5, 21)]),
+    ])
+    fit = fit_arcs(np.round(path, 3), tolerance=tol)
+    assert fit.arcs >= 2
+    assert {ln.split()[0] for ln in fit.lines[2:]} >= {"G1", "G2", "G3"}
+    assert fit.compression > 5
+    assert fit.max_deviation <= tol
+    assert arc_deviation(path, fit.lines) <= tol + 1e-3
+
+
+def test_noise_and_straight_lines_stay_lines():
+    rng = np.random.default_rng(3)
+    zigzag = np.column_stack([np.arange(50.0), rng.uniform(-5, 5, 50), np.zeros(50)])
+    fit = fit_arcs(zigzag)
+    assert fit.arcs == 0
+    assert fit.lines_out == 50
+    straight = np.column_stack([np.arange(50.0), np.arange(50.0) / 2, np.zeros(50)])
+    assert fit_arcs(straight).arcs == 0
+
+
+PROGRAM = """\
+(setup) G21 G90 G94 G17
+g0 x0 y0 z0
+G01 X010.500 Y-0.250 F1500.000 ; first cut
+G1 X20 Y5 F1500
+F1500
+G1 x30 y5 f 900
+G2 X40 Y5 I5 J0
+G3 X50.0 Y5.0 I5.000 J0.000 F900
+G4 P0.25
+G93 G1 X60 F30
+G1 X70 F30
+G94 G1 X80 F600
+G53 G0 Z-1.000
+G0 Z0.0000
+"""
+
+
+def planned(lines):
+    # What the emulated controller plans for ``lines``: the result of every
+    # line and each planner block's geometry and speed
+    emu = pytest.importorskip("grbl_emulator").GrblEmulator(time_scale=None, start_locked=False)
+    results = [emu._execute(line) for line in lines]
+    blocks = [(tuple(np.round(b.start, 9)), tuple(np.round(b.end, 9)), round(b.v_nominal, 9),
+               b.rapid, b.arc and tuple(np.round(b.arc, 9))) for b in emu._planner]
+    return [r for r in results if r], blocks
+
+
+def plain(lines):
+    # The encoding used without compact_wire: comments stripped only
+    out = []
+    for line in lines:
+        wire = re.sub(r"\([^)]*\)|;.*", "", line).strip()
+        if wire:
+            out.append(wire)
+    return out
+
+
+def test_compact_wire_plans_the_same_moves():
+    lines = PROGRAM.splitlines()
+    enc = WireEncoder(decimals=3)
+    compact = [item[0] for item in map(enc.encode, lines) if item is not None]
+    assert sum(map(len, compact)) < sum(map(len, plain(lines))) * 0.7
+    errors, blocks = planned(plain(lines))
+    assert not errors
+    assert planned(compact) == (errors, blocks)
+    # Originals come back untouched for logging
+    enc = WireEncoder()
+    assert enc.encode("G1 X1.500 (cut)") == ("G1X1.5", "G1 X1.500 (cut)")
+    assert enc.encode("$H") == ("$H", "$H")
+    assert enc.encode("  ; note") is None
+
+
+def test_compact_wire_rounds_to_whole_steps():
+    enc = WireEncoder(decimals=3)
+    assert enc.encode("G1 X1.23449 Y-0.00001 F100.0")[0] == "G1X1.234Y0F100"
+    # Only a changed feed is resent, except in inverse-time mode
+    assert enc.encode("G1 X2 F100")[0] == "G1X2"
+    assert enc.encode("G93 G1 X3 F100")[0] == "G93G1X3F100"
+    assert enc.encode("G1 X4 F100")[0] == "G1X4F100"
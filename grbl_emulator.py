@@ -0,0 +1,700 @@
+"""
+GRBL 1.1 protocol emulator on a Linux pseudo-terminal.
+
+    emu = GrblEmulator(time_scale=10.0)
+    m = CNC_Machine(com=emu.start(), locations_file="location_status.yaml")
+    m.home()
+    ...
+    emu.stop()
+
+Models the 128-byte RX buffer (bytes that do not fit are dropped, as on the
+real controller), a 15-block look-ahead planner, ok/error:N replies, '?'
+status reports, $-commands, real-time bytes and motion time from feed,
+max rate, acceleration and junction deviation. Like an Arduino, the
+emulator resets and prints its banner whenever the port is opened.
+
+G-code covers what this package sends: G0-G3, G4, G10 L2/L20 P1, G17-G21,
+G53, G54-G59 (all sharing the G54 offset), G80, G90/G91, G92/G92.1 and
+G93/G94. Other GRBL 1.1 words answer error:20 here although the real
+controller accepts them, notably G28/G30 and their .1 forms, probing
+(G38.x), tool length offsets (G43.1) and G91.1.
+
+Run ``python grbl_emulator.py`` to get a port for manual testing.
+"""
+import math
+import os
+import pty
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from kinematics import (
+    AXES, DEFAULT_SETTINGS, junction_speed, move_limits, profile_distance,
+    profile_duration, profile_speed, trapezoid,
+)
+
+VERSION = "1.1h"
+BANNER = f"Grbl {VERSION} ['$' for help]"
+LINE_BUFFER_SIZE = 80
+
+# Settings reported by $$ on top of the ones used for motion timing
+EMULATOR_SETTINGS = {
+    0: 10, 1: 25, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0, 10: 3, 12: 0.002, 13: 0,
+    20: 0, 21: 0, 22: 1, 23: 0, 24: 100.0, 25: 1000.0, 26: 250, 27: 1.0,
+    30: 1000, 31: 0, 32: 0, 130: 270.0, 131: 150.0, 132: 35.0,
+}
+
+ERR_EXPECTED_LETTER = 1
+ERR_BAD_NUMBER = 2
+ERR_INVALID_STATEMENT = 3
+ERR_SETTING_DISABLED = 5
+ERR_IDLE_ERROR = 8
+ERR_SYSTEM_GC_LOCK = 9
+ERR_OVERFLOW = 11
+ERR_INVALID_JOG = 16
+ERR_UNSUPPORTED = 20
+ERR_UNDEFINED_FEED = 22
+ERR_NO_AXIS_WORDS = 26
+ERR_INVALID_TARGET = 33
+
+ALARM_ABORT_CYCLE = 3
+
+CMD_RESET = 0x18
+CMD_STATUS = ord("?")
+CMD_HOLD = ord("!")
+CMD_CYCLE_START = ord("~")
+CMD_SAFETY_DOOR = 0x84
+CMD_JOG_CANCEL = 0x85
+
+_WORD = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+
+
+class _Block:
+    __slots__ = ("start", "end", "length", "v_nominal", "accel", "u_start",
+                 "u_end", "rapid", "jog", "arc", "v_entry", "profile", "elapsed")
+
+    def __init__(self, start, end, length, v_nominal, accel, u_start, u_end,
+                 rapid=False, jog=False, arc=None):
+        self.start = start
+        self.end = end
+        self.length = length
+        self.v_nominal = v_nominal
+        self.accel = accel
+        self.u_start = u_start
+        self.u_end = u_end
+        self.rapid = rapid
+        self.jog = jog
+        self.arc = arc
+        self.v_entry = 0.0
+        self.profile = None
+        self.elapsed = 0.0
+
+    def position(self, s):
+        if self.length <= 0.0:
+            return list(self.end)
+        f = min(1.0, s / self.length)
+        if self.arc is None:
+            return [a + (b - a) * f for a, b in zip(self.start, self.end)]
+        cx, cy, radius, a0, sweep = self.arc
+        ang = a0 + sweep * f
+        return [cx + radius * math.cos(ang), cy + radius * math.sin(ang),
+                self.start[2] + (self.end[2] - self.start[2]) * f]
+
+
+class GrblEmulator:
+    """
+    Emulated GRBL controller behind a pty. ``time_scale`` speeds up simulated
+    motion (10.0 runs ten times faster than real time, None completes moves
+    instantly). ``start_locked`` mimics $22=1: the controller boots in Alarm
+    and needs $H or $X.
+    """
+
+    def __init__(self, settings=None, rx_buffer_size=128, planner_blocks=15,
+                 time_scale=1.0, start_locked=True):
+        self.settings = dict(EMULATOR_SETTINGS)
+        self.settings.update(DEFAULT_SETTINGS)
+        self.settings.update(settings or {})
+        if not start_locked:
+            self.settings[22] = 0
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_blocks = planner_blocks
+        self.time_scale = time_scale
+        self.port = None
+        self.overflows = 0
+        self.lines_received = 0
+        self._master = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # G54 offset (kept like EEPROM data) and G92 offset (lost on reset)
+        self.wco = [0.0, 0.0, 0.0]
+        self.g92 = [0.0, 0.0, 0.0]
+        self.mpos = [0.0, 0.0, 0.0]
+        self._reset(power_on=True)
+
+    # ---- lifecycle ----
+    def start(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # Only the client keeps the slave open, so a hang-up tells us when the
+        # port is opened and closed (the Arduino reset-on-open behaviour).
+        os.close(slave)
+        self._master = master
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="grbl-emulator", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        if self._master is not None:
+            os.close(self._master)
+            self._master = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def position(self):
+        """Current machine position (MPos)."""
+        with self._lock:
+            return tuple(self._current_mpos())
+
+    # ---- main loop ----
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._master, select.POLLIN | select.POLLHUP)
+        connected = False
+        last = time.monotonic()
+        while not self._stop.is_set():
+            events = poller.poll(2)
+            now = time.monotonic()
+            hup = any(ev & select.POLLHUP for _, ev in events)
+            if hup:
+                if connected:
+                    connected = False
+                    with self._lock:
+                        self._reset(power_on=True)
+                time.sleep(0.01)
+                last = now
+                continue
+            if not connected:
+                connected = True
+                with self._lock:
+                    self._reset(power_on=True)
+                    self._emit("")
+                    self._emit(BANNER)
+                    self._announce_alarm()
+            data = b""
+            if any(ev & select.POLLIN for _, ev in events):
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    data = b""
+            with self._lock:
+                for b in data:
+                    self._on_byte(b)
+                dt = now - last
+                self._advance(math.inf if self.time_scale is None else dt * self.time_scale)
+                self._process_rx()
+                out, self._out = self._out, []
+            last = now
+            if out:
+                try:
+                    os.write(self._master, "".join(out).encode("ascii"))
+                except OSError:
+                    pass
+
+    def _emit(self, text):
+        self._out.append(text + "\r\n")
+
+    # ---- reset ----
+    def _reset(self, power_on=False):
+        # Only power-up (or opening the port) locks the controller with
+        # $22=1; a soft reset keeps the state it had, see _soft_reset()
+        self._rx = bytearray()
+        self._planner = deque()
+        self._plan_pos = None
+        self._pending = None
+        self._dwell_end = None
+        self._hold = False
+        self._feed_ovr = 100
+        self._rapid_ovr = 100
+        self._spindle_ovr = 100
+        self._report_count = 0
+        self._ov_changed = False
+        self._out = [] if power_on else getattr(self, "_out", [])
+        self.g92 = [0.0, 0.0, 0.0]
+        self._modal = {"motion": "G0", "distance": "G90", "units": "G21",
+                       "wcs": "G54", "plane": "G17", "feed_mode": "G94", "feed": 0.0}
+        if power_on:
+            self._state = "Alarm" if self.settings.get(22) else "Idle"
+
+    def _announce_alarm(self):
+        if self._state == "Alarm":
+            self._emit("[MSG:'$H'|'$X' to unlock]")
+
+    def _soft_reset(self):
+        moving = bool(self._planner) or self._state in ("Run", "Jog", "Home")
+        if self._planner:
+            self.mpos = self._current_mpos()
+        was_alarm = self._state == "Alarm"
+        self._reset()
+        # As GRBL 1.1: aborting motion raises an alarm, an alarm stays and
+        # anything else comes back Idle
+        if moving:
+            self._emit(f"ALARM:{ALARM_ABORT_CYCLE}")
+            self._state = "Alarm"
+        else:
+            self._state = "Alarm" if was_alarm else "Idle"
+        self._emit("")
+        self._emit(BANNER)
+        self._announce_alarm()
+
+    # ---- real-time bytes and RX buffer ----
+    def _on_byte(self, b):
+        if b == CMD_STATUS:
+            self._emit(self._status_report())
+        elif b == CMD_HOLD:
+            if self._state in ("Run", "Jog") or self._planner:
+                self._hold = True
+                self._state = "Hold"
+        elif b == CMD_CYCLE_START:
+            if self._hold:
+                self._hold = False
+                self._state = "Run" if self._planner else "Idle"
+        elif b == CMD_RESET:
+            self._soft_reset()
+        elif b == CMD_JOG_CANCEL:
+            if self._state == "Jog":
+                self.mpos = self._current_mpos()
+                self._planner.clear()
+                self._plan_pos = None
+                self._state = "Idle"
+        elif 0x90 <= b <= 0x9D:
+            self._override(b)
+        elif b >= 0x80:
+            pass
+        elif len(self._rx) < self.rx_buffer_size - 1:
+            self._rx.append(b)
+        else:
+            self.overflows += 1
+
+    def _override(self, b):
+        clamp = lambda v, lo, hi: max(lo, min(hi, v))
+        if b == 0x90:
+            self._feed_ovr = 100
+        elif b in (0x91, 0x92, 0x93, 0x94):
+            step = {0x91: 10, 0x92: -10, 0x93: 1, 0x94: -1}[b]
+            self._feed_ovr = clamp(self._feed_ovr + step, 10, 200)
+        elif b in (0x95, 0x96, 0x97):
+            self._rapid_ovr = {0x95: 100, 0x96: 50, 0x97: 25}[b]
+        elif b == 0x99:
+            self._spindle_ovr = 100
+        elif b in (0x9A, 0x9B, 0x9C, 0x9D):
+            step = {0x9A: 10, 0x9B: -10, 0x9C: 1, 0x9D: -1}[b]
+            self._spindle_ovr = clamp(self._spindle_ovr + step, 10, 200)
+        # Like GRBL, the next report carries the new values
+        self._ov_changed = True
+
+    def _status_report(self):
+        mask = int(self.settings.get(10, 1))
+        mpos = self._current_mpos()
+        state = self._state + (":0" if self._state == "Hold" else "")
+        fields = [state]
+        if mask & 1:
+            fields.append("MPos:" + ",".join(f"{v:.3f}" for v in mpos))
+        else:
+            wpos = (m - o for m, o in zip(mpos, self._work_offset()))
+            fields.append("WPos:" + ",".join(f"{v:.3f}" for v in wpos))
+        if mask & 2:
+            fields.append(f"Bf:{self.planner_blocks - len(self._planner)},"
+                          f"{self.rx_buffer_size - len(self._rx)}")
+        fields.append(f"FS:{self._current_feed():.0f},0")
+        if self._report_count % 10 == 0:
+            fields.append("WCO:" + ",".join(f"{v:.3f}" for v in self._work_offset()))
+        if self._report_count % 10 == 1 or self._ov_changed:
+            fields.append(f"Ov:{self._feed_ovr},{self._rapid_ovr},{self._spindle_ovr}")
+            self._ov_changed = False
+        self._report_count += 1
+        return "<" + "|".join(fields) + ">"
+
+    def _work_offset(self):
+        # WCO as GRBL reports it: the coordinate system plus the G92 offset
+        return [a + b for a, b in zip(self.wco, self.g92)]
+
+    # ---- motion ----
+    def _current_mpos(self):
+        if self._planner and self._planner[0].profile is not None:
+            blk = self._planner[0]
+            return blk.position(profile_distance(blk.profile, blk.elapsed))
+        return list(self.mpos)
+
+    def _current_feed(self):
+        if self._hold or not self._planner or self._planner[0].profile is None:
+            return 0.0
+        blk = self._planner[0]
+        return profile_speed(blk.profile, blk.elapsed) * 60.0 * self._override_factor(blk)
+
+    def _override_factor(self, blk):
+        return (self._rapid_ovr if blk.rapid else self._feed_ovr) / 100.0
+
+    def _advance(self, dt):
+        while self._planner and not self._hold and dt > 0.0:
+            blk = self._planner[0]
+            if blk.profile is None:
+                self._begin_block(blk)
+            factor = self._override_factor(blk)
+            remaining = (profile_duration(blk.profile) - blk.elapsed) / factor
+            if dt >= remaining:
+                dt -= remaining
+                self.mpos = list(blk.end)
+                self._planner.popleft()
+            else:
+                blk.elapsed += dt * factor
+                dt = 0.0
+        if not self._planner:
+            self._plan_pos = None
+            if self._state in ("Run", "Jog"):
+                self._state = "Idle"
+        if self._state == "Home" and self._pending is None:
+            self._state = "Idle"
+
+    def _begin_block(self, blk):
+        # Freeze this block's profile: the exit speed is the fastest the rest
+        # of the queue can still stop from (backward pass), capped by the
+        # junction limit and by what is reachable from the entry speed.
+        deviation = float(self.settings[11])
+        v_next = 0.0
+        blocks = list(self._planner)
+        for nxt, cur in zip(reversed(blocks[1:]), reversed(blocks[:-1])):
+            v_junc = min(junction_speed(cur.u_end, nxt.u_start, min(cur.accel, nxt.accel), deviation),
+                         cur.v_nominal, nxt.v_nominal)
+            v_reach = math.sqrt(v_next ** 2 + 2.0 * nxt.accel * nxt.length)
+            v_next = min(v_junc, v_reach)
+        v_exit = min(v_next, math.sqrt(blk.v_entry ** 2 + 2.0 * blk.accel * blk.length))
+        blk.profile = trapezoid(blk.length, blk.v_nominal, blk.accel, blk.v_entry, v_exit)
+        if len(blocks) > 1:
+            blocks[1].v_entry = blk.profile.v_exit
+
+    def _queue_line(self, target, rapid, feed, jog=False, arc=None, inverse_time=None):
+        # inverse_time: the G93 F word, 1/min, which sets the feed per move
+        start = self._plan_pos or self._current_mpos()
+        delta = [t - s for t, s in zip(target, start)]
+        if inverse_time is not None:
+            if arc is not None:
+                feed = math.hypot(arc[2] * arc[4], delta[2]) * inverse_time
+            else:
+                feed = math.sqrt(sum(d * d for d in delta)) * inverse_time
+        if arc is not None:
+            cx, cy, radius, a0, sweep = arc
+            length = math.hypot(radius * sweep, delta[2])
+            sign = 1.0 if sweep > 0 else -1.0
+            a1 = a0 + sweep
+            u_start = (-math.sin(a0) * sign, math.cos(a0) * sign, 0.0)
+            u_end = (-math.sin(a1) * sign, math.cos(a1) * sign, 0.0)
+            # Limit speed and acceleration along the chord direction
+            _, v_nominal, accel = move_limits(
+                [u_start[0] + u_end[0], u_start[1] + u_end[1], delta[2] / length]
+                if abs(sweep) < math.pi else [1.0, 1.0, delta[2] / length],
+                None if rapid else feed, self.settings)
+        else:
+            length, v_nominal, accel = move_limits(delta, None if rapid else feed, self.settings)
+            if length == 0.0:
+                return
+            u_start = u_end = tuple(d / length for d in delta)
+        self._planner.append(_Block(list(start), list(target), length, v_nominal, accel,
+                                    u_start, u_end, rapid=rapid, jog=jog, arc=arc))
+        self._plan_pos = list(target)
+        if self._state == "Idle":
+            self._state = "Jog" if jog else "Run"
+
+    # ---- line processing ----
+    def _process_rx(self):
+        while True:
+            if self._pending is not None and not self._finish_pending():
+                return
+            if len(self._planner) >= self.planner_blocks:
+                return
+            ends = [i for i in (self._rx.find(b"\n"), self._rx.find(b"\r")) if i >= 0]
+            if not ends:
+                return
+            i = min(ends)
+            raw = self._rx[:i].decode("ascii", errors="replace")
+            del self._rx[:i + 1]
+            self.lines_received += 1
+            result = self._execute(raw)
+            if result is None:
+                continue
+            if result == 0:
+                self._emit("ok")
+            else:
+                self._emit(f"error:{result}")
+
+    def _finish_pending(self):
+        # G4 and $H reply only once the planner has drained (and the dwell ran)
+        kind, seconds = self._pending
+        if self._planner:
+            return False
+        if kind == "dwell":
+            now = time.monotonic()
+            if self._dwell_end is None:
+                self._dwell_end = now + seconds
+            if now < self._dwell_end:
+                return False
+            self._dwell_end = None
+        elif kind == "home":
+            self.mpos = [0.0, 0.0, 0.0]
+            self._state = "Idle"
+        self._pending = None
+        self._emit("ok")
+        return True
+
+    def _execute(self, raw):
+        line = "".join(re.sub(r"\([^)]*\)|;.*", "", raw).split()).upper()
+        if len(line) > LINE_BUFFER_SIZE:
+            return ERR_OVERFLOW
+        if not line:
+            return 0
+        if line[0] == "$":
+            return self._system_command(line)
+        if self._state == "Alarm":
+            return ERR_SYSTEM_GC_LOCK
+        return self._gcode(line)
+
+    def _system_command(self, line):
+        if line.startswith("$J="):
+            if self._state not in ("Idle", "Jog"):
+                return ERR_IDLE_ERROR
+            return self._gcode(line[3:], jog=True)
+        if self._state not in ("Idle", "Alarm"):
+            return ERR_IDLE_ERROR
+        if line == "$":
+            self._emit("[HLP:$$ $# $G $I $N $x=val $Nx=line $J=line $SLP $C $X $H ~ ! ? ctrl-x]")
+        elif line == "$$":
+            for key in sorted(self.settings):
+                val = self.settings[key]
+                self._emit(f"${key}={val:.3f}" if isinstance(val, float) else f"${key}={val}")
+        elif line == "$#":
+            self._emit("[G54:" + ",".join(f"{v:.3f}" for v in self.wco) + "]")
+            for g in ("G55", "G56", "G57", "G58", "G59", "G28", "G30", "G92"):
+                self._emit(f"[{g}:0.000,0.000,0.000]")
+            self._emit("[TLO:0.000]")
+            self._emit("[PRB:0.000,0.000,0.000:0]")
+        elif line == "$G":
+            m = self._modal
+            self._emit(f"[GC:{m['motion']} {m['wcs']} {m['plane']} {m['units']} "
+                       f"{m['distance']} {m['feed_mode']} M5 M9 T0 F{m['feed']:g} S0]")
+        elif line == "$I":
+            self._emit(f"[VER:{VERSION}.20190825:]")
+            self._emit(f"[OPT:V,{self.planner_blocks},{self.rx_buffer_size}]")
+        elif line == "$X":
+            if self._state == "Alarm":
+                self._emit("[MSG:Caution: Unlocked]")
+                self._state = "Idle"
+        elif line == "$H":
+            if not self.settings.get(22):
+                return ERR_SETTING_DISABLED
+            self._state = "Home"
+            self._queue_line([0.0, 0.0, 0.0], rapid=False, feed=float(self.settings[25]))
+            self._pending = ("home", None)
+            return None
+        elif line in ("$C", "$SLP") or line.startswith("$N"):
+            pass
+        elif re.fullmatch(r"\$\d+=[-+]?(\d+\.?\d*|\.\d+)", line):
+            key, val = line[1:].split("=")
+            self.settings[int(key)] = float(val) if "." in val else int(val)
+        else:
+            return ERR_INVALID_STATEMENT
+        return 0
+
+    def _gcode(self, line, jog=False):
+        words = []
+        pos = 0
+        for m in _WORD.finditer(line):
+            if m.start() != pos:
+                return ERR_EXPECTED_LETTER if not line[pos].isdigit() else ERR_BAD_NUMBER
+            words.append((m.group(1), float(m.group(2))))
+            pos = m.end()
+        if pos != len(line):
+            return ERR_BAD_NUMBER if line[pos] in "-+." or line[pos].isdigit() else ERR_EXPECTED_LETTER
+
+        modal = dict(self._modal)
+        motion = None
+        non_modal = None
+        values = {}
+        for letter, val in words:
+            if letter == "G":
+                code = f"G{val:g}"
+                if code in ("G0", "G1", "G2", "G3", "G80"):
+                    motion = code
+                elif code in ("G90", "G91"):
+                    modal["distance"] = code
+                elif code in ("G20", "G21"):
+                    modal["units"] = code
+                elif code in ("G54", "G55", "G56", "G57", "G58", "G59"):
+                    modal["wcs"] = code
+                elif code in ("G17", "G18", "G19"):
+                    modal["plane"] = code
+                elif code in ("G93", "G94"):
+                    modal["feed_mode"] = code
+                elif code in ("G4", "G10", "G53", "G92", "G92.1"):
+                    non_modal = code
+                elif code in ("G40", "G49", "G61"):
+                    pass
+                else:
+                    return ERR_UNSUPPORTED
+            elif letter == "M":
+                if val not in (0, 1, 2, 3, 4, 5, 7, 8, 9, 30):
+                    return ERR_UNSUPPORTED
+            elif letter in "XYZIJKRFPLSTN":
+                values[letter] = val
+            else:
+                return ERR_UNSUPPORTED
+
+        scale = 25.4 if modal["units"] == "G20" else 1.0
+        # In G93 the F word is the inverse time of its own line; back in G94
+        # the feed is undefined until the next F word
+        inverse = modal["feed_mode"] == "G93" and not jog
+        inverse_time = None
+        if inverse:
+            inverse_time = values.get("F")
+        elif "F" in values:
+            modal["feed"] = values["F"] * scale
+        elif self._modal["feed_mode"] == "G93":
+            modal["feed"] = 0.0
+
+        if non_modal == "G4":
+            self._modal = modal
+            dwell = values.get("P", 0.0)
+            self._pending = ("dwell", 0.0 if self.time_scale is None else dwell / self.time_scale)
+            return None
+        if non_modal == "G10":
+            if values.get("L") not in (2, 20) or int(values.get("P", 1)) != 1:
+                return ERR_UNSUPPORTED
+            cur = self._plan_pos or self._current_mpos()
+            for i, axis in enumerate(AXES):
+                if axis in values:
+                    v = values[axis] * scale
+                    self.wco[i] = v if values["L"] == 2 else cur[i] - self.g92[i] - v
+            self._modal = modal
+            # GRBL sends WCO with the next report after the offsets change
+            self._report_count = 0
+            return 0
+        if non_modal in ("G92", "G92.1"):
+            if non_modal == "G92.1":
+                self.g92 = [0.0, 0.0, 0.0]
+            elif not any(a in values for a in AXES):
+                return ERR_NO_AXIS_WORDS
+            else:
+                # The current position takes the given work coordinates
+                cur = self._plan_pos or self._current_mpos()
+                for i, axis in enumerate(AXES):
+                    if axis in values:
+                        self.g92[i] = cur[i] - self.wco[i] - values[axis] * scale
+            self._modal = modal
+            self._report_count = 0
+            return 0
+
+        if jog:
+            # $J= lines carry their own G90/G91 and F and leave modal state alone
+            if motion is not None or non_modal not in (None, "G53") or "F" not in values:
+                return ERR_INVALID_JOG
+            motion = "G1"
+            modal["feed"] = values["F"] * scale
+        elif motion is None and any(a in values for a in AXES):
+            motion = modal["motion"]
+        elif motion is not None:
+            modal["motion"] = motion
+        if motion in (None, "G80") or not any(a in values for a in AXES):
+            if not jog:
+                self._modal = modal
+            return 0
+        if motion != "G0" and not (inverse_time if inverse else modal["feed"] > 0.0):
+            return ERR_UNDEFINED_FEED
+
+        start = self._plan_pos or self._current_mpos()
+        target = list(start)
+        for i, axis in enumerate(AXES):
+            if axis not in values:
+                continue
+            v = values[axis] * scale
+            if non_modal == "G53":
+                target[i] = v
+            elif modal["distance"] == "G91":
+                target[i] = start[i] + v
+            else:
+                target[i] = v + self.wco[i] + self.g92[i]
+        arc = None
+        if motion in ("G2", "G3"):
+            arc = self._arc_geometry(start, target, values, scale, motion == "G2")
+            if arc is None:
+                return ERR_INVALID_TARGET
+        if not jog:
+            self._modal = modal
+        self._queue_line(target, rapid=motion == "G0", feed=modal["feed"], jog=jog, arc=arc,
+                         inverse_time=None if motion == "G0" else inverse_time)
+        return 0
+
+    def _arc_geometry(self, start, target, values, scale, clockwise):
+        x0, y0 = start[0], start[1]
+        x1, y1 = target[0], target[1]
+        if "R" in values:
+            r = values["R"] * scale
+            dx, dy = x1 - x0, y1 - y0
+            h2 = 4.0 * r * r - dx * dx - dy * dy
+            if h2 < 0.0:
+                return None
+            h = -math.sqrt(h2) / math.hypot(dx, dy)
+            if not clockwise:
+                h = -h
+            if r < 0:
+                h = -h
+            cx = x0 + 0.5 * (dx - dy * h)
+            cy = y0 + 0.5 * (dy + dx * h)
+        else:
+            cx = x0 + values.get("I", 0.0) * scale
+            cy = y0 + values.get("J", 0.0) * scale
+        radius = math.hypot(x0 - cx, y0 - cy)
+        if radius == 0.0:
+            return None
+        a0 = math.atan2(y0 - cy, x0 - cx)
+        a1 = math.atan2(y1 - cy, x1 - cx)
+        sweep = a1 - a0
+        if clockwise:
+            if sweep >= -1e-9:
+                sweep -= 2.0 * math.pi
+        elif sweep <= 1e-9:
+            sweep += 2.0 * math.pi
+        return (cx, cy, radius, a0, sweep)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Emulate a GRBL 1.1 controller on a pty.")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="simulated seconds per real second (0 = instant)")
+    parser.add_argument("--unlocked", action="store_true", help="boot in Idle instead of Alarm")
+    args = parser.parse_args()
+    emu = GrblEmulator(time_scale=args.time_scale or None, start_locked=not args.unlocked)
+    print(emu.start(), flush=True)
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        emu.stop()
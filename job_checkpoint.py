@@ -0,0 +1,236 @@
+"""
+Line-level checkpoints for long G-code jobs.
+
+While a job streams, every acknowledged line is appended to a checkpoint
+file as one JSON object: its index in the program, the tool position in
+work coordinates after it and, when it changed, the modal state (units,
+plane, distance and feed modes, work coordinate system, motion mode, feed,
+spindle and coolant). The file is append-only and is fsync'd in batches,
+so a crash loses at most the last batch and never corrupts earlier
+records; a torn final line is ignored when the file is read back.
+
+GRBL acknowledges a line when it enters the planner, not when it has run,
+so the last acknowledged line can be up to a planner's worth of moves
+ahead of the tool. Records of lines that take a planner block are marked,
+and load_checkpoint() resumes from the last line before the newest
+``blocks`` + SEGMENT_BLOCKS of those: the last one that certainly finished. The job is only
+marked done once the machine went Idle after it. ModalState.restore_lines()
+gives the G-code that re-establishes the state before the job continues.
+"""
+import json
+import logging
+import os
+import re
+import time
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# index: last line certainly executed (-1 before the first), with the
+# position and modal state after it; source: the file the job streams from,
+# if any; done: the job ran to the end; acked: last acknowledged line
+Checkpoint = namedtuple("Checkpoint", "index position modal source done acked")
+
+# GRBL 1.1's default planner buffer
+PLANNER_BLOCKS = 15
+# GRBL drops a block from the planner once its last step segment is
+# prepared; each of the 6 segments queued for the stepper may still be
+# the tail of a different short block
+SEGMENT_BLOCKS = 6
+
+_WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_COMMENT = re.compile(r"\([^)]*\)|;.*")
+
+# Modal group of each G/M code worth restoring
+_G_GROUPS = {
+    0.0: "motion", 1.0: "motion", 2.0: "motion", 3.0: "motion", 80.0: "motion",
+    17.0: "plane", 18.0: "plane", 19.0: "plane",
+    20.0: "units", 21.0: "units",
+    90.0: "distance", 91.0: "distance",
+    93.0: "feed_mode", 94.0: "feed_mode",
+    54.0: "wcs", 55.0: "wcs", 56.0: "wcs", 57.0: "wcs", 58.0: "wcs", 59.0: "wcs",
+}
+_M_GROUPS = {3.0: "spindle", 4.0: "spindle", 5.0: "spindle",
+             7.0: "coolant", 8.0: "coolant", 9.0: "coolant"}
+_SETUP_GROUPS = ("units", "plane", "wcs")
+
+
+class ModalState:
+    """G-code modal state followed line by line."""
+
+    def __init__(self, state=None):
+        self.state = dict(state or {})
+
+    def update(self, raw):
+        # Returns True if the line changed anything
+        line = _COMMENT.sub("", raw or "").strip().upper()
+        if not line or line[0] == "$":
+            return False
+        changed = False
+        for letter, num in _WORD.findall(line):
+            value = float(num)
+            if letter == "G":
+                group, word = _G_GROUPS.get(value), f"G{value:g}"
+            elif letter == "M":
+                group, word = _M_GROUPS.get(value), f"M{value:g}"
+                if value in (2.0, 30.0):
+                    # Program end resets spindle and coolant
+                    for key in ("spindle", "coolant"):
+                        changed |= self.state.pop(key, None) is not None
+                    continue
+            elif letter in "FS":
+                group, word = letter, f"{letter}{value:g}"
+            else:
+                continue
+            if group is not None and self.state.get(group) != word:
+                self.state[group] = word
+                changed = True
+        return changed
+
+    def restore_lines(self):
+        """
+        (before, after): G-code for before the recovery move (units, plane,
+        WCS, spindle and coolant, and G94, as that move runs at a normal
+        feed) and after it (distance and feed modes, motion mode and feed).
+        """
+        s = self.state
+        before = [" ".join([s[g] for g in _SETUP_GROUPS if g in s] + ["G94"])]
+        if s.get("spindle") in ("M3", "M4"):
+            before.append(" ".join([s["spindle"]] + ([s["S"]] if "S" in s else [])))
+        if s.get("coolant"):
+            before.append(s["coolant"])
+        after = [s.get("distance", "G90")]
+        if "feed_mode" in s:
+            after.append(s["feed_mode"])
+        # G2/G3 need axis words, so only a linear motion mode is restored
+        if s.get("motion") in ("G0", "G1"):
+            after.append(s["motion"])
+        if "F" in s:
+            after.append(s["F"])
+        return before, [" ".join(after)]
+
+
+class Checkpointer:
+    """
+    Append-only checkpoint writer for one job starting at ``position``
+    with a ``blocks``-block planner. pulled() follows each line as it is
+    handed to the streamer and sets ``current``, the mark the streamer
+    keeps with the line; acked() records a mark once GRBL has acknowledged
+    its line. fsync happens every ``every`` records or ``interval_s``
+    seconds, whichever comes first.
+    """
+
+    def __init__(self, path, source=None, start_index=0, modal=None, position=None,
+                 blocks=PLANNER_BLOCKS, every=200, interval_s=1.0):
+        self.path = os.fspath(path)
+        self.modal = ModalState(modal)
+        self.index = start_index - 1
+        self.current = None
+        self.every = every
+        self.interval_s = interval_s
+        # Snapshots are replaced, never mutated, so a mark can hold one and
+        # acked() can tell by identity whether it still needs writing
+        self._snapshot = dict(self.modal.state)
+        self._written = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # A fresh job starts a fresh file; a resumed one appends to it
+        self._f = open(self.path, "a" if start_index else "w", encoding="utf-8")
+        self._write({"start": start_index, "source": None if source is None else os.fspath(source),
+                     "pos": list(position or (None, None, None)), "modal": self._snapshot,
+                     "blocks": blocks})
+        self._written = self._snapshot
+        self._sync()
+
+    def pulled(self, raw, position, planned=False):
+        # planned: the line takes a planner block (it moves or dwells)
+        self.index += 1
+        if self.modal.update(raw):
+            self._snapshot = dict(self.modal.state)
+        self.current = (self.index, list(position), self._snapshot, planned)
+
+    def acked(self, mark):
+        index, position, modal, planned = mark
+        rec = {"line": index, "pos": position}
+        if planned:
+            rec["planned"] = True
+        if modal is not self._written:
+            rec["modal"] = modal
+            self._written = modal
+        self._write(rec)
+        self._unsynced += 1
+        if self._unsynced >= self.every or time.monotonic() - self._last_sync >= self.interval_s:
+            self._sync()
+
+    def finish(self):
+        self._write({"done": True})
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._sync()
+        self._f.close()
+
+    def _write(self, rec):
+        self._f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+
+def load_checkpoint(path):
+    """
+    Read back from ``path`` the last line that certainly finished, with the
+    state after it: the acknowledged line before the newest ``blocks`` +
+    SEGMENT_BLOCKS that took a planner block, as those may not have run
+    yet.
+    """
+    # recent[0] is the resume point, followed by the acknowledged lines
+    # after it; ``pending`` counts the planned ones among those
+    recent = deque()
+    pending = 0
+    blocks = PLANNER_BLOCKS + SEGMENT_BLOCKS
+    acked = -1
+    modal = {}
+    source = None
+    done = False
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            try:
+                rec = json.loads(raw)
+            except ValueError:
+                # Torn write from a crash mid-record
+                logger.warning("Skipping damaged checkpoint record in %s.", path)
+                continue
+            if "start" in rec:
+                if rec.get("source") is not None:
+                    source = rec["source"]
+                modal = rec.get("modal", modal)
+                blocks = rec.get("blocks", PLANNER_BLOCKS) + SEGMENT_BLOCKS
+                acked = rec["start"] - 1
+                recent = deque([(acked, rec.get("pos", [None, None, None]), modal, False)])
+                pending = 0
+                done = False
+            elif "line" in rec:
+                modal = rec.get("modal", modal)
+                acked = rec["line"]
+                recent.append((acked, rec["pos"], modal, rec.get("planned", False)))
+                pending += rec.get("planned", False)
+                while pending > blocks:
+                    recent.popleft()
+                    pending -= recent[0][3]
+            elif rec.get("done"):
+                done = True
+    if not recent:
+        return Checkpoint(-1, [None, None, None], {}, source, done, acked)
+    if done:
+        index, position, modal, _ = recent[-1]
+    else:
+        # Lines that took no planner block ran when they were acknowledged
+        while len(recent) > 1 and not recent[1][3]:
+            recent.popleft()
+        index, position, modal, _ = recent[0]
+    return Checkpoint(index, position, modal, source, done, acked)
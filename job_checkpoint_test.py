@@ -0,0 +1,29 @@
+"""
+Unit tests for job checkpoints. Run with ``python -m pytest -q``.
+"""
+from job_checkpoint import ModalState
+
+
+def modal_after(*lines):
+    state = ModalState()
+    for line in lines:
+        state.update(line)
+    return state
+
+
+def test_recovery_move_runs_in_units_per_minute():
+    before, after = modal_after("G21 G17 G55 G91", "M3 S1000", "M8",
+                                "G93 G1 X1 F30").restore_lines()
+    # G93 would make the recovery move's F an inverse time
+    assert before == ["G21 G17 G55 G94", "M3 S1000", "M8"]
+    assert after == ["G91 G93 G1 F30"]
+
+
+def test_restore_without_state():
+    before, after = ModalState().restore_lines()
+    assert before == ["G94"]
+    assert after == ["G90"]
+    before, after = modal_after("G20 G94 G2 X1 Y1 I1 F200", "M5", "M30").restore_lines()
+    # Arcs need axis words and program end stops the spindle
+    assert before == ["G20 G94"]
+    assert after == ["G90 G94 F200"]
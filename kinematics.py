@@ -0,0 +1,438 @@
+"""
+Motion timing helpers shared by the GRBL emulator, the virtual machine and
+the G-code duration estimator.
+Units follow GRBL: positions in mm, feeds in mm/min, accelerations in mm/s^2.
+"""
+import math
+import re
+from collections import namedtuple
+
+import numpy as np
+
+AXES = ("X", "Y", "Z")
+
+# GRBL settings used for motion timing ($11 junction deviation, $100-$102
+# steps/mm, $110-$112 max rates, $120-$122 accelerations). Values suit the
+# small Genmitsu machines this package targets; read the real ones with $$.
+DEFAULT_SETTINGS = {
+    11: 0.010, 12: 0.002,
+    100: 800.0, 101: 800.0, 102: 800.0,
+    110: 3000.0, 111: 3000.0, 112: 1000.0,
+    120: 200.0, 121: 200.0, 122: 100.0,
+}
+
+Profile = namedtuple(
+    "Profile", "length v_entry v_peak v_exit accel t_accel t_cruise t_decel"
+)
+
+
+def axis_limits(settings=None):
+    """Per-axis (max rate in mm/s, acceleration in mm/s^2) from GRBL settings."""
+    s = dict(DEFAULT_SETTINGS)
+    s.update(settings or {})
+    rates = tuple(float(s[110 + i]) / 60.0 for i in range(len(AXES)))
+    accels = tuple(float(s[120 + i]) for i in range(len(AXES)))
+    return rates, accels
+
+
+def move_limits(delta, feed=None, settings=None):
+    """
+    Length, nominal speed (mm/s) and acceleration for a straight move.
+    ``feed`` is in mm/min; None means a rapid (G0) limited only by max rates.
+    """
+    length = math.sqrt(sum(d * d for d in delta))
+    if length == 0.0:
+        return 0.0, 0.0, 0.0
+    rates, accels = axis_limits(settings)
+    speed = math.inf if feed is None else float(feed) / 60.0
+    accel = math.inf
+    for d, rate, acc in zip(delta, rates, accels):
+        u = abs(d) / length
+        if u > 0.0:
+            speed = min(speed, rate / u)
+            accel = min(accel, acc / u)
+    return length, speed, accel
+
+
+def trapezoid(length, v_nominal, accel, v_entry=0.0, v_exit=0.0):
+    """Trapezoidal (or triangular) velocity profile covering ``length``."""
+    if length <= 0.0 or v_nominal <= 0.0:
+        return Profile(0.0, 0.0, 0.0, 0.0, accel, 0.0, 0.0, 0.0)
+    v_entry = min(v_entry, v_nominal)
+    v_exit = min(v_exit, v_nominal)
+    d_accel = (v_nominal ** 2 - v_entry ** 2) / (2.0 * accel)
+    d_decel = (v_nominal ** 2 - v_exit ** 2) / (2.0 * accel)
+    if d_accel + d_decel <= length:
+        v_peak = v_nominal
+        cruise = length - d_accel - d_decel
+    else:
+        v_peak = math.sqrt(max(accel * length + (v_entry ** 2 + v_exit ** 2) / 2.0,
+                               max(v_entry, v_exit) ** 2))
+        cruise = 0.0
+    return Profile(
+        length, v_entry, v_peak, v_exit, accel,
+        (v_peak - v_entry) / accel, cruise / v_peak, (v_peak - v_exit) / accel,
+    )
+
+
+def profile_duration(p):
+    return p.t_accel + p.t_cruise + p.t_decel
+
+
+def profile_distance(p, t):
+    """Distance covered ``t`` seconds into profile ``p``."""
+    if t <= 0.0:
+        return 0.0
+    if t < p.t_accel:
+        return p.v_entry * t + 0.5 * p.accel * t * t
+    d = p.v_entry * p.t_accel + 0.5 * p.accel * p.t_accel ** 2
+    t -= p.t_accel
+    if t < p.t_cruise:
+        return d + p.v_peak * t
+    d += p.v_peak * p.t_cruise
+    t -= p.t_cruise
+    if t < p.t_decel:
+        return min(p.length, d + p.v_peak * t - 0.5 * p.accel * t * t)
+    return p.length
+
+
+def profile_speed(p, t):
+    """Speed in mm/s ``t`` seconds into profile ``p``."""
+    if t <= 0.0:
+        return p.v_entry
+    if t >= profile_duration(p):
+        return p.v_exit
+    if t < p.t_accel:
+        return p.v_entry + p.accel * t
+    if t < p.t_accel + p.t_cruise:
+        return p.v_peak
+    return max(p.v_exit, p.v_peak - p.accel * (t - p.t_accel - p.t_cruise))
+
+
+def junction_speed(u_prev, u_next, accel, deviation):
+    """
+    GRBL's junction-deviation limit (mm/s) for the corner between two moves
+    with unit directions ``u_prev`` and ``u_next``.
+    """
+    cos_theta = -sum(a * b for a, b in zip(u_prev, u_next))
+    if cos_theta > 0.999999:
+        return 0.0
+    if cos_theta < -0.999999:
+        return math.inf
+    sin_half = math.sqrt(0.5 * (1.0 - cos_theta))
+    return math.sqrt(accel * deviation * sin_half / (1.0 - sin_half))
+
+
+def parse_grbl_settings(text):
+    """Settings dict from ``$$`` output lines such as ``$110=3000.000``."""
+    lines = text.splitlines() if isinstance(text, str) else text
+    settings = {}
+    for line in lines:
+        m = re.match(r"\s*\$(\d+)=([-+]?[0-9.]+)", line)
+        if m:
+            settings[int(m.group(1))] = float(m.group(2))
+    return settings
+
+
+_WORD = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_COMMENT = re.compile(r"\([^)]*\)|;.*")
+
+
+def _arc_points(start, end, offset, clockwise, tolerance):
+    # Chord points GRBL's mc_arc would produce for an XY-plane arc
+    cx, cy = start[0] + offset[0], start[1] + offset[1]
+    radius = math.hypot(start[0] - cx, start[1] - cy)
+    a0 = math.atan2(start[1] - cy, start[0] - cx)
+    a1 = math.atan2(end[1] - cy, end[0] - cx)
+    sweep = a1 - a0
+    if clockwise and sweep >= -1e-9:
+        sweep -= 2.0 * math.pi
+    elif not clockwise and sweep <= 1e-9:
+        sweep += 2.0 * math.pi
+    if radius <= tolerance:
+        return [end]
+    n = max(1, int(abs(sweep) * radius / math.sqrt(tolerance * (2.0 * radius - tolerance))))
+    ang = a0 + sweep * np.arange(1, n + 1) / n
+    pts = np.empty((n, 3))
+    pts[:, 0] = cx + radius * np.cos(ang)
+    pts[:, 1] = cy + radius * np.sin(ang)
+    pts[:, 2] = start[2] + (end[2] - start[2]) * np.arange(1, n + 1) / n
+    pts[-1] = end
+    return pts.tolist()
+
+
+def _parse_motion(lines, start, wco, arc_tolerance):
+    # Flatten G-code into straight segments: per segment the end point, feed
+    # (NaN for rapids), source line and whether the planner stops before it;
+    # plus per-line dwell seconds. Runs once per line, so kept lean.
+    wx, wy, wz = (float(o) for o in wco)
+    pos = [float(start[0]) + wx, float(start[1]) + wy, float(start[2]) + wz]
+    ends, feeds, owners, stops, dwells = [], [], [], [], {}
+    motion, relative, scale, feed = 0, False, 1.0, 0.0
+    stop_next = True
+    findall = _WORD.findall
+    for idx, raw in enumerate(lines):
+        if "(" in raw or ";" in raw:
+            raw = _COMMENT.sub("", raw)
+        line = raw.strip().upper()
+        if not line:
+            continue
+        if line[0] == "$":
+            if line == "$H":
+                pos = [0.0, 0.0, 0.0]
+            stop_next = True
+            continue
+        x = y = z = None
+        machine = dwell = skip = False
+        p = i_off = j_off = 0.0
+        for letter, num in findall(line):
+            if letter == "X":
+                x = float(num)
+            elif letter == "Y":
+                y = float(num)
+            elif letter == "Z":
+                z = float(num)
+            elif letter == "F":
+                feed = float(num)
+            elif letter == "G":
+                g = float(num)
+                if g <= 3.0 and g == int(g):
+                    motion = int(g)
+                elif g == 90.0:
+                    relative = False
+                elif g == 91.0:
+                    relative = True
+                elif g == 53.0:
+                    machine = True
+                elif g == 4.0:
+                    dwell = True
+                elif g == 21.0:
+                    scale = 1.0
+                elif g == 20.0:
+                    scale = 25.4
+                elif g in (10.0, 28.0, 30.0, 92.0):
+                    skip = True
+            elif letter == "I":
+                i_off = float(num)
+            elif letter == "J":
+                j_off = float(num)
+            elif letter == "P":
+                p = float(num)
+        if dwell:
+            dwells[idx] = p
+            stop_next = True
+            continue
+        if skip or (x is None and y is None and z is None):
+            continue
+        target = list(pos)
+        for i, val, off in ((0, x, wx), (1, y, wy), (2, z, wz)):
+            if val is None:
+                continue
+            val *= scale
+            if machine:
+                target[i] = val
+            elif relative:
+                target[i] = pos[i] + val
+            else:
+                target[i] = val + off
+        seg_feed = math.nan if motion == 0 else feed * scale
+        if motion >= 2:
+            pts = _arc_points(pos, target, (i_off * scale, j_off * scale),
+                              motion == 2, arc_tolerance)
+            for pt in pts:
+                ends.append(pt)
+                feeds.append(seg_feed)
+                owners.append(idx)
+                stops.append(stop_next)
+                stop_next = False
+        else:
+            ends.append(target)
+            feeds.append(seg_feed)
+            owners.append(idx)
+            stops.append(stop_next)
+            stop_next = False
+        pos = target
+    return ends, feeds, owners, stops, dwells
+
+
+def estimate_gcode_duration(gcode, settings=None, start=(0.0, 0.0, 0.0), wco=(0.0, 0.0, 0.0)):
+    """
+    Predict how long GRBL takes to execute ``gcode`` (a blob or an iterable of
+    lines) using its acceleration-limited trapezoid planner with junction
+    deviation. Rates and accelerations come from ``settings`` ($11, $12,
+    $110-$112, $120-$122; see parse_grbl_settings), falling back to
+    DEFAULT_SETTINGS. ``start`` is the work position before the first line
+    and ``wco`` the work coordinate offset used to place G53 moves.
+
+    Returns ``(timestamps, total)``: for every input line the time in seconds
+    at which it has finished executing, and the total program time.
+    """
+    lines = gcode.splitlines() if isinstance(gcode, str) else list(gcode)
+    s = dict(DEFAULT_SETTINGS)
+    s.update(settings or {})
+    origin = np.asarray(start, dtype=float) + np.asarray(wco, dtype=float)
+    ends, feeds, owners, stops, dwells = _parse_motion(lines, start, wco, float(s[12]))
+
+    per_line = np.zeros(len(lines))
+    if ends:
+        seg_t = _plan_segment_times(origin, np.asarray(ends, dtype=float),
+                                    np.asarray(feeds, dtype=float),
+                                    np.asarray(stops, dtype=bool), s)
+        per_line += np.bincount(np.asarray(owners), weights=seg_t, minlength=len(lines))
+    for idx, seconds in dwells.items():
+        per_line[idx] += seconds
+    timestamps = np.cumsum(per_line)
+    total = float(timestamps[-1]) if len(timestamps) else 0.0
+    return timestamps, total
+
+
+def _plan_segment_times(origin, ends, feeds, stops, s):
+    rates, accels = axis_limits(s)
+    rates = np.asarray(rates)
+    accels = np.asarray(accels)
+    starts = np.vstack([origin, ends[:-1]])
+    delta = ends - starts
+    length = np.sqrt((delta * delta).sum(axis=1))
+    moving = length > 0.0
+    times = np.zeros(len(ends))
+    if not moving.any():
+        return times
+    # Zero-length segments take no time, but a planner stop flagged on one
+    # still applies to the next segment that moves
+    idx = np.flatnonzero(moving)
+    stop_count = np.cumsum(stops)
+    stop = np.diff(np.concatenate([[0], stop_count[idx]])) > 0
+    stop[0] = True
+    L = length[idx]
+    U = delta[idx] / L[:, None]
+
+    absu = np.abs(U)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        v_axis = np.where(absu > 0.0, rates / absu, np.inf).min(axis=1)
+        a = np.where(absu > 0.0, accels / absu, np.inf).min(axis=1)
+    feed = feeds[idx] / 60.0
+    v_nom = np.where(np.isnan(feed), v_axis, np.minimum(feed, v_axis))
+    v_nom = np.where(v_nom > 0.0, v_nom, v_axis)
+
+    # Junction limits (squared) at the start of each segment
+    n = len(L)
+    J = np.zeros(n + 1)
+    if n > 1:
+        cos_t = -(U[:-1] * U[1:]).sum(axis=1)
+        sin_half = np.sqrt(np.clip(0.5 * (1.0 - cos_t), 0.0, 1.0))
+        a_j = np.minimum(a[:-1], a[1:])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vj2 = np.where(sin_half < 1.0, a_j * float(s[11]) * sin_half / (1.0 - sin_half), 0.0)
+        vj2 = np.where(cos_t < -0.999999, np.inf, vj2)
+        vj2 = np.where(cos_t > 0.999999, 0.0, vj2)
+        J[1:n] = np.minimum(vj2, np.minimum(v_nom[:-1], v_nom[1:]) ** 2)
+    J[:n][stop] = 0.0
+
+    # Backward then forward pass, both closed-form via running minima:
+    # B_k = min_{j>=k}(J_j + S_j) - S_k and F_k = S_k + min_{j<=k}(B_j - S_j)
+    c = 2.0 * a * L
+    S = np.concatenate([[0.0], np.cumsum(c)])
+    B = np.minimum.accumulate((J + S)[::-1])[::-1] - S
+    F = S + np.minimum.accumulate(B - S)
+    v2 = np.maximum(F, 0.0)
+    v0 = np.sqrt(v2[:-1])
+    v1 = np.sqrt(v2[1:])
+
+    d_acc = (v_nom ** 2 - v0 ** 2) / (2.0 * a)
+    d_dec = (v_nom ** 2 - v1 ** 2) / (2.0 * a)
+    cruise = L - d_acc - d_dec
+    v_peak = np.where(cruise >= 0.0, v_nom,
+                      np.sqrt(np.maximum(a * L + 0.5 * (v0 ** 2 + v1 ** 2), np.maximum(v0, v1) ** 2)))
+    t = (v_peak - v0) / a + (v_peak - v1) / a + np.maximum(cruise, 0.0) / v_nom
+    times[idx] = t
+    return times
+
+
+class LineTimer:
+    """
+    Upper bound on how long GRBL takes to execute each line, one line at a
+    time, for ack deadlines. Every move starts and ends at rest, an arc is
+    taken as its full circle, an axis whose start or end is unknown is
+    assumed to cross its whole travel (``spans``, mm), dwells count in full
+    and $H gets ``homing_s``. A G1 before any F word is timed at
+    ``default_feed``. The feed, feed mode and motion mode carry over from
+    line to line. ``kind`` tells which override scales the last estimate:
+    "feed", "rapid" or None (dwells, homing and jogs, which GRBL does not
+    override).
+    """
+
+    def __init__(self, settings=None, spans=(300.0, 300.0, 100.0), homing_s=60.0,
+                 default_feed=100.0):
+        self.settings = settings
+        self.spans = spans
+        self.homing_s = homing_s
+        self.feed = default_feed
+        self.inverse_time = False
+        self.motion = "G0"
+        self.kind = None
+
+    def estimate(self, raw, start, end):
+        """Seconds for ``raw`` taking the tool from ``start`` to ``end``."""
+        self.kind = None
+        line = _COMMENT.sub("", raw or "").strip().upper().replace(" ", "")
+        if not line:
+            return 0.0
+        if line.startswith("$"):
+            if line == "$H":
+                return self.homing_s
+            if not line.startswith("$J="):
+                return 0.0
+            # A jog is a G1 whose feed does not carry over
+            saved = self.feed, self.motion
+            self.motion = "G1"
+            try:
+                return self.estimate(line[3:], start, end)
+            finally:
+                self.feed, self.motion = saved
+                self.kind = None
+        motion = self.motion
+        dwell = 0.0
+        seen = set()
+        radius = None
+        for letter, num in _WORD.findall(line):
+            value = float(num)
+            if letter == "G":
+                if value in (0.0, 1.0, 2.0, 3.0):
+                    motion = self.motion = f"G{value:g}"
+                elif value in (38.2, 38.3, 38.4, 38.5, 28.0, 30.0):
+                    motion = "G1" if value >= 38.0 else "G0"
+                elif value == 93.0:
+                    self.inverse_time = True
+                elif value == 94.0:
+                    self.inverse_time = False
+                elif value == 4.0:
+                    motion = "G4"
+            elif letter == "F":
+                self.feed = value
+            elif letter == "P" and motion == "G4":
+                dwell = value
+            elif letter in AXES:
+                seen.add(AXES.index(letter))
+            elif letter in "IJK":
+                radius = math.hypot(radius or 0.0, value)
+            elif letter == "R":
+                radius = abs(value)
+        if motion == "G4":
+            return dwell
+        if not seen:
+            return 0.0
+        delta = [0.0, 0.0, 0.0]
+        for i in seen:
+            s, e = start[i], end[i]
+            delta[i] = self.spans[i] if s is None or e is None else e - s
+        if motion in ("G2", "G3") and radius is not None:
+            # Unknown sweep: a full circle in the plane plus the helix
+            delta = [2.0 * math.pi * radius, 0.0, abs(delta[2])]
+        feed = None if motion == "G0" else self.feed
+        length, v_nominal, accel = move_limits(delta, feed, self.settings)
+        if length == 0.0:
+            return 0.0
+        if feed is not None and self.inverse_time and feed > 0.0:
+            v_nominal = min(v_nominal, length * feed / 60.0)
+        self.kind = "rapid" if feed is None else "feed"
+        return profile_duration(trapezoid(length, v_nominal, accel))
@@ -0,0 +1,78 @@
+"""
+Unit tests for the motion timing helpers. Run with ``python -m pytest -q``.
+"""
+import math
+
+import pytest
+
+from kinematics import DEFAULT_SETTINGS, LineTimer, estimate_gcode_duration
+
+
+def trapezoid_s(length, feed, accel=200.0):
+    # A move from rest to rest reaching ``feed`` (mm/min)
+    v = feed / 60.0
+    return length / v + v / accel
+
+
+def test_single_move_is_a_trapezoid():
+    timestamps, total = estimate_gcode_duration("G90\nG1 X100 F3000\n")
+    assert total == pytest.approx(trapezoid_s(100.0, 3000.0))
+    assert timestamps.tolist() == pytest.approx([0.0, total])
+
+
+def test_rapids_run_at_the_axis_max_rate():
+    _, total = estimate_gcode_duration("G0 Z-50\n")
+    assert total == pytest.approx(trapezoid_s(50.0, DEFAULT_SETTINGS[112], accel=100.0))
+
+
+def test_collinear_segments_do_not_slow_down():
+    split = "\n".join(f"G1 X{10 * (i + 1)} F3000" for i in range(10))
+    assert estimate_gcode_duration(split)[1] == pytest.approx(
+        estimate_gcode_duration("G1 X100 F3000")[1])
+
+
+def test_corners_slow_down_by_junction_deviation():
+    _, corner = estimate_gcode_duration("G1 X50 F3000\nG1 Y50\n")
+    stop = 2 * trapezoid_s(50.0, 3000.0)
+    straight = trapezoid_s(100.0, 3000.0)
+    assert straight < corner < stop
+    # A larger junction deviation takes the corner faster
+    _, loose = estimate_gcode_duration("G1 X50 F3000\nG1 Y50\n", {11: 0.1})
+    assert loose < corner
+
+
+def test_dwells_and_per_line_timestamps():
+    timestamps, total = estimate_gcode_duration(["G1 X10 F600", "G4 P1.5", "(note)", "G1 X0"])
+    move = trapezoid_s(10.0, 600.0)
+    assert timestamps.tolist() == pytest.approx([move, move + 1.5, move + 1.5, total])
+    assert total == pytest.approx(2 * move + 1.5)
+
+
+def test_relative_and_machine_coordinates():
+    absolute = estimate_gcode_duration("G90\nG1 X30 F1200\nG1 X60\n")[1]
+    relative = estimate_gcode_duration("G91\nG1 X30 F1200\nG1 X30\n")[1]
+    assert relative == pytest.approx(absolute)
+    # G53 targets are machine coordinates: from work X0 with WCO X-20 to
+    # machine X10 is 30 mm
+    machine = estimate_gcode_duration("G53 G1 X10 F1200", start=(0, 0, 0), wco=(-20, 0, 0))[1]
+    assert machine == pytest.approx(trapezoid_s(30.0, 1200.0))
+
+
+def test_arcs_follow_their_length():
+    # Half a circle of radius 10 at a feed far below the cornering limits
+    _, total = estimate_gcode_duration("G17 G90\nG2 X20 Y0 I10 J0 F120\n")
+    assert total == pytest.approx(trapezoid_s(math.pi * 10.0, 120.0), rel=1e-3)
+
+
+def test_line_timer_names_the_override_that_scales_it():
+    timer = LineTimer()
+    pos = (0.0, 0.0, 0.0)
+    kinds = []
+    for line, end in (("G0 X10", (10.0, 0.0, 0.0)), ("G1 X0 F600", (0.0, 0.0, 0.0)),
+                      ("G4 P1", None), ("$J=G91 X5 F600", (5.0, 0.0, 0.0)), ("$H", None),
+                      ("G90", None)):
+        end = end or pos
+        kinds.append((timer.estimate(line, pos, end) > 0.0, timer.kind))
+        pos = end
+    assert kinds == [(True, "rapid"), (True, "feed"), (True, None), (True, None),
+                     (True, None), (False, None)]
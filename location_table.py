@@ -0,0 +1,421 @@
+"""
+Compiled location tables.
+
+The locations YAML describes each location by an origin, a grid size and
+offsets. compile_locations() turns it into one (M, 3) array holding every
+position of every location, plus a name -> slot index, so lookups are a
+dict hit and an array index. load_location_table() caches the compiled
+table next to the YAML file, keyed by the file's size, mtime and SHA-256,
+and rebuilds it whenever the file changes. LocationWatcher reports edits
+to the file (inotify on Linux, stat polling elsewhere).
+
+Locations may carry a ``clearance_z`` (work Z that clears whatever sits in
+their footprint, the grid padded by half a pitch) and the reserved
+top-level ``keep_out_zones`` list adds deck obstacles as
+x_min/x_max/y_min/y_max/clearance_z rectangles. Both become obstacle
+rectangles used by LocationTable.travel_height(), which only answers for
+paths lying entirely within them.
+"""
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import json
+import logging
+import os
+import select
+import struct
+import threading
+from collections import namedtuple
+
+import numpy as np
+import yaml
+
+CACHE_VERSION = 3
+
+# Reserved top-level key holding deck obstacles rather than a location
+KEEP_OUT_ZONES = "keep_out_zones"
+
+# First row in LocationTable.positions, grid width and number of positions
+Slot = namedtuple("Slot", "start num_x count")
+
+logger = logging.getLogger(__name__)
+
+
+class LocationTable:
+    """Every position of every location, indexed by name and location index."""
+
+    __slots__ = ("raw", "names", "positions", "starts", "widths", "counts", "slots",
+                 "obstacles")
+
+    def __init__(self, raw, names, positions, starts, widths, counts, obstacles=None):
+        self.raw = raw
+        self.names = list(names)
+        self.positions = positions
+        self.starts = starts
+        self.widths = widths
+        self.counts = counts
+        # (K, 5) rows of x_min, x_max, y_min, y_max, clearance_z
+        self.obstacles = np.empty((0, 5)) if obstacles is None else obstacles
+        self.slots = {
+            name: Slot(int(s), int(w), int(c))
+            for name, s, w, c in zip(self.names, starts, widths, counts)
+        }
+
+    def __contains__(self, name):
+        return name in self.slots
+
+    def __len__(self):
+        return len(self.names)
+
+    def slot(self, name):
+        try:
+            return self.slots[name]
+        except KeyError:
+            raise KeyError(f"Unknown location '{name}'") from None
+
+    def position(self, name, index=None):
+        # None or a negative index means the location origin, as it always has
+        slot = self.slot(name)
+        if index is None or index < 0:
+            index = 0
+        if index >= slot.count:
+            raise KeyError(f"Location '{name}' has indices 0..{slot.count - 1}; got {index}")
+        x, y, z = self.positions[slot.start + index].tolist()
+        return x, y, z
+
+    def positions_of(self, name, indices=None):
+        slot = self.slot(name)
+        if indices is None:
+            return self.positions[slot.start:slot.start + slot.count].copy()
+        idx = np.asarray(indices, dtype=np.int64).reshape(-1)
+        bad = (idx < 0) | (idx >= slot.count)
+        if bad.any():
+            raise KeyError(
+                f"Location '{name}' has indices 0..{slot.count - 1}; "
+                f"out of range: {np.unique(idx[bad]).tolist()}"
+            )
+        return self.positions[slot.start + idx]
+
+    def travel_height(self, start, end):
+        """
+        Lowest Z clearing every obstacle the straight XY path from ``start``
+        to ``end`` crosses, or None (the caller should then retract fully)
+        unless the whole path lies in regions with a declared clearance:
+        what is outside every region is unknown, not free.
+        """
+        ob = self.obstacles
+        (x0, y0), (x1, y1) = start[:2], end[:2]
+        # Liang-Barsky clip of the segment against every rectangle at once
+        t0 = np.zeros(len(ob)); t1 = np.ones(len(ob))
+        hit = np.ones(len(ob), dtype=bool)
+        for p, d, lo, hi in ((x0, x1 - x0, ob[:, 0], ob[:, 1]), (y0, y1 - y0, ob[:, 2], ob[:, 3])):
+            if d == 0.0:
+                hit &= (lo <= p) & (p <= hi)
+                continue
+            ta = (lo - p) / d; tb = (hi - p) / d
+            t0 = np.maximum(t0, np.minimum(ta, tb))
+            t1 = np.minimum(t1, np.maximum(ta, tb))
+        hit &= t0 <= t1
+        if not _spans(t0[hit], t1[hit]):
+            return None
+        return float(ob[hit, 4].max())
+
+
+def _spans(t0, t1, eps=1e-9):
+    # True if the intervals [t0, t1] together cover [0, 1]
+    reach = 0.0
+    for lo, hi in sorted(zip(t0.tolist(), t1.tolist())):
+        if lo > reach + eps:
+            return False
+        reach = max(reach, hi)
+    return reach >= 1.0 - eps
+
+
+_ZONE_KEYS = ("x_min", "x_max", "y_min", "y_max", "clearance_z")
+_LOCATION_KEYS = {"x_origin", "y_origin", "z_origin", "num_x", "num_y", "x_offset", "y_offset"}
+
+
+def _is_location(entry):
+    return isinstance(entry, dict) and "x_origin" in entry
+
+
+def validate_locations(raw):
+    """Raise ValueError listing every malformed location entry."""
+    if raw is None:
+        return
+    if not isinstance(raw, dict):
+        raise ValueError(f"locations file must be a mapping, not {type(raw).__name__}")
+    problems = []
+    for name, loc in raw.items():
+        if not isinstance(loc, dict) or not _LOCATION_KEYS & loc.keys():
+            continue
+        for key in ("x_origin", "y_origin"):
+            if key not in loc:
+                problems.append(f"{name} has no {key}")
+        for key in ("x_origin", "y_origin", "z_origin", "x_offset", "y_offset", "clearance_z"):
+            val = loc.get(key, 0.0)
+            if isinstance(val, bool) or not isinstance(val, (int, float)):
+                problems.append(f"{name}.{key}={val!r} is not a number")
+        for key in ("num_x", "num_y"):
+            val = loc.get(key, 1)
+            if isinstance(val, bool) or not isinstance(val, int) or val < 1:
+                problems.append(f"{name}.{key}={val!r} is not a positive integer")
+        if "clearance_z" in loc:
+            # The footprint is the grid padded by half a pitch, so a zero
+            # pitch would leave an obstacle without area
+            for key in ("x_offset", "y_offset"):
+                if loc.get(key, 0.0) == 0:
+                    problems.append(f"{name}.clearance_z needs a non-zero {key} to size its "
+                                    f"footprint; use {KEEP_OUT_ZONES} for a single spot")
+    zones = raw.get(KEEP_OUT_ZONES) or []
+    if not isinstance(zones, list):
+        problems.append(f"{KEEP_OUT_ZONES} must be a list")
+        zones = []
+    for i, zone in enumerate(zones):
+        label = f"{KEEP_OUT_ZONES}[{i}]"
+        if not isinstance(zone, dict):
+            problems.append(f"{label} is not a mapping")
+            continue
+        for key in _ZONE_KEYS:
+            val = zone.get(key)
+            if isinstance(val, bool) or not isinstance(val, (int, float)):
+                problems.append(f"{label}.{key}={val!r} is not a number")
+    if problems:
+        raise ValueError("Invalid locations: " + "; ".join(problems))
+
+
+def compile_locations(raw):
+    """Build a LocationTable from the dict loaded from a locations YAML."""
+    validate_locations(raw)
+    names, starts, widths, counts, blocks, obstacles = [], [], [], [], [], []
+    start = 0
+    for name, loc in (raw or {}).items():
+        if not _is_location(loc):
+            continue
+        nx = int(loc.get("num_x", 1)); ny = int(loc.get("num_y", 1))
+        count = nx * ny
+        idx = np.arange(count)
+        block = np.empty((count, 3))
+        block[:, 0] = float(loc["x_origin"]) + (idx % nx) * float(loc.get("x_offset", 0.0))
+        block[:, 1] = float(loc["y_origin"]) + (idx // nx) * float(loc.get("y_offset", 0.0))
+        block[:, 2] = float(loc.get("z_origin", 0.0))
+        names.append(str(name)); starts.append(start); widths.append(nx); counts.append(count)
+        blocks.append(block)
+        start += count
+        if "clearance_z" in loc:
+            # Footprint: the grid padded by half a pitch on each side
+            px = abs(float(loc.get("x_offset", 0.0))) / 2.0
+            py = abs(float(loc.get("y_offset", 0.0))) / 2.0
+            obstacles.append((block[:, 0].min() - px, block[:, 0].max() + px,
+                              block[:, 1].min() - py, block[:, 1].max() + py,
+                              float(loc["clearance_z"])))
+    for zone in (raw or {}).get(KEEP_OUT_ZONES) or []:
+        x_lo, x_hi = sorted((float(zone["x_min"]), float(zone["x_max"])))
+        y_lo, y_hi = sorted((float(zone["y_min"]), float(zone["y_max"])))
+        obstacles.append((x_lo, x_hi, y_lo, y_hi, float(zone["clearance_z"])))
+    positions = np.vstack(blocks) if blocks else np.empty((0, 3))
+    return LocationTable(raw or {}, names, positions,
+                         np.asarray(starts, dtype=np.int64),
+                         np.asarray(widths, dtype=np.int64),
+                         np.asarray(counts, dtype=np.int64),
+                         np.asarray(obstacles, dtype=float).reshape(-1, 5))
+
+
+def default_cache_path(path):
+    head, tail = os.path.split(os.path.abspath(path))
+    return os.path.join(head, f".{tail}.cache.npz")
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_cache(cache_path):
+    with np.load(cache_path, allow_pickle=False) as z:
+        meta = json.loads(str(z["meta"]))
+        if meta.get("version") != CACHE_VERSION:
+            return None, None
+        table = LocationTable(meta["raw"], meta["names"], z["positions"],
+                              z["starts"], z["widths"], z["counts"], z["obstacles"])
+    return meta, table
+
+
+def _write_cache(cache_path, table, size, mtime_ns, digest):
+    meta = {"version": CACHE_VERSION, "size": size, "mtime_ns": mtime_ns,
+            "sha256": digest, "names": table.names, "raw": table.raw}
+    buf = io.BytesIO()
+    np.savez(buf, meta=np.array(json.dumps(meta)), positions=table.positions,
+             starts=table.starts, widths=table.widths, counts=table.counts,
+             obstacles=table.obstacles)
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, cache_path)
+
+
+def load_location_table(path, cache_path=None):
+    """
+    Load and compile the locations YAML at ``path``, reusing the cached
+    table when the file is unchanged. ``cache_path`` defaults to a hidden
+    file next to the YAML; pass False to disable caching. Unreadable or
+    unwritable caches fall back to parsing the YAML.
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(path)
+    size, mtime_ns = _file_key(path)
+    digest = None
+    if cache_path:
+        try:
+            meta, table = _read_cache(cache_path)
+        except (OSError, ValueError, KeyError):
+            meta, table = None, None
+        if table is not None:
+            if (meta["size"], meta["mtime_ns"]) == (size, mtime_ns):
+                return table
+            # Touched but maybe not edited: the content hash decides
+            digest = _file_hash(path)
+            if meta["sha256"] == digest:
+                _try_write_cache(cache_path, table, size, mtime_ns, digest)
+                return table
+    with open(path, "rb") as f:
+        data = f.read()
+    raw = yaml.safe_load(data) or {}
+    table = compile_locations(raw)
+    if cache_path:
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        _try_write_cache(cache_path, table, size, mtime_ns, digest)
+    return table
+
+
+def _try_write_cache(cache_path, table, size, mtime_ns, digest):
+    try:
+        _write_cache(cache_path, table, size, mtime_ns, digest)
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Could not write location cache %s: %s", cache_path, e)
+
+
+# inotify(7) constants
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_EVENT = struct.Struct("iIII")
+
+
+def _inotify_watch(directory):
+    # (fd, wd) watching ``directory`` for files written or renamed into
+    # place, or None where inotify is unavailable
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    fd = init(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return None
+    mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+    if add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class LocationWatcher:
+    """
+    Background thread calling ``on_change()`` after ``path`` is edited.
+    Editors that save by renaming a new file into place are covered as
+    the parent directory is watched. Bursts of events are coalesced and
+    a callback only fires when the file's size or mtime actually moved.
+    """
+
+    def __init__(self, path, on_change, poll_s=1.0, settle_s=0.1):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.poll_s = poll_s
+        self.settle_s = settle_s
+        self.using_inotify = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._fd = None
+        self._key = self._stat()
+
+    def _stat(self):
+        try:
+            return _file_key(self.path)
+        except OSError:
+            return None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._fd = _inotify_watch(os.path.dirname(self.path))
+        self.using_inotify = self._fd is not None
+        self._thread = threading.Thread(target=self._run, name="location-watcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _wait_for_event(self):
+        # True when something in the directory may have changed the file
+        if self._fd is None:
+            return not self._stop.wait(self.poll_s) and self._stat() != self._key
+        ready, _, _ = select.select([self._fd], [], [], self.poll_s)
+        if not ready:
+            return False
+        name = os.fsencode(os.path.basename(self.path))
+        hit = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = _IN_EVENT.unpack_from(data, offset)
+                offset += _IN_EVENT.size
+                hit = hit or data[offset:offset + length].rstrip(b"\0") == name
+                offset += length
+        return hit
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._wait_for_event():
+                continue
+            # Let the writer finish: wait until the file stops changing
+            key = self._stat()
+            while not self._stop.wait(self.settle_s):
+                settled = self._stat()
+                if settled == key:
+                    break
+                key = settled
+            if self._stop.is_set() or key is None or key == self._key:
+                continue
+            self._key = key
+            try:
+                self.on_change()
+            except Exception:
+                logger.exception("Location reload callback failed")
@@ -0,0 +1,90 @@
+"""
+Unit tests for compiled location tables. Run with ``python -m pytest -q``.
+"""
+import os
+
+import pytest
+
+import location_table
+from location_table import default_cache_path, load_location_table
+
+RACK = "rack:\n  x_origin: 10\n  y_origin: 20\n  num_x: 2\n  x_offset: 5\n"
+
+
+@pytest.fixture
+def compiles(monkeypatch):
+    # Counts the times the YAML is actually compiled
+    calls = []
+    real = location_table.compile_locations
+
+    def counting(raw):
+        calls.append(raw)
+        return real(raw)
+
+    monkeypatch.setattr(location_table, "compile_locations", counting)
+    return calls
+
+
+def test_unchanged_file_reuses_the_cache(tmp_path, compiles):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK)
+    assert load_location_table(path).position("rack", 1) == (15.0, 20.0, 0.0)
+    assert os.path.exists(default_cache_path(path))
+    assert load_location_table(path).position("rack", 1) == (15.0, 20.0, 0.0)
+    assert len(compiles) == 1
+
+
+def test_touched_file_is_rehashed_not_recompiled(tmp_path, compiles):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK)
+    load_location_table(path)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    load_location_table(path)
+    assert len(compiles) == 1
+    # The cache now carries the new mtime, so the next load skips the hash
+    meta, _ = location_table._read_cache(default_cache_path(path))
+    assert meta["mtime_ns"] == os.stat(path).st_mtime_ns
+
+
+def test_edited_file_is_recompiled(tmp_path, compiles):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK)
+    st = os.stat(path)
+    load_location_table(path)
+    # Same size, only the mtime tells the edit apart
+    path.write_text(RACK.replace("y_origin: 20", "y_origin: 30"))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert load_location_table(path).position("rack", 0) == (10.0, 30.0, 0.0)
+    # A different size is enough even with the old mtime
+    path.write_text(RACK.replace("y_origin: 20", "y_origin: 300"))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert load_location_table(path).position("rack", 0) == (10.0, 300.0, 0.0)
+    assert len(compiles) == 3
+
+
+def test_damaged_or_disabled_cache_falls_back_to_the_yaml(tmp_path, compiles):
+    path = tmp_path / "locations.yaml"
+    path.write_text(RACK)
+    cache = default_cache_path(path)
+    with open(cache, "wb") as f:
+        f.write(b"not an npz")
+    assert load_location_table(path).position("rack", 1) == (15.0, 20.0, 0.0)
+    assert load_location_table(path, cache_path=False).position("rack", 1) == (15.0, 20.0, 0.0)
+    assert len(compiles) == 2
+
+
+def test_travel_height_needs_the_whole_path_covered():
+    table = location_table.compile_locations({location_table.KEEP_OUT_ZONES: [
+        {"x_min": 0, "x_max": 50, "y_min": 0, "y_max": 20, "clearance_z": -8},
+        {"x_min": 50, "x_max": 100, "y_min": 0, "y_max": 20, "clearance_z": -3},
+        {"x_min": 150, "x_max": 200, "y_min": 0, "y_max": 20, "clearance_z": -8},
+    ]})
+    # Adjacent zones together cover the path; the higher clearance wins
+    assert table.travel_height((10, 10, -20), (90, 10, -20)) == -3.0
+    assert table.travel_height((10, 10, -20), (40, 15, -20)) == -8.0
+    # Both ends covered, but not the gap between 100 and 150
+    assert table.travel_height((10, 10, -20), (180, 10, -20)) is None
+    # Leaving the zones sideways
+    assert table.travel_height((10, 10, -20), (10, 30, -20)) is None
+    assert location_table.compile_locations({}).travel_height((0, 0, 0), (0, 0, 0)) is None
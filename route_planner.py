@@ -0,0 +1,254 @@
+"""
+Visiting-order optimisation for point lists.
+
+Travel time between two points is the slowest of the per-axis times at the
+axis max rates (and the path length at the programmed feed, when given),
+which is how GRBL limits a straight move. The route starts at a fixed point
+and ends wherever is cheapest: a nearest-neighbour seed improved with 2-opt
+and Or-opt moves restricted to each point's nearest candidates.
+"""
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+
+Route = namedtuple("Route", "order original_s optimized_s")
+
+
+def _travel_cost(xs, ys, zs, inv_rates, inv_feed):
+    irx, iry, irz = inv_rates
+
+    def cost(i, j):
+        dx = abs(xs[i] - xs[j])
+        dy = abs(ys[i] - ys[j])
+        dz = abs(zs[i] - zs[j])
+        t = max(dx * irx, dy * iry, dz * irz)
+        if inv_feed:
+            t = max(t, math.sqrt(dx * dx + dy * dy + dz * dz) * inv_feed)
+        return t
+    return cost
+
+
+def _costs_from(P, i, inv_rates, inv_feed):
+    # Travel times from P[i] to every point
+    d = np.abs(P - P[i])
+    t = (d * inv_rates).max(axis=1)
+    if inv_feed:
+        t = np.maximum(t, np.sqrt((d * d).sum(axis=1)) * inv_feed)
+    return t
+
+
+def _pair_costs(P, a, b, inv_rates, inv_feed):
+    d = np.abs(P[a] - P[b])
+    t = (d * inv_rates).max(axis=1)
+    if inv_feed:
+        t = np.maximum(t, np.sqrt((d * d).sum(axis=1)) * inv_feed)
+    return t
+
+
+def _neighbours(P, k, inv_rates, inv_feed):
+    # Candidate lists from a uniform grid in time-scaled coordinates: each
+    # point looks at its own and the adjacent cells, keeping the k cheapest.
+    n = len(P)
+    Q = P * inv_rates
+    lo = Q.min(axis=0)
+    span = Q.max(axis=0) - lo
+    dims = np.flatnonzero(span > 0.0)
+    if len(dims) == 0:
+        return [[j for j in range(n) if j != i][:k] for i in range(n)]
+    cell = (np.prod(span[dims]) * 2.0 / n) ** (1.0 / len(dims))
+    shape = np.ones(3, dtype=np.int64)
+    idx = np.zeros((n, 3), dtype=np.int64)
+    for d in dims:
+        shape[d] = max(1, int(span[d] / cell) + 1)
+        idx[:, d] = np.minimum(((Q[:, d] - lo[d]) / cell).astype(np.int64), shape[d] - 1)
+    keys = (idx[:, 0] * shape[1] + idx[:, 1]) * shape[2] + idx[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    offsets = np.array(np.meshgrid(*[[-1, 0, 1] if d in dims else [0] for d in range(3)],
+                                   indexing="ij")).reshape(3, -1).T
+    src, dst = [], []
+    points = np.arange(n)
+    for off in offsets:
+        nb = idx + off
+        ok = ((nb >= 0) & (nb < shape)).all(axis=1)
+        nb_keys = (nb[:, 0] * shape[1] + nb[:, 1]) * shape[2] + nb[:, 2]
+        first = np.searchsorted(sorted_keys, nb_keys, "left")
+        counts = np.where(ok, np.searchsorted(sorted_keys, nb_keys, "right") - first, 0)
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        src.append(np.repeat(points, counts))
+        dst.append(order[np.arange(total) - starts + np.repeat(first, counts)])
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+    keep = src != dst
+    src, dst = src[keep], dst[keep]
+    cost = _pair_costs(P, src, dst, inv_rates, inv_feed)
+    srt = np.lexsort((cost, src))
+    src, dst = src[srt], dst[srt]
+    group_start = np.searchsorted(src, src, "left")
+    rank = np.arange(len(src)) - group_start
+    sel = rank < k
+    out = [[] for _ in range(n)]
+    for i, j in zip(src[sel].tolist(), dst[sel].tolist()):
+        out[i].append(j)
+    return out
+
+
+def _nearest_neighbour(P, neigh, inv_rates, inv_feed):
+    n = len(P)
+    visited = np.zeros(n, dtype=bool)
+    seen = [False] * n
+    route = [n - 1]
+    visited[n - 1] = seen[n - 1] = True
+    cur = n - 1
+    for _ in range(n - 1):
+        nxt = next((j for j in neigh[cur] if not seen[j]), None)
+        if nxt is None:
+            t = _costs_from(P, cur, inv_rates, inv_feed)
+            t[visited] = np.inf
+            nxt = int(t.argmin())
+        visited[nxt] = seen[nxt] = True
+        route.append(nxt)
+        cur = nxt
+    return route
+
+
+def path_time(points, order=None, start=None, rates=(3000.0, 3000.0, 1000.0), feed=None):
+    """Summed travel time in seconds visiting ``points`` in ``order``."""
+    P = np.asarray(points, dtype=float).reshape(-1, 3)
+    if order is not None:
+        P = P[np.asarray(order, dtype=np.intp)]
+    if start is not None:
+        P = np.vstack([np.asarray(start, dtype=float), P])
+    if len(P) < 2:
+        return 0.0
+    d = np.abs(np.diff(P, axis=0))
+    t = (d * (60.0 / np.asarray(rates, dtype=float))).max(axis=1)
+    if feed:
+        t = np.maximum(t, np.sqrt((d * d).sum(axis=1)) * 60.0 / float(feed))
+    return float(t.sum())
+
+
+def optimize_route(points, start=None, rates=(3000.0, 3000.0, 1000.0), feed=None,
+                   neighbours=8, time_limit=0.5):
+    """
+    Reorder ``points`` (N x 3) to minimise total travel time from ``start``
+    (defaults to the first point, which then stays first). ``rates`` are the
+    per-axis max rates and ``feed`` the programmed feed, both in mm/min.
+    Improvement stops after ``time_limit`` seconds.
+
+    Returns Route(order, original_s, optimized_s) where ``order`` indexes
+    into ``points``.
+    """
+    t_end = time.perf_counter() + time_limit
+    pts = np.asarray(points, dtype=float).reshape(-1, 3)
+    n = len(pts)
+    original = path_time(pts, start=start, rates=rates, feed=feed)
+    if n < 3:
+        return Route(list(range(n)), original, original)
+    fixed_first = start is None
+    origin = pts[0] if fixed_first else np.asarray(start, dtype=float)
+    # The start is appended as an extra node that is never moved
+    P = np.vstack([pts, origin[None, :]])
+    inv_rates = 60.0 / np.asarray(rates, dtype=float)
+    inv_feed = 60.0 / float(feed) if feed else 0.0
+
+    neigh = _neighbours(P, neighbours, inv_rates, inv_feed)
+    route = _nearest_neighbour(P, neigh, inv_rates, inv_feed)
+    pinned = 1
+    if fixed_first:
+        # Point 0 sits on the start node; pin it straight after it
+        route.remove(0)
+        route.insert(1, 0)
+        pinned = 2
+    cost = _travel_cost(P[:, 0].tolist(), P[:, 1].tolist(), P[:, 2].tolist(),
+                        inv_rates.tolist(), inv_feed)
+
+    improved = True
+    while improved and time.perf_counter() < t_end:
+        improved = _two_opt(route, cost, neigh, pinned, t_end)
+        improved = _or_opt(route, cost, neigh, pinned, t_end) or improved
+
+    order = [i for i in route if i != n]
+    optimized = path_time(pts, order, start=start, rates=rates, feed=feed)
+    if optimized > original:
+        return Route(list(range(n)), original, original)
+    return Route(order, original, optimized)
+
+
+def _two_opt(route, cost, neigh, pinned, t_end, eps=1e-12):
+    # Reverse route[i+1..j] when joining (a, c) and (b, d) is cheaper than
+    # (a, b) and (c, d); d may be past the end of the open path.
+    m = len(route)
+    pos = [0] * m
+    for k, node in enumerate(route):
+        pos[node] = k
+    any_gain = False
+    for i in range(pinned - 1, m - 2):
+        if time.perf_counter() > t_end:
+            break
+        a, b = route[i], route[i + 1]
+        ab = cost(a, b)
+        for c in neigh[a]:
+            j = pos[c]
+            if j <= i + 1:
+                continue
+            d = route[j + 1] if j + 1 < m else None
+            delta = cost(a, c) - ab
+            if d is not None:
+                delta += cost(b, d) - cost(c, d)
+            if delta < -eps:
+                route[i + 1:j + 1] = route[i + 1:j + 1][::-1]
+                for k in range(i + 1, j + 1):
+                    pos[route[k]] = k
+                any_gain = True
+                b = route[i + 1]
+                ab = cost(a, b)
+    return any_gain
+
+
+def _or_opt(route, cost, neigh, pinned, t_end, eps=1e-12):
+    # Move a run of 1-3 points (either way round) next to a neighbour
+    any_gain = False
+    for seg in (1, 2, 3):
+        m = len(route)
+        pos = {node: k for k, node in enumerate(route)}
+        i = pinned
+        while i + seg <= m:
+            if time.perf_counter() > t_end:
+                return any_gain
+            s1, sl = route[i], route[i + seg - 1]
+            p = route[i - 1]
+            nx = route[i + seg] if i + seg < m else None
+            gain = cost(p, s1)
+            if nx is not None:
+                gain += cost(sl, nx) - cost(p, nx)
+            best = None
+            for c in set(neigh[s1]) | set(neigh[sl]):
+                j = pos[c]
+                if i - 1 <= j < i + seg or j < pinned - 1:
+                    continue
+                d = route[j + 1] if j + 1 < m else None
+                cd = cost(c, d) if d is not None else 0.0
+                fwd = cost(c, s1) + (cost(sl, d) if d is not None else 0.0) - cd
+                rev = cost(c, sl) + (cost(s1, d) if d is not None else 0.0) - cd
+                add, flip = (fwd, False) if fwd <= rev else (rev, True)
+                if add - gain < -eps and (best is None or add < best[0]):
+                    best = (add, j, flip)
+            if best is None:
+                i += 1
+                continue
+            _, j, flip = best
+            moved = route[i:i + seg]
+            if flip:
+                moved.reverse()
+            rest = route[:i] + route[i + seg:]
+            at = j + 1 if j < i else j + 1 - seg
+            route[:] = rest[:at] + moved + rest[at:]
+            pos = {node: k for k, node in enumerate(route)}
+            any_gain = True
+    return any_gain
@@ -0,0 +1,51 @@
+"""
+Unit tests for the visiting-order optimiser. Run with ``python -m pytest -q``.
+"""
+import numpy as np
+import pytest
+
+from route_planner import optimize_route, path_time
+
+RATES = (3000.0, 3000.0, 1000.0)
+
+
+def nearest_neighbour_s(points, start, feed=None):
+    # Plain greedy tour from ``start``, the seed the optimiser improves on
+    left = list(range(len(points)))
+    order, cur = [], start
+    while left:
+        nxt = min(left, key=lambda i: path_time([points[i]], start=cur, rates=RATES, feed=feed))
+        left.remove(nxt)
+        order.append(nxt)
+        cur = points[nxt]
+    return path_time(points, order, start=start, rates=RATES, feed=feed)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("feed", [None, 1500.0])
+def test_route_is_a_permutation_and_never_longer(seed, feed):
+    rng = np.random.default_rng(seed)
+    points = np.column_stack([rng.uniform(0, 300, 60), rng.uniform(0, 200, 60),
+                              rng.uniform(-20, 0, 60)]).tolist()
+    start = (0.0, 0.0, 0.0)
+    route = optimize_route(points, start=start, rates=RATES, feed=feed)
+    assert sorted(route.order) == list(range(len(points)))
+    assert route.original_s == pytest.approx(path_time(points, start=start, rates=RATES, feed=feed))
+    assert route.optimized_s == pytest.approx(
+        path_time(points, route.order, start=start, rates=RATES, feed=feed))
+    assert route.optimized_s <= route.original_s + 1e-9
+    assert route.optimized_s <= nearest_neighbour_s(points, start, feed) + 1e-9
+
+
+def test_without_a_start_the_first_point_stays_first():
+    rng = np.random.default_rng(7)
+    points = rng.uniform(0, 100, (30, 3)).tolist()
+    route = optimize_route(points)
+    assert route.order[0] == 0
+    assert sorted(route.order) == list(range(len(points)))
+    assert route.optimized_s <= route.original_s + 1e-9
+
+
+def test_short_lists_keep_their_order():
+    assert optimize_route([]).order == []
+    assert optimize_route([(5, 5, 0), (1, 1, 0)], start=(0, 0, 0)).order == [0, 1]